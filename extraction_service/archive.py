@@ -0,0 +1,211 @@
+import os
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import date, datetime, timezone
+from typing import Callable, Iterator
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from defined_types import (
+    CheatingSentiment,
+    ReviewWithSentiment,
+    SteamProduct,
+    SteamReview,
+)
+
+ARCHIVE_SCHEMA = pa.schema(
+    [
+        ("recommendation_id", pa.int64()),
+        ("review", pa.string()),
+        ("language", pa.string()),
+        ("timestamp_created", pa.timestamp("us", tz="UTC")),
+        ("timestamp_updated", pa.timestamp("us", tz="UTC")),
+        ("sentiment", pa.string()),
+        # Only from backends that report one, missing from older files
+        ("confidence", pa.float64()),
+        ("model", pa.string()),
+        ("prompt_version", pa.string()),
+        ("classified_at", pa.timestamp("us", tz="UTC")),
+    ]
+)
+
+
+# Days with at least this many files are merged into one by compact
+ARCHIVE_COMPACT_MIN_FILES = 16
+
+
+@dataclass(slots=True)
+class ArchivedReview:
+    steam_review: SteamReview
+    sentiment: CheatingSentiment
+    model: str
+    prompt_version: str
+    classified_at: datetime
+    confidence: float | None = None
+
+
+class ReviewArchive:
+    # Raw reviews with the labels they got, so they can be labelled again without
+    # fetching them from Steam. Files are only ever added, one per write and day
+    # under <root>/app_id=<app_id>/date=<yyyy-mm-dd>/, a review relabelled later
+    # gets another row and the newest one wins when reading. Every chunk written adds
+    # a file, compact merges the files of a day so reads stay fast.
+    def __init__(self, root: str):
+        self.root = root
+
+    def app_path(self, app_id: int) -> str:
+        return os.path.join(self.root, f"app_id={app_id}")
+
+    def day_path(self, app_id: int, day: date) -> str:
+        return os.path.join(self.app_path(app_id), f"date={day.isoformat()}")
+
+    def append(
+        self,
+        steam_product: SteamProduct,
+        reviews_with_sentiment: list[ReviewWithSentiment],
+        model: str,
+        prompt_version: str,
+    ):
+        classified_at = datetime.now(timezone.utc)
+        by_day: dict[date, list[ReviewWithSentiment]] = {}
+        for r in reviews_with_sentiment:
+            if r.cheating_sentiment is None:
+                continue
+            day = r.steam_review.timestamp_created.astimezone(timezone.utc).date()
+            by_day.setdefault(day, []).append(r)
+
+        for day, rows in by_day.items():
+            table = pa.Table.from_pydict(
+                {
+                    "recommendation_id": [
+                        r.steam_review.recommendation_id for r in rows
+                    ],
+                    "review": [r.steam_review.review for r in rows],
+                    "language": [r.steam_review.language for r in rows],
+                    "timestamp_created": [
+                        r.steam_review.timestamp_created for r in rows
+                    ],
+                    "timestamp_updated": [
+                        r.steam_review.timestamp_updated for r in rows
+                    ],
+                    "sentiment": [r.cheating_sentiment.value for r in rows],
+                    "confidence": [r.confidence for r in rows],
+                    "model": [r.model or model for r in rows],
+                    "prompt_version": [prompt_version] * len(rows),
+                    "classified_at": [classified_at] * len(rows),
+                },
+                schema=ARCHIVE_SCHEMA,
+            )
+
+            self.write_file(self.day_path(steam_product.app_id, day), table)
+
+    @staticmethod
+    def write_file(path: str, table: pa.Table):
+        os.makedirs(path, exist_ok=True)
+        name = f"part-{time.time_ns()}-{uuid.uuid4().hex[:8]}.parquet"
+        # Readers only pick up complete files
+        tmp_path = os.path.join(path, f".{name}.tmp")
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, os.path.join(path, name))
+
+    def day_files(self, app_id: int, day: date) -> list[str]:
+        path = self.day_path(app_id, day)
+        if not os.path.isdir(path):
+            return []
+        return sorted(
+            os.path.join(path, name)
+            for name in os.listdir(path)
+            if name.endswith(".parquet")
+        )
+
+    def compact(self, app_id: int, min_files: int = ARCHIVE_COMPACT_MIN_FILES) -> int:
+        # Every row is kept, older labels are still read by eval_classifier. A
+        # crash between writing the merged file and removing the parts only leaves
+        # duplicate rows, which reading ignores
+        n_compacted = 0
+        for day in self.days(app_id):
+            files = self.day_files(app_id, day)
+            if len(files) < min_files:
+                continue
+
+            table = pa.concat_tables(
+                pq.read_table(f, schema=ARCHIVE_SCHEMA) for f in files
+            )
+            self.write_file(self.day_path(app_id, day), table.sort_by("classified_at"))
+            for f in files:
+                os.remove(f)
+            n_compacted += 1
+
+        return n_compacted
+
+    def days(
+        self,
+        app_id: int,
+        from_date: date | None = None,
+        to_date: date | None = None,
+    ) -> list[date]:
+        app_path = self.app_path(app_id)
+        if not os.path.isdir(app_path):
+            return []
+
+        days = [
+            date.fromisoformat(name.removeprefix("date="))
+            for name in os.listdir(app_path)
+            if name.startswith("date=")
+        ]
+        return sorted(
+            d
+            for d in days
+            if (from_date is None or d >= from_date)
+            and (to_date is None or d <= to_date)
+        )
+
+    def read_day(
+        self,
+        app_id: int,
+        day: date,
+        model_filter: Callable[[str], bool] | None = None,
+    ) -> list[ArchivedReview]:
+        # With model_filter, the newest row of the models it accepts
+        files = self.day_files(app_id, day)
+        if len(files) == 0:
+            return []
+
+        table = pa.concat_tables(pq.read_table(f, schema=ARCHIVE_SCHEMA) for f in files)
+        latest: dict[int, ArchivedReview] = {}
+        for row in table.sort_by("classified_at").to_pylist():
+            if model_filter is not None and not model_filter(row["model"]):
+                continue
+            latest[row["recommendation_id"]] = ArchivedReview(
+                steam_review=SteamReview(
+                    recommendation_id=row["recommendation_id"],
+                    review=row["review"],
+                    timestamp_created=row["timestamp_created"],
+                    timestamp_updated=row["timestamp_updated"],
+                    language=row["language"],
+                ),
+                sentiment=CheatingSentiment(row["sentiment"]),
+                model=row["model"],
+                prompt_version=row["prompt_version"],
+                classified_at=row["classified_at"],
+                confidence=row["confidence"],
+            )
+
+        return sorted(
+            latest.values(),
+            key=lambda a: a.steam_review.timestamp_created,
+            reverse=True,
+        )
+
+    def read(
+        self,
+        app_id: int,
+        from_date: date | None = None,
+        to_date: date | None = None,
+        model_filter: Callable[[str], bool] | None = None,
+    ) -> Iterator[list[ArchivedReview]]:
+        # One day at a time, newest first like the Steam pages
+        for day in reversed(self.days(app_id, from_date, to_date)):
+            yield self.read_day(app_id, day, model_filter)
@@ -0,0 +1,103 @@
+import argparse
+import asyncio
+import logging
+import time
+
+from benchmarks.stub_server import StubServer, sentiment_chat_route
+from defined_types import LLMServiceType
+from llm import local_llama, openrouter
+from llm.client import AsyncLimiter, LLMClient, extract_cheating_sentiment
+from mocks import generate_mock_review, generate_mock_steam_product
+
+SAMPLE_REVIEWS = [
+    "good game",
+    "cheaters everywhere, uninstalled",
+    "fun with friends but the matchmaking takes forever",
+    "anticheat actually works for once, havent seen a hacker in weeks",
+    "servers lag every evening and the devs dont care",
+    "10/10 would get wallhacked again",
+]
+
+
+def create_llm_client(service_type: LLMServiceType, url: str | None) -> LLMClient:
+    match service_type:
+        case LLMServiceType.LOCAL:
+            return local_llama.LocalLlama(llm_url=url)
+        case LLMServiceType.OPENROUTER:
+            return openrouter.OpenRouter("google/gemma-3-27b-it", api_url=url)
+
+
+async def run(
+    service_type: LLMServiceType,
+    url: str | None,
+    n_reviews: int,
+    concurrency: int,
+    batch_token_budget: int | None,
+):
+    llm_client = create_llm_client(service_type, url)
+    reviews = []
+    for i in range(n_reviews):
+        review = generate_mock_review(SAMPLE_REVIEWS[i % len(SAMPLE_REVIEWS)])
+        review.recommendation_id = i
+        reviews.append(review)
+
+    start = time.perf_counter()
+    try:
+        await extract_cheating_sentiment(
+            llm_client,
+            reviews=reviews,
+            steam_product=generate_mock_steam_product(),
+            limiter=AsyncLimiter(
+                max_concurrency=concurrency, max_requests_per_second=None
+            ),
+            batch_token_budget=batch_token_budget,
+        )
+    finally:
+        await llm_client.close()
+    elapsed = time.perf_counter() - start
+
+    mode = "single" if batch_token_budget is None else f"batch {batch_token_budget}"
+    print(
+        f"{service_type.value:<11}{mode:<12}{llm_client.usage.n_requests:>9}"
+        f"{llm_client.usage.tokens_per_review():>15.1f}"
+        f"{elapsed / n_reviews * 1000:>15.2f}"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Compares single and batched review classification. Runs against "
+        "a local stub unless --live is given, in which case the real backend is used"
+    )
+    parser.add_argument(
+        "--llm-service-type",
+        type=str,
+        choices=[LLMServiceType.LOCAL.value, LLMServiceType.OPENROUTER.value],
+        default=LLMServiceType.LOCAL.value,
+    )
+    parser.add_argument("--live", action="store_true")
+    parser.add_argument("--reviews", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--batch-token-budget", type=int, default=400)
+    args = parser.parse_args()
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    service_type = LLMServiceType(args.llm_service_type)
+
+    print(
+        f"{'backend':<11}{'mode':<12}{'requests':>9}{'tokens/review':>15}{'s/1k reviews':>15}"
+    )
+    for budget in [None, args.batch_token_budget]:
+        if args.live:
+            await run(service_type, None, args.reviews, args.concurrency, budget)
+            continue
+
+        with StubServer(
+            routes={"/v1/chat/completions": sentiment_chat_route()}
+        ) as stub:
+            url = stub.url + "/v1/chat/completions"
+            await run(service_type, url, args.reviews, args.concurrency, budget)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,269 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import random
+import resource
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from benchmarks.stub_server import (
+    delayed,
+    sentiment_chat_route,
+    steam_reviews_route,
+    stub_process,
+)
+from config import DEFAULT_LOOKBACK_WINDOW_HOURS
+from dead_letters import DeadLetterQueue
+from defined_types import IngestState, SteamReview
+from llm.client import AsyncLimiter
+from llm.local_llama import LocalLlama
+from log import log
+from main import Pipeline, extract_for_steam_product
+from metrics import metrics
+from mocks import generate_mock_reviews, generate_mock_steam_product
+from steam_product import (
+    create_steam_http_client,
+    fetch_steam_reviews,
+    fetch_steam_reviews_sliced,
+)
+from storage.sqlite import SqliteStore
+
+APP_REVIEWS_PATH = "/appreviews/0"
+CHAT_PATH = "/v1/chat/completions"
+SCENARIOS = ["steam_fetch", "steam_fetch_sliced", "pipeline", "pipeline_stream"]
+# Stages reported with their latency percentiles
+STAGES = ["steam_page_seconds", "llm_request_seconds", "limiter_wait_seconds"]
+
+WORDS = (
+    "game fun cheaters hackers aimbot ranked friends servers lag devs update "
+    "anticheat banned matchmaking maps weapons wallhack great boring"
+).split()
+
+
+def generate_reviews(n: int, seed: int) -> list[SteamReview]:
+    # The same texts and ids for every run with the seed, spread over the default
+    # lookback window so a first run fetches all of them
+    rng = random.Random(seed)
+    window = timedelta(hours=DEFAULT_LOOKBACK_WINDOW_HOURS) * 0.9
+    reviews = generate_mock_reviews(n, datetime.now(timezone.utc), window / n)
+    for review in reviews:
+        review.review = " ".join(rng.choices(WORDS, k=rng.randint(5, 60)))
+        # Steam's timestamps are whole seconds, its date range filter too
+        review.timestamp_created = review.timestamp_created.replace(microsecond=0)
+        review.timestamp_updated = review.timestamp_created
+    return reviews
+
+
+async def run_scenario(
+    scenario: str, steam_url: str, llm_url: str, args: argparse.Namespace
+) -> int:
+    steam_product = generate_mock_steam_product()
+    base_url = steam_url + "/appreviews/{app_id}"
+    from_dt = datetime.now(timezone.utc) - timedelta(
+        hours=DEFAULT_LOOKBACK_WINDOW_HOURS
+    )
+    steam_limiter = AsyncLimiter(
+        max_concurrency=None, max_requests_per_second=None, name="steam"
+    )
+    steam_http_client = create_steam_http_client()
+
+    try:
+        if scenario == "steam_fetch":
+            reviews = await fetch_steam_reviews(
+                steam_product, base_url, from_dt, steam_limiter, steam_http_client
+            )
+            return len(reviews)
+
+        if scenario == "steam_fetch_sliced":
+            reviews = await fetch_steam_reviews_sliced(
+                steam_product,
+                base_url,
+                from_dt,
+                datetime.now(timezone.utc),
+                args.slices,
+                steam_limiter,
+                steam_http_client,
+            )
+            return len(reviews)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            llm_client = LocalLlama(
+                llm_url=llm_url + CHAT_PATH, single_token=args.single_token
+            )
+            store = SqliteStore(f"{tmp_dir}/reviews.sqlite")
+            dead_letters = DeadLetterQueue(f"{tmp_dir}/dead_letters.sqlite")
+            pipeline = Pipeline(
+                store=store,
+                llm_client=llm_client,
+                llm_limiter=AsyncLimiter(
+                    max_concurrency=args.llm_concurrency,
+                    max_requests_per_second=None,
+                    name="llm",
+                ),
+                steam_limiter=steam_limiter,
+                steam_http_client=steam_http_client,
+                dead_letters=dead_letters,
+                batch_token_budget=args.batch_token_budget,
+                steam_base_url=base_url,
+            )
+            try:
+                await extract_for_steam_product(
+                    pipeline,
+                    steam_product,
+                    IngestState(app_id=steam_product.app_id),
+                    stream=scenario == "pipeline_stream",
+                )
+            finally:
+                await llm_client.close()
+                await store.close()
+                dead_letters.close()
+            return llm_client.usage.n_reviews
+    finally:
+        await steam_http_client.aclose()
+
+
+def run_scenario_process(
+    scenario: str,
+    steam_url: str,
+    llm_url: str,
+    args: argparse.Namespace,
+    results: multiprocessing.Queue,
+):
+    # Every scenario gets a fresh process, so its peak RSS is its own
+    log.setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    start = time.perf_counter()
+    n_reviews = asyncio.run(run_scenario(scenario, steam_url, llm_url, args))
+    elapsed = time.perf_counter() - start
+
+    result = {
+        "reviews": n_reviews,
+        "seconds": round(elapsed, 3),
+        "reviews_per_second": round(n_reviews / elapsed, 1),
+        # Kilobytes on Linux
+        "peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+    }
+    for (name, labels), h in metrics.histograms.items():
+        if name not in STAGES:
+            continue
+        key = name.removesuffix("_seconds") + "".join(f"_{v}" for _, v in labels)
+        result[f"{key}_p50_ms"] = round(h.quantile(0.5) * 1000, 1)
+        result[f"{key}_p99_ms"] = round(h.quantile(0.99) * 1000, 1)
+    results.put(result)
+
+
+# Gated on by --compare, the stage percentiles come from histogram buckets and are
+# too coarse to fail a run on, their changes are only printed
+GATED = {"reviews_per_second": True, "peak_rss_mb": False}
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> list[str]:
+    # Throughput that dropped or memory that grew by more than threshold
+    regressions = []
+    for scenario, result in current["results"].items():
+        previous = baseline["results"].get(scenario)
+        if previous is None:
+            continue
+        for key, value in result.items():
+            if (
+                key not in previous
+                or previous[key] == 0
+                or key in ("reviews", "seconds")
+            ):
+                continue
+            change = value / previous[key] - 1
+            regressed = False
+            if key in GATED:
+                higher_is_better = GATED[key]
+                regressed = (-change if higher_is_better else change) > threshold
+            print(
+                f"{scenario:<20}{key:<32}{previous[key]:>12}{value:>12}{change:>+9.1%}"
+                + ("  REGRESSION" if regressed else "")
+            )
+            if regressed:
+                regressions.append(f"{scenario} {key}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Runs the Steam fetch and the whole pipeline against local stub "
+        "Steam and LLM servers and records throughput, stage latencies and peak RSS"
+    )
+    parser.add_argument("--reviews", type=int, default=10_000)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--steam-latency", type=float, default=0.02)
+    parser.add_argument("--llm-latency", type=float, default=0.05)
+    parser.add_argument("--llm-error-rate", type=float, default=0.01)
+    parser.add_argument("--llm-concurrency", type=int, default=32)
+    parser.add_argument("--batch-token-budget", type=int)
+    parser.add_argument("--single-token", action="store_true")
+    parser.add_argument("--slices", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--out", type=str, help="Write the results to this JSON file, e.g. a baseline"
+    )
+    parser.add_argument(
+        "--compare", type=str, help="Compare the results with this JSON baseline"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Relative change counted as a regression by --compare",
+    )
+    args = parser.parse_args()
+
+    reviews = generate_reviews(args.reviews, args.seed)
+    steam_routes = {
+        APP_REVIEWS_PATH: delayed(steam_reviews_route(reviews), args.steam_latency)
+    }
+    llm_routes = {
+        CHAT_PATH: delayed(
+            sentiment_chat_route(error_rate=args.llm_error_rate, seed=args.seed),
+            args.llm_latency,
+        )
+    }
+    del reviews
+
+    ctx = multiprocessing.get_context("fork")
+    output = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+        "results": {},
+    }
+    with stub_process(steam_routes) as steam_url, stub_process(llm_routes) as llm_url:
+        for scenario in args.scenarios:
+            results = ctx.Queue()
+            process = ctx.Process(
+                target=run_scenario_process,
+                args=(scenario, steam_url, llm_url, args, results),
+            )
+            process.start()
+            # The result is small enough for the queue to flush before the exit
+            process.join()
+            if process.exitcode != 0:
+                raise SystemExit(f"{scenario} failed")
+            result = results.get()
+            output["results"][scenario] = result
+            print(f"{scenario:<20}{json.dumps(result)}")
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(output, f, indent=2)
+            f.write("\n")
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), output, args.threshold)
+        if len(regressions) > 0:
+            raise SystemExit(f"regressed: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import argparse
+import asyncio
+import logging
+import time
+
+import httpx
+
+from benchmarks.stub_server import StubServer, sentiment_chat_route
+from llm.client import AsyncLimiter, extract_cheating_sentiment
+from llm.local_llama import LocalLlama
+from mocks import generate_mock_review, generate_mock_steam_product
+
+CHAT_PATH = "/v1/chat/completions"
+
+
+async def fresh_client_per_request(url: str, n_requests: int, concurrency: int):
+    # How the backends behaved before they owned a pooled client
+    limiter = AsyncLimiter(max_concurrency=concurrency, max_requests_per_second=None)
+
+    async def post():
+        async with httpx.AsyncClient() as client:
+            resp = await client.post(url, json={"messages": []}, timeout=240)
+            resp.raise_for_status()
+
+    await asyncio.gather(*[limiter.run(post) for _ in range(n_requests)])
+
+
+async def pooled_client(url: str, n_requests: int, concurrency: int):
+    llm_client = LocalLlama(llm_url=url, max_connections=concurrency)
+    reviews = [generate_mock_review("good game") for _ in range(n_requests)]
+    try:
+        await extract_cheating_sentiment(
+            llm_client,
+            reviews=reviews,
+            steam_product=generate_mock_steam_product(),
+            limiter=AsyncLimiter(
+                max_concurrency=concurrency, max_requests_per_second=None
+            ),
+        )
+    finally:
+        await llm_client.close()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    args = parser.parse_args()
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    with StubServer(routes={CHAT_PATH: sentiment_chat_route()}) as stub:
+        url = stub.url + CHAT_PATH
+        for name, bench in [
+            ("fresh client per request", fresh_client_per_request),
+            ("pooled client", pooled_client),
+        ]:
+            start = time.perf_counter()
+            await bench(url, args.requests, args.concurrency)
+            elapsed = time.perf_counter() - start
+            print(f"{name:<26} {args.requests / elapsed:8.1f} requests/sec")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
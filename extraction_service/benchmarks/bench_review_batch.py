@@ -0,0 +1,47 @@
+import argparse
+import tracemalloc
+from datetime import datetime, timezone
+
+from defined_types import CheatingSentiment, ReviewBatch, ReviewWithSentiment
+from mocks import generate_mock_reviews, generate_mock_steam_product
+
+
+def mb_allocated(build) -> float:
+    tracemalloc.start()
+    kept = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return size / 1024**2
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--reviews", type=int, default=500_000)
+    args = parser.parse_args()
+
+    reviews = generate_mock_reviews(args.reviews, datetime.now(timezone.utc))
+    for r in reviews:
+        r.review = ""
+
+    def rows() -> list[ReviewWithSentiment]:
+        # One product model per row, as the pipeline built them before
+        return [
+            ReviewWithSentiment(
+                generate_mock_steam_product(), r, CheatingSentiment.NOT_MENTIONED
+            )
+            for r in reviews
+        ]
+
+    def batch() -> ReviewBatch:
+        batch = ReviewBatch(generate_mock_steam_product())
+        for r in reviews:
+            batch.append(r, CheatingSentiment.NOT_MENTIONED)
+        return batch
+
+    print(f"rows  {mb_allocated(rows):8.1f} MB for {args.reviews} reviews")
+    print(f"batch {mb_allocated(batch):8.1f} MB for {args.reviews} reviews")
+
+
+if __name__ == "__main__":
+    main()
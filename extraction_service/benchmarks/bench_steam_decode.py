@@ -0,0 +1,75 @@
+import argparse
+import json
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from benchmarks.stub_server import steam_review_json
+from defined_types import SteamReviews
+from mocks import generate_mock_reviews
+from steam_product import decode_steam_reviews_page
+
+PAGE_SIZE = 100
+
+
+def strict_decode(content: bytes):
+    batch = SteamReviews.model_validate_json(content)
+    return [r.to_review() for r in batch.reviews], batch.cursor
+
+
+def pydantic_models(content: bytes):
+    # How pages were decoded before, keeping the full models
+    batch = SteamReviews.model_validate(json.loads(content))
+    return batch.reviews, batch.cursor
+
+
+def make_page() -> bytes:
+    reviews = generate_mock_reviews(PAGE_SIZE, datetime.now(timezone.utc))
+    for r in reviews:
+        # Roughly the length of an average review
+        r.review = "the game is fun but there are some hackers in ranked " * 4
+    return json.dumps(
+        {
+            "success": 1,
+            "query_summary": {"num_reviews": PAGE_SIZE},
+            "reviews": [steam_review_json(r) for r in reviews],
+            "cursor": "AoJ4vL7x2YcDe",
+        }
+    ).encode()
+
+
+def pages_per_second(decode, page: bytes, n_pages: int) -> float:
+    start = time.perf_counter()
+    for _ in range(n_pages):
+        decode(page)
+    return n_pages / (time.perf_counter() - start)
+
+
+def mb_per_100k_reviews(decode, page: bytes) -> float:
+    n_pages = 100_000 // PAGE_SIZE
+    tracemalloc.start()
+    kept = [decode(page)[0] for _ in range(n_pages)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return size / 1024**2
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=2000)
+    args = parser.parse_args()
+
+    page = make_page()
+    for name, decode in [
+        ("pydantic models", pydantic_models),
+        ("strict", strict_decode),
+        ("lean", decode_steam_reviews_page),
+    ]:
+        rate = pages_per_second(decode, page, args.pages)
+        mb = mb_per_100k_reviews(decode, page)
+        print(f"{name:<16} {rate:8.1f} pages/sec {mb:8.1f} MB per 100k reviews")
+
+
+if __name__ == "__main__":
+    main()
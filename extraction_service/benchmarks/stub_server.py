@@ -0,0 +1,242 @@
+import json
+import math
+import multiprocessing
+import random
+import re
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing.connection import Connection
+from typing import Callable, Iterator
+from urllib.parse import parse_qs, urlparse
+
+from defined_types import CheatingSentiment, SteamReview
+from mocks import generate_mock_api_review
+
+
+@dataclass
+class StubRequest:
+    method: str
+    path: str
+    query: dict[str, list[str]]
+    body: dict | None
+
+
+# A route receives the recorded request and returns (status code, json body)
+Route = Callable[[StubRequest], tuple[int, dict]]
+
+
+@dataclass
+class StubServer:
+    """
+    Local stand-in for the Steam and LLM HTTP APIs, served from a background
+    thread so it can be driven by the async clients under test or benchmark.
+    """
+
+    routes: dict[str, Route]
+    latency: float = 0
+    requests: list[StubRequest] = field(default_factory=list)
+    # Off for long benchmarks, the recorded requests would only grow
+    record_requests: bool = True
+
+    def __enter__(self) -> "StubServer":
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately, with Nagle's algorithm every
+            # keep-alive response would wait for the client's delayed ACK
+            disable_nagle_algorithm = True
+
+            def _handle(self, method: str):
+                url = urlparse(self.path)
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length)) if length > 0 else None
+                request = StubRequest(method, url.path, parse_qs(url.query), body)
+                if stub.record_requests:
+                    stub.requests.append(request)
+
+                route = stub.routes.get(url.path)
+                if route is None:
+                    status, payload = 404, {"error": "not found"}
+                else:
+                    if stub.latency > 0:
+                        time.sleep(stub.latency)
+                    status, payload = route(request)
+
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+            # The default backlog of 5 resets connections when a benchmark opens a
+            # whole pool at once
+            request_queue_size = 128
+
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def serve_stub(routes: dict[str, Route], conn: Connection):
+    with StubServer(routes=routes, record_requests=False) as stub:
+        conn.send(stub.url)
+        stub.thread.join()
+
+
+@contextmanager
+def stub_process(routes: dict[str, Route]) -> Iterator[str]:
+    # Serves the routes from a forked process and yields its url, so the stub doesn't
+    # compete for the GIL with the code being benchmarked. Routes are closures, they
+    # are inherited by the fork instead of pickled.
+    ctx = multiprocessing.get_context("fork")
+    parent_conn, child_conn = ctx.Pipe()
+    process = ctx.Process(target=serve_stub, args=(routes, child_conn), daemon=True)
+    process.start()
+    try:
+        yield parent_conn.recv()
+    finally:
+        process.terminate()
+        process.join()
+
+
+def delayed(route: Route, latency: float) -> Route:
+    # Latency of a single route, StubServer.latency applies to all of them
+    def delayed_route(request: StubRequest) -> tuple[int, dict]:
+        time.sleep(latency)
+        return route(request)
+
+    return delayed_route
+
+
+def sentiment_chat_route(
+    sentiment: str = "not mentioned", error_rate: float = 0, seed: int = 0
+) -> Route:
+    # Answers single and batched sentiment requests with the same sentiment. Token
+    # usage is estimated from the prompt length like llm.client.estimate_tokens.
+    # error_rate of the requests get a 503, drawn from a seeded generator so runs
+    # fail the same share of requests. Single token requests, the ones with a
+    # grammar, get the sentiment's first word as the token with 90% probability.
+    rng = random.Random(seed)
+    rng_lock = threading.Lock()
+
+    def route(request: StubRequest) -> tuple[int, dict]:
+        if error_rate > 0:
+            with rng_lock:
+                failed = rng.random() < error_rate
+            if failed:
+                return 503, {"error": "overloaded"}
+
+        body = request.body or {}
+        prompt = "".join(m["content"] for m in body.get("messages", []))
+        usage = {"prompt_tokens": len(prompt) // 4 + 1, "completion_tokens": 1}
+
+        if "grammar" in body:
+            tokens = [sentiment.split()[0]] + [
+                s.value.split()[0] for s in CheatingSentiment if s.value != sentiment
+            ]
+            top_logprobs = [
+                {"token": token, "logprob": math.log(p)}
+                for token, p in zip(tokens, [0.9, 0.06, 0.04])
+            ]
+            return 200, {
+                "choices": [
+                    {
+                        "message": {"role": "assistant", "content": tokens[0]},
+                        "logprobs": {
+                            "content": [
+                                {**top_logprobs[0], "top_logprobs": top_logprobs}
+                            ]
+                        },
+                    }
+                ],
+                "usage": usage,
+            }
+
+        schema_name = body.get("response_format", {}).get("json_schema", {}).get("name")
+
+        if schema_name == "cheating_sentiments":
+            ids = re.findall(r'"recommendation_id": "(\d+)"', prompt)
+            answer = {
+                "sentiments": [
+                    {"recommendation_id": i, "cheating_sentiment": sentiment}
+                    for i in ids
+                ]
+            }
+        else:
+            answer = {"cheating_sentiment": sentiment}
+
+        content = json.dumps(answer)
+        usage["completion_tokens"] = len(content) // 4 + 1
+        return 200, {
+            "choices": [{"message": {"role": "assistant", "content": content}}],
+            "usage": usage,
+        }
+
+    return route
+
+
+API_REVIEW_TEMPLATE = generate_mock_api_review("").model_dump(
+    mode="json", by_alias=True
+)
+
+
+def steam_review_json(review: SteamReview) -> dict:
+    # Everything appreviews returns for a review, with mock values for the fields
+    # the pipeline doesn't keep
+    return {**API_REVIEW_TEMPLATE, **review.to_dict()}
+
+
+def steam_reviews_route(reviews: list[SteamReview]) -> Route:
+    # Pages through the reviews newest first like appreviews with filter=recent, the
+    # cursor is the offset of the next page. Supports the start_date/end_date range.
+    reviews = sorted(reviews, key=lambda r: r.timestamp_created, reverse=True)
+    # Ascending, for bisecting the date range
+    negated_timestamps = [-r.timestamp_created.timestamp() for r in reviews]
+
+    def route(request: StubRequest) -> tuple[int, dict]:
+        first, last = 0, len(reviews)
+        if request.query.get("date_range_type") == ["include"]:
+            start_date = int(request.query["start_date"][0])
+            end_date = int(request.query["end_date"][0])
+            first = bisect_left(negated_timestamps, -end_date)
+            last = bisect_right(negated_timestamps, -start_date)
+
+        cursor = request.query.get("cursor", ["*"])[0]
+        offset = 0 if cursor == "*" else int(cursor)
+        num_per_page = int(request.query.get("num_per_page", ["20"])[0])
+        page = reviews[first + offset : min(last, first + offset + num_per_page)]
+        return 200, {
+            "success": 1,
+            "query_summary": {"num_reviews": len(page)},
+            "reviews": [steam_review_json(r) for r in page],
+            "cursor": str(offset + len(page)),
+        }
+
+    return route
@@ -0,0 +1,72 @@
+import asyncio
+from datetime import datetime
+from typing import Awaitable, Callable
+
+from defined_types import SteamCheckpoint, SteamReview
+from log import log
+
+
+class PageCheckpointer:
+    # Pages are classified and written out of order, the checkpoint only moves past a
+    # page once every review on it and on all the pages before it is written
+    def __init__(
+        self,
+        checkpoint: SteamCheckpoint,
+        every_n_pages: int,
+        save: Callable[[SteamCheckpoint], Awaitable[None]],
+    ):
+        self.checkpoint = checkpoint
+        self.every_n_pages = every_n_pages
+        self.save = save
+        self.lock = asyncio.Lock()
+
+        self.n_pages = 0
+        # Pages before this index are completely written
+        self.n_written_pages = 0
+        self.n_checkpointed_pages = 0
+        self.page_of: dict[int, int] = {}
+        self.n_unwritten: dict[int, int] = {}
+        self.next_cursors: dict[int, str] = {}
+        self.oldest_review_ts: dict[int, datetime] = {}
+
+    def add_page(self, reviews: list[SteamReview], next_cursor: str):
+        page = self.n_pages
+        self.n_pages += 1
+
+        self.checkpoint.update_newest(reviews)
+
+        # A review that's still in flight from an earlier page is counted there
+        new_ids = {r.recommendation_id for r in reviews} - self.page_of.keys()
+        for review_id in new_ids:
+            self.page_of[review_id] = page
+        self.n_unwritten[page] = len(new_ids)
+        self.next_cursors[page] = next_cursor
+        self.oldest_review_ts[page] = min(r.timestamp_created for r in reviews)
+
+    async def written(self, review_ids: list[int]):
+        for review_id in review_ids:
+            page = self.page_of.pop(review_id, None)
+            if page is not None:
+                self.n_unwritten[page] -= 1
+
+        while self.n_unwritten.get(self.n_written_pages) == 0:
+            page = self.n_written_pages
+            self.checkpoint.cursor = self.next_cursors.pop(page)
+            self.checkpoint.oldest_review_ts = self.oldest_review_ts.pop(page)
+            del self.n_unwritten[page]
+            self.n_written_pages += 1
+
+        if self.n_written_pages - self.n_checkpointed_pages < self.every_n_pages:
+            return
+
+        # Saved under the lock so a slow save can't overwrite a newer checkpoint
+        async with self.lock:
+            if self.n_written_pages - self.n_checkpointed_pages < self.every_n_pages:
+                return
+            self.n_checkpointed_pages = self.n_written_pages
+            checkpoint = self.checkpoint.model_copy()
+            log.info(
+                f"checkpoint after {self.n_written_pages} pages, written down to "
+                f"{checkpoint.oldest_review_ts}"
+            )
+            await self.save(checkpoint)
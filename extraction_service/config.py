@@ -9,8 +9,34 @@ marvel = SteamProduct(name="Marvel Rivals", app_id=2767030)
 tarkov = SteamProduct(name="Escape from Tarkov", app_id=3932890)
 apex = SteamProduct(name="Apex Legends", app_id=1172470)
 
+STEAM_APPS = [finals, arc, bf6, cs2, pubg, marvel, tarkov, apex]
+
 STEAM_REQUEST_PER_SECOND = 2
+# Pages between checkpoints of a streamed ingest
+STEAM_CHECKPOINT_PAGES = 10
+
+# Used by the --stream pipeline: reviews waiting for the LLM and reviews per write
+STREAM_QUEUE_SIZE = 1000
+STREAM_FLUSH_SIZE = 500
 
 
 FIREBASE_JSON = "cheating-sentiment-firebase-adminsdk.json"
 DEFAULT_LOOKBACK_WINDOW_HOURS = 24 * 7
+FIRESTORE_MAX_CONCURRENT_QUERIES = 32
+FIRESTORE_MAX_CONCURRENT_COMMITS = 8
+
+SENTIMENT_CACHE_PATH = "sentiment_cache.sqlite"
+SENTIMENT_CACHE_MAX_ENTRIES = 500_000
+
+DEAD_LETTERS_PATH = "dead_letters.sqlite"
+# Reviews failing this many runs in a row stay in the dead letters but aren't
+# retried anymore
+DEAD_LETTERS_MAX_ATTEMPTS = 5
+
+# Used instead of Firestore with --storage sqlite
+SQLITE_STORE_PATH = "reviews.sqlite"
+
+REVIEW_ARCHIVE_PATH = "review_archive"
+
+# Trained by eval_classifier.py --out, used with --llm-service-type classifier
+LOCAL_CLASSIFIER_PATH = "local_classifier.bin"
@@ -0,0 +1,104 @@
+import asyncio
+import json
+import re
+
+import httpx
+from defined_types import (
+    CheatingSentiment,
+    ReviewWithSentiment,
+    SteamProduct,
+    SteamReview,
+)
+from llm.client import LLMClient, LLMUsage
+
+
+class MockLLMClient(LLMClient):
+    # The LLM client the tests share. Answers every review with the same sentiment
+    # after latency seconds, through cheating_ref_in_review or a chat completion
+    # like the backends return. Batch answers can use their own sentiment and leave
+    # out drop_from_batch, to tell them apart from the single review path. With
+    # fail set every call fails like a backend that can't be reached, with
+    # n_failures only the first n_failures single review calls do.
+    def __init__(
+        self,
+        sentiment: CheatingSentiment = CheatingSentiment.NOT_MENTIONED,
+        latency: float = 0,
+        fail: bool = False,
+        healthy: bool = True,
+        model: str = "mock",
+        batch_sentiment: CheatingSentiment | None = None,
+        drop_from_batch: int | None = None,
+        n_failures: int = 0,
+    ):
+        self.usage = LLMUsage()
+        self.sentiment = sentiment
+        self.latency = latency
+        self.fail = fail
+        self.healthy = healthy
+        self.model = model
+        self.batch_sentiment = batch_sentiment or sentiment
+        self.drop_from_batch = drop_from_batch
+        self.n_failures = n_failures
+        self.reviews: list[str] = []
+        self.n_calls = 0
+        self.n_batch_calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def call(self, fail: bool = False):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+            if self.fail or fail:
+                raise httpx.ConnectError("connection refused")
+        finally:
+            self.in_flight -= 1
+
+    async def cheating_ref_in_review(
+        self, review: SteamReview, steam_product: SteamProduct
+    ) -> ReviewWithSentiment:
+        self.n_calls += 1
+        await self.call(fail=self.n_calls <= self.n_failures)
+        self.reviews.append(review.review)
+        self.usage.record(
+            {"usage": {"prompt_tokens": 1000, "completion_tokens": 10}}, 1
+        )
+        return ReviewWithSentiment(
+            steam_product=steam_product,
+            steam_review=review,
+            cheating_sentiment=self.sentiment,
+        )
+
+    async def complete_chat(self, prompt: str, response_format: dict) -> httpx.Response:
+        await self.call()
+        if response_format["json_schema"]["name"] == "cheating_sentiments":
+            self.n_batch_calls += 1
+            answer = {
+                "sentiments": [
+                    {
+                        "recommendation_id": i,
+                        "cheating_sentiment": self.batch_sentiment.value,
+                    }
+                    for i in re.findall(r'"recommendation_id": "(\d+)"', prompt)
+                    if int(i) != self.drop_from_batch
+                ]
+            }
+        else:
+            answer = {"cheating_sentiment": self.sentiment.value}
+        return httpx.Response(
+            200,
+            json={
+                "choices": [{"message": {"content": json.dumps(answer)}}],
+                "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": 10},
+            },
+        )
+
+    def get_model(self) -> str:
+        return self.model
+
+    async def check_health(self) -> bool:
+        return self.healthy
+
+    async def close(self):
+        pass
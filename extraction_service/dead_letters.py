@@ -0,0 +1,92 @@
+import json
+import sqlite3
+import time
+
+from config import DEAD_LETTERS_MAX_ATTEMPTS
+from defined_types import SteamProduct, SteamReview
+from log import log
+
+
+class DeadLetterQueue:
+    # Reviews that couldn't be classified are kept here with their full text, so
+    # the next run can retry them without fetching them from Steam again. Once a
+    # review failed max_attempts times it's kept for inspection but not retried.
+    def __init__(self, path: str, max_attempts: int = DEAD_LETTERS_MAX_ATTEMPTS):
+        self.max_attempts = max_attempts
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS dead_letters (
+                app_id INTEGER NOT NULL,
+                recommendation_id INTEGER NOT NULL,
+                review TEXT NOT NULL,
+                n_failures INTEGER NOT NULL,
+                first_failed_at REAL NOT NULL,
+                last_failed_at REAL NOT NULL,
+                PRIMARY KEY (app_id, recommendation_id)
+            )"""
+        )
+        self.conn.commit()
+
+    def add(self, steam_product: SteamProduct, reviews: list[SteamReview]):
+        t = time.time()
+        self.conn.executemany(
+            """INSERT INTO dead_letters VALUES (?, ?, ?, 1, ?, ?)
+            ON CONFLICT (app_id, recommendation_id) DO UPDATE SET
+                n_failures = n_failures + 1,
+                last_failed_at = excluded.last_failed_at""",
+            [
+                (
+                    steam_product.app_id,
+                    r.recommendation_id,
+                    json.dumps(r.to_dict()),
+                    t,
+                    t,
+                )
+                for r in reviews
+            ],
+        )
+        self.conn.commit()
+
+        (n_given_up,) = self.conn.execute(
+            "SELECT COUNT(*) FROM dead_letters WHERE app_id = ? AND n_failures = ?",
+            (steam_product.app_id, self.max_attempts),
+        ).fetchone()
+        if n_given_up > 0:
+            log.warning(
+                f"{n_given_up} dead letters for app_id {steam_product.app_id} failed "
+                f"{self.max_attempts} times and aren't retried anymore"
+            )
+
+    def get(self, steam_product: SteamProduct) -> list[SteamReview]:
+        rows = self.conn.execute(
+            "SELECT review FROM dead_letters WHERE app_id = ? AND n_failures < ? "
+            "ORDER BY recommendation_id",
+            (steam_product.app_id, self.max_attempts),
+        ).fetchall()
+        return [SteamReview.from_dict(json.loads(row[0])) for row in rows]
+
+    def remove(self, steam_product: SteamProduct, review_ids: list[int]):
+        self.conn.executemany(
+            "DELETE FROM dead_letters WHERE app_id = ? AND recommendation_id = ?",
+            [(steam_product.app_id, i) for i in review_ids],
+        )
+        self.conn.commit()
+
+    def count(self) -> int:
+        # Only the reviews that are still retried
+        (n,) = self.conn.execute(
+            "SELECT COUNT(*) FROM dead_letters WHERE n_failures < ?",
+            (self.max_attempts,),
+        ).fetchone()
+        return n
+
+    def count_given_up(self) -> int:
+        (n,) = self.conn.execute(
+            "SELECT COUNT(*) FROM dead_letters WHERE n_failures >= ?",
+            (self.max_attempts,),
+        ).fetchone()
+        return n
+
+    def close(self):
+        self.conn.close()
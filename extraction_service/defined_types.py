@@ -1,12 +1,27 @@
+from array import array
+from dataclasses import dataclass, field
 from enum import StrEnum
 from pydantic import BaseModel, Field
-from datetime import datetime
+from datetime import date, datetime, timedelta, timezone
 from typing import Optional
 
 
 class LLMServiceType(StrEnum):
     LOCAL = "local"
     OPENROUTER = "openrouter"
+    ROUTER = "router"
+    CLASSIFIER = "classifier"
+
+
+class StorageType(StrEnum):
+    FIRESTORE = "firestore"
+    SQLITE = "sqlite"
+
+
+class PrefilterRecall(StrEnum):
+    LOW = "low"
+    MEDIUM = "medium"
+    HIGH = "high"
 
 
 class SteamProduct(BaseModel):
@@ -27,7 +42,8 @@ class Author(BaseModel):
     last_played: int
 
 
-class SteamReview(BaseModel):
+class SteamApiReview(BaseModel):
+    # Everything Steam returns for a review, only validated in the strict mode
     recommendation_id: int = Field(alias="recommendationid")
     author: Author
     language: str = ""
@@ -44,6 +60,53 @@ class SteamReview(BaseModel):
     written_during_early_access: bool
     primarily_steam_deck: bool
 
+    def to_review(self) -> "SteamReview":
+        return SteamReview(
+            recommendation_id=self.recommendation_id,
+            review=self.review,
+            timestamp_created=self.timestamp_created,
+            timestamp_updated=self.timestamp_updated,
+            language=self.language,
+        )
+
+
+def parse_timestamp(value: int | str) -> datetime:
+    # Steam sends unix timestamps, reviews serialized by an older version used
+    # ISO strings
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return datetime.fromtimestamp(value, tz=timezone.utc)
+
+
+@dataclass(slots=True)
+class SteamReview:
+    # The fields of a review the pipeline uses, decoded straight from the Steam
+    # JSON without building a model per review
+    recommendation_id: int
+    review: str
+    timestamp_created: datetime
+    timestamp_updated: datetime
+    language: str = ""
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "SteamReview":
+        return cls(
+            recommendation_id=int(d["recommendationid"]),
+            review=d["review"],
+            timestamp_created=parse_timestamp(d["timestamp_created"]),
+            timestamp_updated=parse_timestamp(d["timestamp_updated"]),
+            language=d.get("language", ""),
+        )
+
+    def to_dict(self) -> dict[str, int | str]:
+        return {
+            "recommendationid": self.recommendation_id,
+            "review": self.review,
+            "timestamp_created": int(self.timestamp_created.timestamp()),
+            "timestamp_updated": int(self.timestamp_updated.timestamp()),
+            "language": self.language,
+        }
+
 
 class SteamQuerySummary(BaseModel):
     num_reviews: int
@@ -57,7 +120,7 @@ class SteamQuerySummary(BaseModel):
 class SteamReviews(BaseModel):
     success: int
     query_summary: SteamQuerySummary
-    reviews: list[SteamReview]
+    reviews: list[SteamApiReview]
     cursor: str
 
 
@@ -83,6 +146,9 @@ class CheatingSentiment(StrEnum):
 class FirestoreReview(BaseModel):
     sentiment: CheatingSentiment | None
     timestamp_created: datetime
+    # What produced the sentiment, reviews stored before these were kept have neither
+    model: str | None = None
+    prompt_version: str | None = None
 
     def to_dict(self) -> dict[str, str | datetime | None]:
         if self.sentiment is None:
@@ -90,16 +156,196 @@ class FirestoreReview(BaseModel):
         else:
             value = self.sentiment.value
 
-        return {"sentiment": value, "timestamp_created": self.timestamp_created}
+        d = {"sentiment": value, "timestamp_created": self.timestamp_created}
+        if self.model is not None:
+            d["model"] = self.model
+        if self.prompt_version is not None:
+            d["prompt_version"] = self.prompt_version
+        return d
+
+
+class SteamCheckpoint(BaseModel):
+    # Steam cursor of the next page to fetch
+    cursor: str = "*"
+    # Lower bound of the window being ingested, the watermark when it started
+    from_dt: datetime
+    # Becomes the watermark once the whole window is written
+    newest_review_ts: datetime | None = None
+    # Every review from here up to newest_review_ts is written
+    oldest_review_ts: datetime | None = None
+
+    def update_newest(self, reviews: list[SteamReview]):
+        for r in reviews:
+            if (
+                self.newest_review_ts is None
+                or r.timestamp_created > self.newest_review_ts
+            ):
+                self.newest_review_ts = r.timestamp_created
+
+    def to_dict(self) -> dict[str, str | datetime | None]:
+        return {
+            "cursor": self.cursor,
+            "from_dt": self.from_dt,
+            "newest_review_ts": self.newest_review_ts,
+            "oldest_review_ts": self.oldest_review_ts,
+        }
+
+
+class IngestState(BaseModel):
+    app_id: int
+    # Created timestamp of the newest review that has been ingested
+    last_review_ts: datetime | None = None
+    # Set while reviews newer than last_review_ts are being written, an interrupted
+    # run can have stored some of the reviews up to this timestamp
+    pending_review_ts: datetime | None = None
+    product_known: bool = False
+    # Set while a window is partially written, the next run resumes from it
+    checkpoint: SteamCheckpoint | None = None
 
+    def known_new_after(self) -> datetime | None:
+        # Reviews created after this can't be stored yet
+        timestamps = [
+            ts for ts in (self.last_review_ts, self.pending_review_ts) if ts is not None
+        ]
+        return max(timestamps, default=None)
 
-class ReviewWithSentiment(BaseModel):
+    def to_dict(self) -> dict[str, int | datetime | bool | dict | None]:
+        return {
+            "app_id": self.app_id,
+            "last_review_ts": self.last_review_ts,
+            "pending_review_ts": self.pending_review_ts,
+            "product_known": self.product_known,
+            "checkpoint": None
+            if self.checkpoint is None
+            else self.checkpoint.to_dict(),
+        }
+
+
+@dataclass(slots=True)
+class StoredLabel:
+    # A stored review's sentiment and what produced it
+    sentiment: CheatingSentiment | None
+    model: str | None = None
+    prompt_version: str | None = None
+
+
+@dataclass(slots=True)
+class ReviewWithSentiment:
     steam_product: SteamProduct
     steam_review: SteamReview
     cheating_sentiment: CheatingSentiment | None
+    # Probability of the sentiment, from backends that report one, kept in the archive
+    confidence: float | None = None
+    # The model that answered, when it isn't the client's own, e.g. one of the
+    # router's backends
+    model: str | None = None
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+SENTIMENT_CODES = list(CheatingSentiment)
+NO_SENTIMENT = -1
+
+
+@dataclass(slots=True)
+class ReviewBatch:
+    # Classified reviews of one product stored column by column, the product is held
+    # once per batch and the review texts aren't kept
+    steam_product: SteamProduct
+    recommendation_ids: array = field(default_factory=lambda: array("q"))
+    # Microseconds since the epoch, exact unlike float seconds
+    timestamps_created: array = field(default_factory=lambda: array("q"))
+    # Index into SENTIMENT_CODES or NO_SENTIMENT
+    sentiments: array = field(default_factory=lambda: array("b"))
+    # What the whole batch was classified with
+    model: str | None = None
+    prompt_version: str | None = None
+    # One model per review, only when some review was answered by another model
+    # than the batch's
+    row_models: list[str | None] | None = None
+
+    @classmethod
+    def from_reviews(
+        cls,
+        steam_product: SteamProduct,
+        reviews_with_sentiment: list[ReviewWithSentiment],
+        model: str | None = None,
+        prompt_version: str | None = None,
+    ) -> "ReviewBatch":
+        batch = cls(steam_product, model=model, prompt_version=prompt_version)
+        for r in reviews_with_sentiment:
+            batch.append(r.steam_review, r.cheating_sentiment, r.model)
+        return batch
+
+    def append(
+        self,
+        review: SteamReview,
+        sentiment: CheatingSentiment | None,
+        model: str | None = None,
+    ):
+        if model is not None and model != self.model and self.row_models is None:
+            self.row_models = [self.model] * len(self)
+        if self.row_models is not None:
+            self.row_models.append(model or self.model)
+        self.recommendation_ids.append(review.recommendation_id)
+        self.timestamps_created.append(
+            (review.timestamp_created - EPOCH) // timedelta(microseconds=1)
+        )
+        self.sentiments.append(
+            NO_SENTIMENT if sentiment is None else SENTIMENT_CODES.index(sentiment)
+        )
+
+    def __len__(self) -> int:
+        return len(self.recommendation_ids)
+
+    def __getitem__(self, s: slice) -> "ReviewBatch":
+        return ReviewBatch(
+            self.steam_product,
+            self.recommendation_ids[s],
+            self.timestamps_created[s],
+            self.sentiments[s],
+            self.model,
+            self.prompt_version,
+            None if self.row_models is None else self.row_models[s],
+        )
+
+    def model_of(self, i: int) -> str | None:
+        return self.model if self.row_models is None else self.row_models[i]
+
+    def timestamp_created(self, i: int) -> datetime:
+        return EPOCH + timedelta(microseconds=self.timestamps_created[i])
+
+    def sentiment(self, i: int) -> CheatingSentiment | None:
+        code = self.sentiments[i]
+        return None if code == NO_SENTIMENT else SENTIMENT_CODES[code]
+
+    def newest_timestamp_created(self) -> datetime:
+        return EPOCH + timedelta(microseconds=max(self.timestamps_created))
+
+    def dates(self) -> set[date]:
+        return {
+            (EPOCH + timedelta(microseconds=ts)).date()
+            for ts in set(self.timestamps_created)
+        }
+
+    def classified(self) -> "ReviewBatch":
+        batch = ReviewBatch(
+            self.steam_product, model=self.model, prompt_version=self.prompt_version
+        )
+        if self.row_models is not None:
+            batch.row_models = []
+        for i, code in enumerate(self.sentiments):
+            if code != NO_SENTIMENT:
+                batch.recommendation_ids.append(self.recommendation_ids[i])
+                batch.timestamps_created.append(self.timestamps_created[i])
+                batch.sentiments.append(code)
+                if batch.row_models is not None:
+                    batch.row_models.append(self.row_models[i])
+        return batch
 
-    def to_firestore_review(self) -> FirestoreReview:
+    def to_firestore_review(self, i: int) -> FirestoreReview:
         return FirestoreReview(
-            sentiment=self.cheating_sentiment,
-            timestamp_created=self.steam_review.timestamp_created,
+            sentiment=self.sentiment(i),
+            timestamp_created=self.timestamp_created(i),
+            model=self.model_of(i),
+            prompt_version=self.prompt_version,
         )
@@ -0,0 +1,177 @@
+import argparse
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+
+from dotenv import load_dotenv
+
+import firebase
+from archive import ReviewArchive
+from config import (
+    LOCAL_CLASSIFIER_PATH,
+    REVIEW_ARCHIVE_PATH,
+    SQLITE_STORE_PATH,
+    STEAM_APPS,
+)
+from defined_types import CheatingSentiment, StorageType, SteamReview
+from llm.local_classifier import (
+    CLASSIFIER_N_FEATURES,
+    LinearClassifier,
+    is_llm_label,
+)
+from log import log
+from storage.firestore import FirestoreStore
+from storage.sqlite import SqliteStore
+from storage.store import ReviewStore
+
+load_dotenv()
+
+THRESHOLDS = [0.5, 0.7, 0.8, 0.9, 0.95, 0.99]
+
+# The archive has the review texts and the labels they got, the store has the
+# labels that were kept. With --storage the stored label wins, so labels fixed
+# after archiving are learned too. Labels the classifier gave itself, archived or
+# stored, are never learned from, the newest LLM label is used instead.
+
+
+async def load_labelled_reviews(
+    archive: ReviewArchive, store: ReviewStore | None, days: int, app_ids: list[int]
+) -> list[tuple[SteamReview, CheatingSentiment]]:
+    from_date = (datetime.now(timezone.utc) - timedelta(days=days)).date()
+    labelled = []
+    for app_id in app_ids:
+        archived = [
+            a
+            for day in archive.read(app_id, from_date, model_filter=is_llm_label)
+            for a in day
+        ]
+        sentiments = {a.steam_review.recommendation_id: a.sentiment for a in archived}
+        if store is not None:
+            stored = await store.get_review_labels(app_id, list(sentiments))
+            sentiments.update(
+                (k, label.sentiment)
+                for k, label in stored.items()
+                if label.sentiment is not None and is_llm_label(label.model)
+            )
+
+        labelled.extend(
+            (a.steam_review, sentiments[a.steam_review.recommendation_id])
+            for a in archived
+        )
+
+    return labelled
+
+
+def evaluate(
+    classifier: LinearClassifier,
+    labelled: list[tuple[SteamReview, CheatingSentiment]],
+):
+    start = time.perf_counter()
+    predictions = classifier.predict([r.review for r, _ in labelled])
+    elapsed = time.perf_counter() - start
+
+    labels = [label for _, label in labelled]
+    agree = sum(p == label for (p, _), label in zip(predictions, labels))
+    log.info(
+        f"{len(labelled)} held out reviews in {elapsed:.2f}s, "
+        f"{len(labelled) / elapsed:.0f} reviews/s, {agree / len(labelled):.1%} "
+        "agree with the LLM"
+    )
+
+    print(f"{'llm label':<16}{'reviews':>10}{'agree %':>10}")
+    for sentiment in CheatingSentiment:
+        idxs = [i for i, label in enumerate(labels) if label == sentiment]
+        if len(idxs) == 0:
+            continue
+        n_agree = sum(predictions[i][0] == sentiment for i in idxs)
+        print(f"{sentiment.value:<16}{len(idxs):>10}{n_agree / len(idxs):>10.1%}")
+
+    # Reviews below the threshold are escalated to the LLM, so these agree with it
+    print(f"\n{'threshold':<12}{'local %':>10}{'agree %':>10}{'overall %':>11}")
+    for threshold in THRESHOLDS:
+        local = [i for i, (_, c) in enumerate(predictions) if c >= threshold]
+        n_agree = sum(predictions[i][0] == labels[i] for i in local)
+        print(
+            f"{threshold:<12}{len(local) / len(labels):>10.1%}"
+            f"{n_agree / max(1, len(local)):>10.1%}"
+            f"{(n_agree + len(labels) - len(local)) / len(labels):>11.1%}"
+        )
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Trains the local classifier on the archived LLM labels, reports "
+        "how often it agrees with the LLM on the newest reviews and how fast it is "
+        "on this CPU"
+    )
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--app-ids", type=int, nargs="+")
+    parser.add_argument("--archive", type=str, default=REVIEW_ARCHIVE_PATH)
+    parser.add_argument(
+        "--storage",
+        type=str,
+        choices=[s.value for s in StorageType],
+        help="Prefer the labels in this store over the archived ones",
+    )
+    parser.add_argument(
+        "--test-fraction",
+        type=float,
+        default=0.2,
+        help="Newest share of the reviews held out for the evaluation",
+    )
+    parser.add_argument("--epochs", type=int, default=5)
+    parser.add_argument("--n-features", type=int, default=CLASSIFIER_N_FEATURES)
+    parser.add_argument(
+        "--out",
+        type=str,
+        help="Train again on all the labelled reviews and save the classifier here, "
+        f"main uses {LOCAL_CLASSIFIER_PATH} by default",
+    )
+    args = parser.parse_args()
+
+    store = None
+    match args.storage:
+        case StorageType.FIRESTORE.value:
+            store = FirestoreStore(firebase.get_firestore_client())
+        case StorageType.SQLITE.value:
+            store = SqliteStore(SQLITE_STORE_PATH)
+
+    app_ids = args.app_ids or [app.app_id for app in STEAM_APPS]
+    try:
+        labelled = await load_labelled_reviews(
+            ReviewArchive(args.archive), store, args.days, app_ids
+        )
+    finally:
+        if store is not None:
+            await store.close()
+
+    if len(labelled) == 0:
+        log.error("no labelled reviews in the archive")
+        return
+
+    labelled.sort(key=lambda x: x[0].timestamp_created)
+    n_train = int(len(labelled) * (1 - args.test_fraction))
+    train, test = labelled[:n_train], labelled[n_train:]
+
+    start = time.perf_counter()
+    classifier = LinearClassifier(args.n_features)
+    classifier.fit(
+        [r.review for r, _ in train], [label for _, label in train], args.epochs
+    )
+    log.info(f"trained on {len(train)} reviews in {time.perf_counter() - start:.1f}s")
+    if len(test) > 0:
+        evaluate(classifier, test)
+
+    if args.out is not None:
+        classifier = LinearClassifier(args.n_features)
+        classifier.fit(
+            [r.review for r, _ in labelled],
+            [label for _, label in labelled],
+            args.epochs,
+        )
+        classifier.save(args.out)
+        log.info(f"saved classifier {classifier.version} to {args.out}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,91 @@
+import argparse
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from dotenv import load_dotenv
+
+import firebase
+from config import STEAM_APPS, STEAM_REQUEST_PER_SECOND
+from defined_types import CheatingSentiment, PrefilterRecall, SteamReview
+from llm.client import AsyncLimiter, ReviewPrefilter, is_prefilter_label
+from log import log
+from steam_product import (
+    create_steam_http_client,
+    fetch_steam_reviews,
+    steam_review_base_url,
+)
+
+load_dotenv()
+
+# Firestore only keeps the label, so the review texts are fetched from Steam again
+# and joined with the stored labels on recommendation id. Labels the prefilter
+# gave itself are left out, they would count as caught by it.
+
+
+async def fetch_labelled_reviews(
+    db: firebase.AsyncClient, days: int
+) -> list[tuple[SteamReview, CheatingSentiment]]:
+    from_dt = datetime.now(timezone.utc) - timedelta(days=days)
+    limiter = AsyncLimiter(
+        max_concurrency=None, max_requests_per_second=STEAM_REQUEST_PER_SECOND
+    )
+
+    labelled = []
+    async with create_steam_http_client() as http_client:
+        for app in STEAM_APPS:
+            reviews = await fetch_steam_reviews(
+                app, steam_review_base_url, from_dt, limiter, http_client
+            )
+            labels = await firebase.get_review_labels(
+                db, app.app_id, [r.recommendation_id for r in reviews]
+            )
+            for review in reviews:
+                label = labels.get(review.recommendation_id)
+                if (
+                    label is not None
+                    and label.sentiment is not None
+                    and not is_prefilter_label(label.model)
+                ):
+                    labelled.append((review, label.sentiment))
+
+    return labelled
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Compares the keyword prefilter against the LLM labels stored "
+        "in Firestore"
+    )
+    parser.add_argument("--days", type=int, default=7)
+    args = parser.parse_args()
+
+    db = firebase.get_firestore_client()
+    labelled = await fetch_labelled_reviews(db, args.days)
+    mentioned = [
+        review
+        for review, sentiment in labelled
+        if sentiment != CheatingSentiment.NOT_MENTIONED
+    ]
+    log.info(
+        f"{len(labelled)} labelled reviews, {len(mentioned)} mention cheating "
+        "according to the LLM"
+    )
+    if len(mentioned) == 0:
+        return
+
+    print(f"{'recall':<8}{'caught':>10}{'recall %':>10}{'skipped %':>11}")
+    for recall in PrefilterRecall:
+        prefilter = ReviewPrefilter(recall)
+        caught = sum(prefilter.may_mention_cheating(r.review) for r in mentioned)
+        prefilter = ReviewPrefilter(recall)
+        for review, _ in labelled:
+            prefilter.may_mention_cheating(review.review)
+
+        print(
+            f"{recall.value:<8}{caught:>10}{caught / len(mentioned):>10.1%}"
+            f"{prefilter.n_skipped / prefilter.n_checked:>11.1%}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,16 +1,33 @@
-from collections import defaultdict
-import math
+import asyncio
 from steam_product import SteamProduct
 from datetime import datetime, timezone, date, time
+from time import perf_counter
 import firebase_admin.firestore_async
-from config import FIREBASE_JSON
+import google.api_core.exceptions
+from config import FIREBASE_JSON, FIRESTORE_MAX_CONCURRENT_COMMITS
 from log import log
+from metrics import metrics
 from firebase_admin import credentials, initialize_app
+from google.cloud.firestore_v1.async_batch import AsyncWriteBatch
 from google.cloud.firestore_v1.async_client import AsyncClient
+from google.cloud.firestore_v1.async_document import AsyncDocumentReference
 from google.cloud.firestore_v1.query import Query
-from llm.client import ReviewWithSentiment
-from defined_types import CheatingSentiment
+from llm.client import (
+    DEFAULT_RETRY_POLICY,
+    AsyncLimiter,
+    RetryPolicy,
+    run_with_retry,
+)
+from defined_types import (
+    CheatingSentiment,
+    IngestState,
+    ReviewBatch,
+    SteamCheckpoint,
+    StoredLabel,
+)
+from storage.store import summary_deltas
 from google.cloud.firestore_v1.base_query import FieldFilter, And
+from google.cloud.firestore_v1.transforms import Increment
 
 
 def get_firestore_client() -> AsyncClient:
@@ -32,7 +49,6 @@ async def get_last_review_ts(db: AsyncClient, app_id: int) -> datetime | None:
         .select(["timestamp_created"])
         .get()
     )
-    log.info(last_review)
     last_timestamp_created = (
         last_review[0].get("timestamp_created").replace(tzinfo=timezone.utc)
     )
@@ -42,6 +58,96 @@ async def get_last_review_ts(db: AsyncClient, app_id: int) -> datetime | None:
     return last_timestamp_created
 
 
+def ingest_state_ref(db: AsyncClient, app_id: int) -> AsyncDocumentReference:
+    return db.document(f"ingest_state/{app_id}")
+
+
+async def get_ingest_states(
+    db: AsyncClient, steam_products: list[SteamProduct]
+) -> dict[int, IngestState]:
+    # One round trip for every app, apps without a state doc yet are looked up the
+    # slow way once and get a state doc with their first insert
+    refs = [ingest_state_ref(db, p.app_id) for p in steam_products]
+    states = {}
+    async for doc in db.get_all(refs):
+        if doc.exists:
+            states[int(doc.id)] = IngestState.model_validate(doc.to_dict())
+
+    for steam_product in steam_products:
+        if steam_product.app_id not in states:
+            log.info(f"no ingest state for app_id {steam_product.app_id}")
+            states[steam_product.app_id] = IngestState(
+                app_id=steam_product.app_id,
+                last_review_ts=await get_last_review_ts(db, steam_product.app_id),
+                product_known=await steam_product_exists(db, steam_product.app_id),
+            )
+
+    return states
+
+
+async def set_ingest_state(db: AsyncClient, ingest_state: IngestState):
+    await ingest_state_ref(db, ingest_state.app_id).set(ingest_state.to_dict())
+
+
+async def set_checkpoint(db: AsyncClient, app_id: int, checkpoint: SteamCheckpoint):
+    await ingest_state_ref(db, app_id).set(
+        {"app_id": app_id, "checkpoint": checkpoint.to_dict()}, merge=True
+    )
+
+
+async def set_pending_review_ts(
+    db: AsyncClient, app_id: int, pending_review_ts: datetime
+):
+    # Merged so the stored watermark stays where it was until the reviews are written
+    await ingest_state_ref(db, app_id).set(
+        {"app_id": app_id, "pending_review_ts": pending_review_ts}, merge=True
+    )
+
+
+async def get_review_sentiments(
+    db: AsyncClient, app_id: int, review_ids: list[int]
+) -> dict[int, CheatingSentiment | None]:
+    sentiments = {}
+    batch_size = 500
+    for start_idx in range(0, len(review_ids), batch_size):
+        refs = [
+            db.document(f"apps/{app_id}/reviews/{review_id}")
+            for review_id in review_ids[start_idx : start_idx + batch_size]
+        ]
+        async for doc in db.get_all(refs, field_paths=["sentiment"]):
+            if doc.exists:
+                sentiments[int(doc.id)] = CheatingSentiment.from_str(
+                    doc.get("sentiment")
+                )
+
+    return sentiments
+
+
+async def get_review_labels(
+    db: AsyncClient, app_id: int, review_ids: list[int]
+) -> dict[int, StoredLabel]:
+    labels = {}
+    batch_size = 500
+    for start_idx in range(0, len(review_ids), batch_size):
+        refs = [
+            db.document(f"apps/{app_id}/reviews/{review_id}")
+            for review_id in review_ids[start_idx : start_idx + batch_size]
+        ]
+        async for doc in db.get_all(
+            refs, field_paths=["sentiment", "model", "prompt_version"]
+        ):
+            if doc.exists:
+                # Reviews stored before the labels were tracked have no model
+                fields = doc.to_dict()
+                labels[int(doc.id)] = StoredLabel(
+                    sentiment=CheatingSentiment.from_str(fields.get("sentiment")),
+                    model=fields.get("model"),
+                    prompt_version=fields.get("prompt_version"),
+                )
+
+    return labels
+
+
 async def steam_product_exists(db: AsyncClient, app_id: int) -> bool:
     ref = db.document(f"apps/{app_id}")
     doc = await ref.get()
@@ -59,30 +165,60 @@ async def ensure_steam_product(db: AsyncClient, steam_product: SteamProduct):
         await insert_steam_product(db, steam_product)
 
 
-async def summarize_reviews(
-    db: AsyncClient, steam_product: SteamProduct, dts: set[date]
-):
-
-    reviews_reference = db.collection(f"apps/{steam_product.app_id}/reviews")
-
-    for dt in dts:
-        start_of_day = datetime.combine(dt, time.min)
-        end_of_day = datetime.combine(dt, time.max)
+async def count_reviews(
+    db: AsyncClient, app_id: int, dt: date, sentiment: CheatingSentiment
+) -> int:
+    start_of_day = datetime.combine(dt, time.min)
+    end_of_day = datetime.combine(dt, time.max)
 
-        dt_filter = And(
+    query = db.collection(f"apps/{app_id}/reviews").where(
+        filter=And(
             [
                 FieldFilter("timestamp_created", ">=", start_of_day),
                 FieldFilter("timestamp_created", "<=", end_of_day),
+                FieldFilter("sentiment", "==", sentiment.value),
             ]
         )
+    )
+    # Counted by the server, billed as one read per 1000 matching reviews instead of
+    # one per review
+    results = await query.count().get()
+    return int(results[0][0].value)
+
+
+async def summarize_day(
+    db: AsyncClient, steam_product: SteamProduct, dt: date, limiter: AsyncLimiter
+):
+    counts = await asyncio.gather(
+        *[
+            limiter.run(count_reviews, db, steam_product.app_id, dt, sentiment)
+            for sentiment in CheatingSentiment
+        ]
+    )
+    sentiments = {sentiment.value: n for sentiment, n in zip(CheatingSentiment, counts)}
+
+    await insert_summarized_reviews(db, steam_product, sentiments, dt)
+
+
+async def summarize_reviews(
+    db: AsyncClient,
+    steam_product: SteamProduct,
+    dts: set[date],
+    limiter: AsyncLimiter | None = None,
+):
+    # Full recompute of the daily summaries, only needed to repair counters since
+    # insert_reviews keeps them up to date
+    if limiter is None:
+        limiter = AsyncLimiter(max_concurrency=None, max_requests_per_second=None)
 
-        reviews = await reviews_reference.where(filter=dt_filter).get()
-        sentiments = {sentiment.value: 0 for sentiment in CheatingSentiment}
-        for review in reviews:
-            sentiment = review.get("sentiment")
-            sentiments[sentiment] += 1
+    await asyncio.gather(*[summarize_day(db, steam_product, dt, limiter) for dt in dts])
 
-        await insert_summarized_reviews(db, steam_product, sentiments, dt)
+
+async def get_summarized_reviews(
+    db: AsyncClient, app_id: int, dt: date
+) -> dict[str, int] | None:
+    doc = await db.document(f"apps/{app_id}/summarized_reviews/{dt.isoformat()}").get()
+    return doc.to_dict() if doc.exists else None
 
 
 async def insert_summarized_reviews(
@@ -101,33 +237,138 @@ async def insert_summarized_reviews(
 
 async def insert_reviews(
     db: AsyncClient,
-    steam_product: SteamProduct,
-    reviews_with_sentiment: list[ReviewWithSentiment],
+    review_batch: ReviewBatch,
+    known_new_after: datetime | None = None,
+    limiter: AsyncLimiter | None = None,
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+    ingest_state: IngestState | None = None,
 ):
-    await ensure_steam_product(db, steam_product)
+    # Inserts the reviews and increments the daily summaries in the same batch.
+    # Reviews created after known_new_after can't be stored yet, everything else is
+    # looked up first so that re-inserting a review doesn't count it twice. Batches
+    # are committed concurrently, at most as many as the limiter allows
+    if limiter is None:
+        limiter = AsyncLimiter(
+            max_concurrency=FIRESTORE_MAX_CONCURRENT_COMMITS,
+            max_requests_per_second=None,
+        )
 
-    if len(reviews_with_sentiment) == 0:
+    app_id = review_batch.steam_product.app_id
+    review_batch = review_batch.classified()
+    if len(review_batch) == 0:
         log.info("no reviews to insert, early out")
+        if ingest_state is not None:
+            await set_ingest_state(db, ingest_state)
         return
 
-    batch_size = 500
-    n_batches = math.floor(len(reviews_with_sentiment) / batch_size) + 1
-    log.info(f"{n_batches} to insert")
-    for b in range(n_batches):
-        batch = db.batch()
-        start_idx = b * batch_size
-        end_idx = min((b + 1) * batch_size, len(reviews_with_sentiment))
-
-        log.info(f"creating batch: {b}, start_idx: {start_idx}, end_idx: {end_idx}")
-
-        current_reviews = reviews_with_sentiment[start_idx:end_idx]
-        for r in current_reviews:
-            if r.cheating_sentiment is None:
-                continue
-
-            ref = db.document(
-                f"apps/{steam_product.app_id}/reviews/{r.steam_review.recommendation_id}"
+    maybe_stored = [
+        review_id
+        for i, review_id in enumerate(review_batch.recommendation_ids)
+        if known_new_after is None
+        or review_batch.timestamp_created(i) <= known_new_after
+    ]
+    stored_sentiments = await get_review_sentiments(db, app_id, maybe_stored)
+
+    # A batch takes at most 500 writes, one per review plus one per summary day and
+    # one for the ingest state
+    max_writes = 500 - 1
+    bounds = [0]
+    batch_dates: set[date] = set()
+    for i in range(len(review_batch)):
+        dt = review_batch.timestamp_created(i).date()
+        n_writes = i - bounds[-1] + len(batch_dates | {dt}) + 1
+        if n_writes > max_writes:
+            bounds.append(i)
+            batch_dates = set()
+        batch_dates.add(dt)
+    bounds.append(len(review_batch))
+
+    log.info(f"{len(bounds) - 1} batches to insert")
+    write_batches = [
+        create_write_batch(db, review_batch[start:end], stored_sentiments)
+        for start, end in zip(bounds, bounds[1:])
+    ]
+    start = perf_counter()
+    if ingest_state is None:
+        async with asyncio.TaskGroup() as tg:
+            for b, batch in enumerate(write_batches):
+                tg.create_task(commit_batch(batch, b, limiter, retry_policy))
+    else:
+        if len(write_batches) > 1:
+            # The batches don't commit together, if the run dies in between the next
+            # one has to look these reviews up before counting them
+            await set_pending_review_ts(
+                db, ingest_state.app_id, review_batch.newest_timestamp_created()
             )
-            batch.set(ref, r.to_firestore_review().to_dict())
-        log.info("commiting batch")
-        await batch.commit()
+        async with asyncio.TaskGroup() as tg:
+            for b, batch in enumerate(write_batches[:-1]):
+                tg.create_task(commit_batch(batch, b, limiter, retry_policy))
+        # The state goes in the last batch, committed once the others are, so it
+        # never points past reviews that failed to be written
+        write_batches[-1].set(
+            ingest_state_ref(db, ingest_state.app_id), ingest_state.to_dict()
+        )
+        await commit_batch(
+            write_batches[-1], len(write_batches) - 1, limiter, retry_policy
+        )
+
+    metrics.inc("firestore_reviews_written", len(review_batch))
+    log.info(
+        f"inserted {len(review_batch)} reviews for app_id {app_id} in "
+        f"{len(write_batches)} batches in {perf_counter() - start:.2f}s"
+    )
+
+
+def create_write_batch(
+    db: AsyncClient,
+    review_batch: ReviewBatch,
+    stored_sentiments: dict[int, CheatingSentiment | None],
+) -> AsyncWriteBatch:
+    app_id = review_batch.steam_product.app_id
+    batch = db.batch()
+    for i, review_id in enumerate(review_batch.recommendation_ids):
+        ref = db.document(f"apps/{app_id}/reviews/{review_id}")
+        batch.set(ref, review_batch.to_firestore_review(i).to_dict())
+
+    deltas = summary_deltas(review_batch, stored_sentiments)
+    for dt, delta in deltas.items():
+        ref = db.document(f"apps/{app_id}/summarized_reviews/{dt.isoformat()}")
+        batch.set(
+            ref,
+            {sentiment: Increment(n) for sentiment, n in delta.items()},
+            merge=True,
+        )
+
+    return batch
+
+
+def is_retryable_commit(e: Exception) -> bool:
+    # Only errors where the commit is known not to have been applied, retrying an
+    # applied batch would count its summary increments twice. ServiceUnavailable
+    # and DeadlineExceeded can arrive after the write went through
+    return isinstance(
+        e,
+        (
+            google.api_core.exceptions.Aborted,
+            google.api_core.exceptions.ResourceExhausted,
+        ),
+    )
+
+
+async def commit_batch(
+    batch: AsyncWriteBatch,
+    b: int,
+    limiter: AsyncLimiter,
+    retry_policy: RetryPolicy,
+):
+    start = perf_counter()
+    await run_with_retry(
+        limiter,
+        retry_policy,
+        batch.commit,
+        retry=None,
+        retryable=is_retryable_commit,
+    )
+    elapsed = perf_counter() - start
+    metrics.observe("firestore_commit_seconds", elapsed)
+    log.info(f"committed batch {b} in {elapsed:.2f}s")
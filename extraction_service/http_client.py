@@ -0,0 +1,28 @@
+from importlib.util import find_spec
+
+import httpx
+
+# httpx only speaks HTTP/2 when the optional h2 package is installed, and only
+# negotiates it with servers that offer it over TLS. Plain-http servers such as
+# llama-server keep using pooled HTTP/1.1 keep-alive connections.
+HTTP2_AVAILABLE = find_spec("h2") is not None
+
+
+def create_http_client(
+    max_connections: int,
+    max_keepalive_connections: int | None = None,
+    timeout: float = 240,
+    transport: httpx.AsyncBaseTransport | None = None,
+) -> httpx.AsyncClient:
+    if max_keepalive_connections is None:
+        max_keepalive_connections = max_connections
+
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+        ),
+        http2=HTTP2_AVAILABLE,
+        timeout=timeout,
+        transport=transport,
+    )
@@ -0,0 +1,160 @@
+import asyncio
+import hashlib
+import re
+import sqlite3
+import time
+
+from defined_types import CheatingSentiment
+
+# Writes are held in memory and committed together once this many are waiting
+CACHE_FLUSH_SIZE = 1000
+# Bound variables per lookup query, well below SQLite's limit
+LOOKUP_CHUNK_SIZE = 900
+
+_non_word = re.compile(r"[^\w\s]+")
+_whitespace = re.compile(r"\s+")
+
+
+def normalize_review_text(text: str) -> str:
+    # Reviews like "Cheaters!!", "cheaters" and " CHEATERS " are the same question
+    # to the model, so they should share a cache entry
+    text = _non_word.sub(" ", text.casefold())
+    return _whitespace.sub(" ", text).strip()
+
+
+class SentimentCache:
+    # Inserts and last_used updates are committed in batches by flush, not one
+    # commit per lookup. A crash loses the unflushed entries, which are only
+    # classified again.
+    def __init__(self, path: str, max_entries: int, flush_size: int = CACHE_FLUSH_SIZE):
+        self.max_entries = max_entries
+        self.flush_size = flush_size
+        self.hits = 0
+        self.misses = 0
+        # Key to sentiment and last use, not in the database yet
+        self.pending: dict[str, tuple[CheatingSentiment, float]] = {}
+        # Key to last use, for entries already in the database
+        self.touched: dict[str, float] = {}
+        # Keys currently being classified, so duplicate reviews within a run wait
+        # for the first one instead of making their own LLM call
+        self.in_flight: dict[str, asyncio.Future[CheatingSentiment | None]] = {}
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS sentiment_cache (
+                key TEXT PRIMARY KEY,
+                sentiment TEXT NOT NULL,
+                last_used REAL NOT NULL
+            )"""
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS sentiment_cache_last_used "
+            "ON sentiment_cache (last_used)"
+        )
+        self.conn.commit()
+
+        (self.n_entries,) = self.conn.execute(
+            "SELECT COUNT(*) FROM sentiment_cache"
+        ).fetchone()
+
+    @staticmethod
+    def make_key(model: str, prompt_version: str, review_text: str) -> str:
+        h = hashlib.sha256()
+        for part in (model, prompt_version, normalize_review_text(review_text)):
+            h.update(part.encode())
+            h.update(b"\x1f")
+        return h.hexdigest()
+
+    def get(self, key: str) -> CheatingSentiment | None:
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: list[str]) -> dict[str, CheatingSentiment]:
+        t = time.time()
+        found = {}
+        stored_keys = []
+        for key in keys:
+            if key in self.pending:
+                found[key] = self.pending[key][0]
+                self.pending[key] = (found[key], t)
+            else:
+                stored_keys.append(key)
+
+        for start in range(0, len(stored_keys), LOOKUP_CHUNK_SIZE):
+            chunk = stored_keys[start : start + LOOKUP_CHUNK_SIZE]
+            rows = self.conn.execute(
+                "SELECT key, sentiment FROM sentiment_cache "
+                f"WHERE key IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            for key, sentiment in rows:
+                found[key] = CheatingSentiment(sentiment)
+                self.touched[key] = t
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        if len(self.touched) >= self.flush_size:
+            self.flush()
+        return found
+
+    def put(self, key: str, sentiment: CheatingSentiment):
+        self.put_many([(key, sentiment)])
+
+    def put_many(self, items: list[tuple[str, CheatingSentiment]]):
+        t = time.time()
+        for key, sentiment in items:
+            self.pending[key] = (sentiment, t)
+        if (
+            len(self.pending) >= self.flush_size
+            or self.n_entries + len(self.pending) > self.max_entries
+        ):
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0 and len(self.touched) == 0:
+            return
+
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO sentiment_cache (key, sentiment, last_used) "
+                "VALUES (?, ?, ?)",
+                [(key, s.value, t) for key, (s, t) in self.pending.items()],
+            )
+            self.conn.executemany(
+                "UPDATE sentiment_cache SET last_used = ? WHERE key = ?",
+                [(t, key) for key, t in self.touched.items()],
+            )
+        self.n_entries += len(self.pending)
+        self.pending.clear()
+        self.touched.clear()
+        if self.n_entries > self.max_entries:
+            self.evict()
+
+    def evict(self):
+        # Evict down to 90% of the limit so that a full cache doesn't pay for an
+        # eviction on every insert
+        target = int(self.max_entries * 0.9)
+        (self.n_entries,) = self.conn.execute(
+            "SELECT COUNT(*) FROM sentiment_cache"
+        ).fetchone()
+        n_evict = self.n_entries - target
+        if n_evict <= 0:
+            return
+
+        self.conn.execute(
+            "DELETE FROM sentiment_cache WHERE key IN "
+            "(SELECT key FROM sentiment_cache ORDER BY last_used ASC LIMIT ?)",
+            (n_evict,),
+        )
+        self.conn.commit()
+        self.n_entries = target
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0
+
+    def close(self):
+        self.flush()
+        self.conn.close()
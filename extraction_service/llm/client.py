@@ -1,22 +1,130 @@
 from contextlib import nullcontext
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import hashlib
+import json
+import re
 import time
-from typing import Callable
-from defined_types import ReviewWithSentiment
+from typing import AsyncIterator, Awaitable, Callable
+from defined_types import (
+    CheatingSentiment,
+    PrefilterRecall,
+    ReviewWithSentiment,
+    SteamReview,
+    SteamProduct,
+)
+from llm.cache import SentimentCache
+from log import log
+from metrics import metrics
 
 import asyncio
-from steam_product import SteamReview, SteamProduct
+import httpx
 from abc import ABC, abstractmethod
+import random
 from dataclasses import dataclass
 
+SENTIMENT_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "cheating_sentiment",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "cheating_sentiment": {
+                    "type": "string",
+                    "description": "The cheating sentiment in the review, either 'positive', 'negative' or 'not mentioned'",
+                    "enum": [s.value for s in CheatingSentiment],
+                }
+            },
+            "required": ["cheating_sentiment"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+BATCH_SENTIMENT_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "cheating_sentiments",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "sentiments": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "recommendation_id": {"type": "string"},
+                            "cheating_sentiment": {
+                                "type": "string",
+                                "enum": [s.value for s in CheatingSentiment],
+                            },
+                        },
+                        "required": ["recommendation_id", "cheating_sentiment"],
+                        "additionalProperties": False,
+                    },
+                }
+            },
+            "required": ["sentiments"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+# Rough token count used to pack batches, ~4 characters per token for English
+CHARS_PER_TOKEN = 4
+BATCH_MAX_REVIEWS = 20
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+@dataclass
+class LLMUsage:
+    n_requests: int = 0
+    n_reviews: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+    def record(self, resp_json: dict, n_reviews: int):
+        self.n_requests += 1
+        self.n_reviews += n_reviews
+        usage = (resp_json.get("usage") if isinstance(resp_json, dict) else None) or {}
+        self.prompt_tokens += usage.get("prompt_tokens", 0)
+        self.completion_tokens += usage.get("completion_tokens", 0)
+
+    def tokens_per_review(self) -> float:
+        if self.n_reviews == 0:
+            return 0
+        return (self.prompt_tokens + self.completion_tokens) / self.n_reviews
+
+
+# Few-shot examples shared by the single and the batch prompt, so they can't drift
+SENTIMENT_EXAMPLES = """Example of a positve review: "Game is absolutely amazing. \nAnyone in these reviews saying they were wrongly banned and weren't actually cheating were actually cheating.\nIf you cheat, you get banned. GTFO."
+        Example of a negative review: "1k horus played. goodbye arc nice knowing ya. cheaters have ruined your game."
+        Example of a review that doesn't mentioned cheating: "If you shoot someone after saying don't shoot. Ur a piece of shit\""""
+
 
 @dataclass
 class LLMClient(ABC):
-    base_prompt = """Does this review of a game contains positive or negative sentiments of cheating, or is cheating not mentioned at all? 
+    usage: LLMUsage
+
+    # Most reviews packed into one cheating_ref_in_reviews call
+    max_batch_reviews = BATCH_MAX_REVIEWS
+
+    base_prompt = f"""Does this review of a game contains positive or negative sentiments of cheating, or is cheating not mentioned at all? 
         If the sentiment is positive reply with "positive", if it is negative reply with "negative", if it's not metioned at all reply with "not mentioned".
-        Example of a positve review: "Game is absolutely amazing. \nAnyone in these reviews saying they were wrongly banned and weren't actually cheating were actually cheating.\nIf you cheat, you get banned. GTFO."
-        Example of a negative review: "1k horus played. goodbye arc nice knowing ya. cheaters have ruined your game."
-        Example of a review that doesn't mentioned cheating: "If you shoot someone after saying don't shoot. Ur a piece of shit"
-        REVIEW: {review}."""
+        {SENTIMENT_EXAMPLES}
+        REVIEW: {{review}}."""
+
+    batch_prompt = f"""For each of the following reviews of a game, does the review contain positive or negative sentiments of cheating, or is cheating not mentioned at all?
+        If the sentiment is positive answer "positive", if it is negative answer "negative", if it's not metioned at all answer "not mentioned".
+        {SENTIMENT_EXAMPLES}
+        Answer once for every review, using its recommendation_id.
+        REVIEWS: {{reviews}}"""
 
     @abstractmethod
     async def cheating_ref_in_review(
@@ -24,23 +132,94 @@ class LLMClient(ABC):
     ) -> ReviewWithSentiment:
         pass
 
+    @abstractmethod
+    async def complete_chat(self, prompt: str, response_format: dict) -> httpx.Response:
+        pass
+
     @abstractmethod
     def get_model(self) -> str:
         pass
 
+    def get_models(self) -> set[str]:
+        # Every model a label from this client may be tagged with
+        return {self.get_model()}
+
     @abstractmethod
-    def close(self):
+    async def close(self):
         pass
 
+    async def check_health(self) -> bool:
+        # Backends without a health endpoint are only judged by their failures
+        return True
+
+    def get_prompt_version(self) -> str:
+        # Changes whenever one of the prompts is edited, stored next to every label
+        h = hashlib.sha256()
+        for prompt in (self.base_prompt, self.batch_prompt):
+            h.update(prompt.encode())
+            h.update(b"\x1f")
+        return h.hexdigest()[:12]
+
     # @staticmethod
     def generate_prompt(self, review: SteamReview) -> str:
         return self.base_prompt.format(review=review.review)
 
+    def generate_batch_prompt(self, reviews: list[SteamReview]) -> str:
+        return self.batch_prompt.format(
+            reviews=json.dumps(
+                [
+                    {"recommendation_id": str(r.recommendation_id), "review": r.review}
+                    for r in reviews
+                ],
+                ensure_ascii=False,
+            )
+        )
+
+    async def cheating_ref_in_reviews(
+        self, reviews: list[SteamReview], steam_product: SteamProduct
+    ) -> list[ReviewWithSentiment]:
+        # Reviews missing from the answer, or with an unparsable sentiment, come
+        # back with cheating_sentiment=None so the caller can retry them one by one
+        sentiments: dict[str, CheatingSentiment | None] = {}
+
+        resp = await self.complete_chat(
+            self.generate_batch_prompt(reviews), BATCH_SENTIMENT_RESPONSE_FORMAT
+        )
+        if resp.is_error:
+            log.warning(
+                f"failed to extract sentiment for a batch of {len(reviews)} reviews got error code: {resp.status_code} - {resp.reason_phrase}"
+            )
+        else:
+            resp_json = resp.json()
+            self.usage.record(resp_json, len(reviews))
+            try:
+                content = json.loads(resp_json["choices"][0]["message"]["content"])
+                for item in content["sentiments"]:
+                    sentiments[str(item["recommendation_id"])] = (
+                        CheatingSentiment.from_str(item.get("cheating_sentiment"))
+                    )
+            except (KeyError, TypeError, AttributeError, json.JSONDecodeError) as e:
+                log.error(f"failed to parse batch response: {e!r}")
+
+        return [
+            ReviewWithSentiment(
+                steam_product=steam_product,
+                steam_review=r,
+                cheating_sentiment=sentiments.get(str(r.recommendation_id)),
+            )
+            for r in reviews
+        ]
+
 
 class AsyncLimiter:
     def __init__(
-        self, max_concurrency: int | None, max_requests_per_second: int | None
+        self,
+        max_concurrency: int | None,
+        max_requests_per_second: int | None,
+        name: str | None = None,
     ):
+        # Named limiters report how long calls waited for them
+        self.name = name
         self.max_concurrency = max_concurrency
         self.max_requests_per_seconds = max_requests_per_second
         self.rate_limit_delay = None
@@ -57,7 +236,14 @@ class AsyncLimiter:
             else nullcontext()
         )
 
+    def observe_wait(self, start: float):
+        if self.name is not None:
+            metrics.observe(
+                "limiter_wait_seconds", time.perf_counter() - start, limiter=self.name
+            )
+
     async def run(self, func: Callable, *args, **kwargs):
+        start = time.perf_counter()
         async with self.semaphore_cm:
             if self.rate_limit_delay is not None:
                 t = time.perf_counter()
@@ -68,24 +254,661 @@ class AsyncLimiter:
                 # elapsed_time = time.perf_counter() - self.last_call_time
 
                 # self.last_call_time = time.perf_counter()
+            self.observe_wait(start)
             return await func(*args, **kwargs)
 
 
-async def extract_cheating_sentiment(
+class BackendOverloadedError(Exception):
+    def __init__(self, status_code: int, retry_after: float | None):
+        super().__init__(
+            f"backend overloaded, status code {status_code}, retry after {retry_after}"
+        )
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    # Retry-After is either a number of seconds or an HTTP date
+    if value is None:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def raise_for_overload(resp: httpx.Response):
+    if resp.status_code in (429, 503):
+        raise BackendOverloadedError(
+            resp.status_code, parse_retry_after(resp.headers.get("Retry-After"))
+        )
+
+
+class AdaptiveLimiter(AsyncLimiter):
+    """
+    AIMD limiter, concurrency and request rate grow by roughly one step per window
+    of successful requests and are cut by decrease_factor when the backend reports
+    overload (429/503) or latency rises above latency_tolerance times its running
+    average. max_concurrency and max_requests_per_second are ceilings.
+    Overloaded calls are passed on to the caller, the limiter only backs off and
+    holds every request back until Retry-After passes. Retrying is up to
+    run_with_retry.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        max_requests_per_second: float,
+        initial_concurrency: int | None = None,
+        initial_requests_per_second: float | None = None,
+        min_concurrency: int = 1,
+        min_requests_per_second: float = 0.1,
+        decrease_factor: float = 0.5,
+        latency_tolerance: float = 3,
+        name: str | None = None,
+    ):
+        super().__init__(
+            max_concurrency=max_concurrency,
+            max_requests_per_second=max_requests_per_second,
+            name=name,
+        )
+        self.min_concurrency = min_concurrency
+        self.min_requests_per_second = min_requests_per_second
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+
+        self.concurrency = float(initial_concurrency or max_concurrency)
+        self.requests_per_second = float(
+            initial_requests_per_second or max_requests_per_second
+        )
+
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.latency_average: float | None = None
+        self.n_overloaded = 0
+        self.n_decreases = 0
+
+    async def run(self, func: Callable, *args, **kwargs):
+        wait_start = time.perf_counter()
+        await self.acquire()
+        self.observe_wait(wait_start)
+        start = time.perf_counter()
+        try:
+            result = await func(*args, **kwargs)
+        except BackendOverloadedError as e:
+            self.on_overload(e.retry_after)
+            raise
+        finally:
+            await self.release()
+
+        self.on_success(time.perf_counter() - start)
+        return result
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(
+                lambda: self.in_flight < max(1, int(self.concurrency))
+            )
+            self.in_flight += 1
+
+        while True:
+            t = time.perf_counter()
+            start_at = max(t, self.wait_until, self.paused_until)
+            if start_at <= t:
+                self.wait_until = t + 1 / self.requests_per_second
+                return
+            await asyncio.sleep(start_at - t)
+
+    async def release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self, latency: float):
+        if self.latency_average is None:
+            self.latency_average = latency
+
+        ceiling = self.latency_tolerance * self.latency_average
+        # Slow calls move the average too, capped so a single outlier barely does,
+        # otherwise a lasting shift in latency would be backed off from forever
+        self.latency_average = 0.9 * self.latency_average + 0.1 * min(latency, ceiling)
+        if latency > ceiling:
+            self.decrease()
+            return
+
+        self.concurrency = min(
+            self.max_concurrency, self.concurrency + 1 / self.concurrency
+        )
+        self.requests_per_second = min(
+            self.max_requests_per_seconds,
+            self.requests_per_second + 1 / self.requests_per_second,
+        )
+
+    def on_overload(self, retry_after: float | None):
+        self.n_overloaded += 1
+        if retry_after is not None:
+            self.paused_until = max(
+                self.paused_until, time.perf_counter() + retry_after
+            )
+        self.decrease()
+
+    def decrease(self):
+        # Requests already in flight when the backend starts struggling all report
+        # it, only back off once per average latency
+        t = time.perf_counter()
+        if t - self.last_decrease < (self.latency_average or 0):
+            return
+
+        self.last_decrease = t
+        self.n_decreases += 1
+        self.concurrency = max(
+            self.min_concurrency, self.concurrency * self.decrease_factor
+        )
+        self.requests_per_second = max(
+            self.min_requests_per_second,
+            self.requests_per_second * self.decrease_factor,
+        )
+        log.info(f"backing off, limiter is now {self.metrics()}")
+
+    def metrics(self) -> dict[str, float | int]:
+        return {
+            "concurrency": int(self.concurrency),
+            "requests_per_second": round(self.requests_per_second, 2),
+            "in_flight": self.in_flight,
+            "latency_average": round(self.latency_average or 0, 3),
+            "overloaded": self.n_overloaded,
+            "decreases": self.n_decreases,
+        }
+
+
+@dataclass
+class RetryPolicy:
+    max_attempts: int = 5
+    base_delay: float = 1
+    max_delay: float = 30
+    # Total seconds a single call may spend retrying before it's given up on
+    budget: float = 120
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+# Errors that make a review come back without a sentiment instead of raising. A
+# response that can't be parsed isn't retried, the review goes to the dead letters.
+REQUEST_FAILED_ERRORS = (
+    httpx.HTTPError,
+    BackendOverloadedError,
+    json.JSONDecodeError,
+    KeyError,
+)
+
+
+def is_retryable(e: Exception) -> bool:
+    if isinstance(e, (BackendOverloadedError, httpx.TransportError)):
+        return True
+    if isinstance(e, httpx.HTTPStatusError):
+        status_code = e.response.status_code
+        return status_code >= 500 or status_code in (408, 429)
+    return False
+
+
+async def run_with_retry(
+    limiter: AsyncLimiter,
+    retry_policy: RetryPolicy,
+    func: Callable,
+    *args,
+    retryable: Callable[[Exception], bool] = is_retryable,
+    **kwargs,
+):
+    start = time.perf_counter()
+    attempt = 1
+    while True:
+        try:
+            return await limiter.run(func, *args, **kwargs)
+        except Exception as e:
+            # Full jitter, so requests that failed together don't retry together
+            delay = random.uniform(
+                0, min(retry_policy.max_delay, retry_policy.base_delay * 2**attempt)
+            )
+            if isinstance(e, BackendOverloadedError) and e.retry_after is not None:
+                delay = max(delay, e.retry_after)
+            elapsed = time.perf_counter() - start
+            if (
+                not retryable(e)
+                or attempt >= retry_policy.max_attempts
+                or elapsed + delay > retry_policy.budget
+            ):
+                raise
+
+            log.info(f"attempt {attempt} failed with {e!r}, retrying in {delay:.1f}s")
+            attempt += 1
+            await asyncio.sleep(delay)
+
+
+async def request_sentiment(
+    client: LLMClient,
+    review: SteamReview,
+    steam_product: SteamProduct,
+    limiter: AsyncLimiter,
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+) -> ReviewWithSentiment:
+    # A review that still fails after retrying comes back without a sentiment
+    # instead of raising, so it doesn't take the rest of the gather with it
+    try:
+        return await run_with_retry(
+            limiter, retry_policy, client.cheating_ref_in_review, review, steam_product
+        )
+    except REQUEST_FAILED_ERRORS as e:
+        log.warning(
+            f"giving up on review {review.recommendation_id} after retrying: {e!r}"
+        )
+        return ReviewWithSentiment(
+            steam_product=steam_product,
+            steam_review=review,
+            cheating_sentiment=None,
+        )
+
+
+# Patterns are matched at the start of a word, so "cheat" also covers "cheaters",
+# "cheating" etc. Each recall level includes the terms of the levels below it.
+PREFILTER_TERMS = {
+    PrefilterRecall.LOW: [
+        r"cheat",
+        r"hack",
+        r"aim ?bot",
+        r"wall ?hack",
+        r"anti[- ]?cheat",
+        r"trigger ?bot",
+        r"spin ?bot",
+        r"esp\b",
+        r"vac\b",
+    ],
+    PrefilterRecall.MEDIUM: [
+        r"ban",
+        r"exploit",
+        r"script",
+        r"macro",
+        r"mod menu",
+        r"kernel",
+        r"rage ?(?:hack|bot)",
+        r"closet",
+        r"blatant",
+        r"sus\b",
+    ],
+    PrefilterRecall.HIGH: [
+        r"report",
+        r"suspicious",
+        r"unfair",
+        r"smurf",
+        r"glitch",
+        r"modder",
+        r"no ?recoil",
+        r"speed ?hack",
+        r"fly ?hack",
+        r"ddos",
+        r"lag ?switch",
+        r"trust ?factor",
+    ],
+}
+
+
+# Labels the prefilter gave instead of an LLM have a model starting with this
+PREFILTER_MODEL_PREFIX = "prefilter-"
+
+
+def is_prefilter_label(model: str | None) -> bool:
+    return model is not None and model.startswith(PREFILTER_MODEL_PREFIX)
+
+
+class ReviewPrefilter:
+    def __init__(self, recall: PrefilterRecall):
+        self.recall = recall
+        self.model = f"{PREFILTER_MODEL_PREFIX}{recall.value}"
+
+        levels = list(PrefilterRecall)
+        terms = [
+            term
+            for level in levels[: levels.index(recall) + 1]
+            for term in PREFILTER_TERMS[level]
+        ]
+        self.pattern = re.compile(r"\b(?:" + "|".join(terms) + ")", re.IGNORECASE)
+
+        self.n_checked = 0
+        self.n_skipped = 0
+
+    def may_mention_cheating(self, text: str) -> bool:
+        self.n_checked += 1
+        if self.pattern.search(text) is not None:
+            return True
+
+        self.n_skipped += 1
+        return False
+
+
+async def classify_review(
+    client: LLMClient,
+    review: SteamReview,
+    steam_product: SteamProduct,
+    limiter: AsyncLimiter,
+    cache: SentimentCache | None = None,
+    prefilter: ReviewPrefilter | None = None,
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+) -> ReviewWithSentiment:
+    if prefilter is not None and not prefilter.may_mention_cheating(review.review):
+        return ReviewWithSentiment(
+            steam_product=steam_product,
+            steam_review=review,
+            cheating_sentiment=CheatingSentiment.NOT_MENTIONED,
+            model=prefilter.model,
+        )
+
+    if cache is None:
+        return await request_sentiment(
+            client, review, steam_product, limiter, retry_policy
+        )
+
+    key = cache.make_key(client.get_model(), client.get_prompt_version(), review.review)
+
+    if key in cache.in_flight:
+        sentiment = await cache.in_flight[key]
+        if sentiment is not None:
+            cache.hits += 1
+    else:
+        sentiment = cache.get(key)
+
+    if sentiment is not None:
+        return ReviewWithSentiment(
+            steam_product=steam_product,
+            steam_review=review,
+            cheating_sentiment=sentiment,
+        )
+
+    in_flight = asyncio.get_running_loop().create_future()
+    cache.in_flight.setdefault(key, in_flight)
+    sentiment = None
+    try:
+        result = await request_sentiment(
+            client, review, steam_product, limiter, retry_policy
+        )
+        sentiment = result.cheating_sentiment
+        if sentiment is not None:
+            cache.put(key, sentiment)
+        return result
+    finally:
+        if cache.in_flight.get(key) is in_flight:
+            del cache.in_flight[key]
+        in_flight.set_result(sentiment)
+
+
+def pack_batches(
+    reviews: list[SteamReview], token_budget: int, max_reviews: int = BATCH_MAX_REVIEWS
+) -> list[list[SteamReview]]:
+    batches: list[list[SteamReview]] = []
+    batch: list[SteamReview] = []
+    batch_tokens = 0
+    for review in reviews:
+        tokens = estimate_tokens(review.review)
+        if len(batch) > 0 and (
+            batch_tokens + tokens > token_budget or len(batch) >= max_reviews
+        ):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+
+        batch.append(review)
+        batch_tokens += tokens
+
+    if len(batch) > 0:
+        batches.append(batch)
+
+    return batches
+
+
+async def classify_batch(
+    client: LLMClient,
+    reviews: list[SteamReview],
+    steam_product: SteamProduct,
+    limiter: AsyncLimiter,
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+) -> list[ReviewWithSentiment]:
+    if len(reviews) == 1:
+        return [
+            await request_sentiment(
+                client, reviews[0], steam_product, limiter, retry_policy
+            )
+        ]
+
+    try:
+        results = await run_with_retry(
+            limiter,
+            retry_policy,
+            client.cheating_ref_in_reviews,
+            reviews,
+            steam_product,
+        )
+    except REQUEST_FAILED_ERRORS as e:
+        log.warning(f"batch of {len(reviews)} reviews failed after retrying: {e!r}")
+        results = [
+            ReviewWithSentiment(
+                steam_product=steam_product, steam_review=r, cheating_sentiment=None
+            )
+            for r in reviews
+        ]
+
+    failed = [i for i, r in enumerate(results) if r.cheating_sentiment is None]
+    if len(failed) > 0:
+        log.info(
+            f"falling back to single review calls for {len(failed)} of {len(reviews)} reviews"
+        )
+        retried = await asyncio.gather(
+            *[
+                request_sentiment(
+                    client, reviews[i], steam_product, limiter, retry_policy
+                )
+                for i in failed
+            ]
+        )
+        for i, result in zip(failed, retried):
+            results[i] = result
+
+    return results
+
+
+async def classify_reviews(
     client: LLMClient,
     reviews: list[SteamReview],
     steam_product: SteamProduct,
-    max_concurrent: int,
-    max_request_per_seconds: int,
+    limiter: AsyncLimiter,
+    cache: SentimentCache | None = None,
+    prefilter: ReviewPrefilter | None = None,
+    batch_token_budget: int | None = None,
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
 ) -> list[ReviewWithSentiment]:
+    if batch_token_budget is None:
+        return list(
+            await asyncio.gather(
+                *[
+                    classify_review(
+                        client,
+                        r,
+                        steam_product,
+                        limiter,
+                        cache,
+                        prefilter,
+                        retry_policy,
+                    )
+                    for r in reviews
+                ]
+            )
+        )
+
+    model = client.get_model()
+    prompt_version = client.get_prompt_version()
+    results: list[ReviewWithSentiment | None] = [None] * len(reviews)
+    # Reviews that need the LLM, grouped by cache key so duplicates are only sent once
+    pending: dict[str, list[int]] = {}
+    for i, review in enumerate(reviews):
+        if prefilter is not None and not prefilter.may_mention_cheating(review.review):
+            results[i] = ReviewWithSentiment(
+                steam_product=steam_product,
+                steam_review=review,
+                cheating_sentiment=CheatingSentiment.NOT_MENTIONED,
+                model=prefilter.model,
+            )
+            continue
+
+        if cache is None:
+            pending[str(i)] = [i]
+            continue
+
+        key = cache.make_key(model, prompt_version, review.review)
+        if key in pending:
+            cache.hits += 1
+            pending[key].append(i)
+        else:
+            pending[key] = [i]
+
+    if cache is not None:
+        # One query per chunk of keys rather than one per review
+        for key, sentiment in cache.get_many(list(pending)).items():
+            for i in pending.pop(key):
+                results[i] = ReviewWithSentiment(
+                    steam_product=steam_product,
+                    steam_review=reviews[i],
+                    cheating_sentiment=sentiment,
+                )
 
-    limiter = AsyncLimiter(
-        max_concurrency=max_concurrent, max_requests_per_second=max_request_per_seconds
+    batches = pack_batches(
+        [reviews[idxs[0]] for idxs in pending.values()],
+        batch_token_budget,
+        client.max_batch_reviews,
     )
+    batch_results = await asyncio.gather(
+        *[
+            classify_batch(client, b, steam_product, limiter, retry_policy)
+            for b in batches
+        ]
+    )
+    classified = [r for batch in batch_results for r in batch]
 
-    tasks = [
-        limiter.run(client.cheating_ref_in_review, r, steam_product) for r in reviews
-    ]
-    results = await asyncio.gather(*tasks)
+    if cache is not None:
+        cache.put_many(
+            [
+                (key, result.cheating_sentiment)
+                for key, result in zip(pending, classified)
+                if result.cheating_sentiment is not None
+            ]
+        )
+    for idxs, result in zip(pending.values(), classified):
+        results[idxs[0]] = result
+        for i in idxs[1:]:
+            results[i] = ReviewWithSentiment(
+                steam_product=steam_product,
+                steam_review=reviews[i],
+                cheating_sentiment=result.cheating_sentiment,
+            )
 
     return results
+
+
+async def extract_cheating_sentiment(
+    client: LLMClient,
+    reviews: list[SteamReview],
+    steam_product: SteamProduct,
+    limiter: AsyncLimiter,
+    cache: SentimentCache | None = None,
+    prefilter: ReviewPrefilter | None = None,
+    batch_token_budget: int | None = None,
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+) -> list[ReviewWithSentiment]:
+
+    return await classify_reviews(
+        client,
+        reviews,
+        steam_product,
+        limiter,
+        cache,
+        prefilter,
+        batch_token_budget,
+        retry_policy,
+    )
+
+
+async def stream_cheating_sentiment(
+    client: LLMClient,
+    pages: AsyncIterator[list[SteamReview]],
+    steam_product: SteamProduct,
+    limiter: AsyncLimiter,
+    on_chunk: Callable[[list[ReviewWithSentiment]], Awaitable[None]],
+    n_workers: int,
+    queue_size: int,
+    chunk_size: int,
+    cache: SentimentCache | None = None,
+    prefilter: ReviewPrefilter | None = None,
+    batch_token_budget: int | None = None,
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+) -> int:
+    # Pages are consumed as they arrive and fed through a bounded queue, so at most
+    # queue_size + chunk_size reviews are held in memory and classification starts
+    # while Steam is still being paged.
+    queue: asyncio.Queue[SteamReview | None] = asyncio.Queue(maxsize=queue_size)
+    chunk: list[ReviewWithSentiment] = []
+    n_classified = 0
+    max_reviews_per_call = 1 if batch_token_budget is None else client.max_batch_reviews
+
+    async def produce():
+        async for page in pages:
+            for review in page:
+                await queue.put(review)
+
+        for _ in range(n_workers):
+            await queue.put(None)
+
+    async def work():
+        nonlocal chunk, n_classified
+        done = False
+        while not done:
+            review = await queue.get()
+            if review is None:
+                return
+
+            reviews = [review]
+            while len(reviews) < max_reviews_per_call and not queue.empty():
+                review = queue.get_nowait()
+                if review is None:
+                    done = True
+                    break
+                reviews.append(review)
+
+            results = await classify_reviews(
+                client,
+                reviews,
+                steam_product,
+                limiter,
+                cache,
+                prefilter,
+                batch_token_budget,
+                retry_policy,
+            )
+            chunk.extend(results)
+            n_classified += len(results)
+
+            if len(chunk) >= chunk_size:
+                full_chunk, chunk = chunk, []
+                await on_chunk(full_chunk)
+
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(produce())
+        for _ in range(n_workers):
+            tg.create_task(work())
+
+    if len(chunk) > 0:
+        await on_chunk(chunk)
+
+    return n_classified
@@ -0,0 +1,321 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import math
+import random
+import re
+import zlib
+from array import array
+
+import httpx
+import pyarrow as pa
+import pyarrow.compute as pc
+from defined_types import (
+    CheatingSentiment,
+    ReviewWithSentiment,
+    SteamProduct,
+    SteamReview,
+)
+from log import log
+from .client import (
+    AsyncLimiter,
+    LLMClient,
+    LLMUsage,
+    classify_reviews,
+    is_prefilter_label,
+)
+
+CLASSIFIER_N_FEATURES = 2**18
+# Reviews scored per call, the pipeline packs this many into one batch
+CLASSIFIER_BATCH_SIZE = 4096
+# Reviews the classifier is less sure about go to the escalation backend
+CLASSIFIER_CONFIDENCE_THRESHOLD = 0.9
+CLASSIFIER_MAX_CONCURRENT = 4
+CLASSIFIER_MAX_REQUESTS_PER_SECOND = 1000
+# Large enough that batches are only bounded by CLASSIFIER_BATCH_SIZE
+CLASSIFIER_BATCH_TOKEN_BUDGET = 100_000_000
+
+# Every label the classifier gives has a model starting with this
+MODEL_PREFIX = "local-classifier-"
+
+CLASSES = list(CheatingSentiment)
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def hash_features(text: str, n_features: int) -> list[int]:
+    # Words and word pairs hashed into n_features buckets, so there is no
+    # vocabulary to keep. crc32 rather than hash(), which changes per process
+    tokens = TOKEN_PATTERN.findall(text.lower())
+    features = {zlib.crc32(t.encode()) % n_features for t in tokens}
+    features.update(
+        zlib.crc32(f"{a} {b}".encode()) % n_features
+        for a, b in itertools.pairwise(tokens)
+    )
+    return list(features)
+
+
+def is_llm_label(model: str | None) -> bool:
+    # The classifier is only trained on labels an LLM gave, not on its own or the
+    # prefilter's. Labels stored before the model was kept can be either
+    return (
+        model is not None
+        and not model.startswith(MODEL_PREFIX)
+        and not is_prefilter_label(model)
+    )
+
+
+class LinearClassifier:
+    """
+    Multinomial logistic regression over hashed word and word pair features,
+    trained with SGD. Small enough to train on a laptop CPU from the archived
+    labels, and a batch is scored with a few pyarrow kernels rather than a Python
+    loop over every feature.
+    """
+
+    def __init__(
+        self,
+        n_features: int = CLASSIFIER_N_FEATURES,
+        weights: array | None = None,
+        bias: list[float] | None = None,
+    ):
+        self.n_features = n_features
+        # One weight per feature and class, feature major
+        self.weights = weights or array("d", bytes(8 * n_features * len(CLASSES)))
+        self.bias = bias or [0.0] * len(CLASSES)
+
+    @property
+    def version(self) -> str:
+        h = hashlib.sha256(self.weights.tobytes())
+        h.update(json.dumps(self.bias).encode())
+        return h.hexdigest()[:12]
+
+    def scores(self, features: list[int]) -> list[float]:
+        w = self.weights
+        s0, s1, s2 = self.bias
+        for f in features:
+            i = 3 * f
+            s0 += w[i]
+            s1 += w[i + 1]
+            s2 += w[i + 2]
+        return [s0, s1, s2]
+
+    @staticmethod
+    def softmax(scores: list[float]) -> list[float]:
+        m = max(scores)
+        exps = [math.exp(s - m) for s in scores]
+        total = sum(exps)
+        return [e / total for e in exps]
+
+    def batch_scores(self, features: list[list[int]]) -> list[pa.Array]:
+        # One score column per class. The weights of every feature in the batch are
+        # gathered with one take per class and summed per review by a group by. The
+        # bias rows give every review a group, even one without features
+        n = len(features)
+        lists = pa.array(features, pa.list_(pa.int64()))
+        indices = pc.multiply(lists.flatten(), len(CLASSES))
+        weights = pa.Array.from_buffers(
+            pa.float64(), len(self.weights), [None, pa.py_buffer(self.weights)]
+        )
+        columns = {
+            "review": pa.concat_arrays(
+                [pa.array(range(n), pa.int64()), pc.list_parent_indices(lists)]
+            )
+        }
+        for c, bias in enumerate(self.bias):
+            columns[str(c)] = pa.concat_arrays(
+                [
+                    pa.array([bias] * n, pa.float64()),
+                    weights.take(pc.add(indices, c)),
+                ]
+            )
+        sums = (
+            pa.table(columns)
+            .group_by("review", use_threads=False)
+            .aggregate([(str(c), "sum") for c in range(len(CLASSES))])
+            .sort_by("review")
+        )
+        return [sums[f"{c}_sum"].combine_chunks() for c in range(len(CLASSES))]
+
+    def predict(self, texts: list[str]) -> list[tuple[CheatingSentiment, float]]:
+        # The label and its probability for every text
+        if len(texts) == 0:
+            return []
+        scores = self.batch_scores(
+            [hash_features(text, self.n_features) for text in texts]
+        )
+        # The first class with the highest score wins, like max() would pick
+        top = pc.max_element_wise(*scores)
+        best = pa.array([len(CLASSES) - 1] * len(texts), pa.int64())
+        for c in reversed(range(len(CLASSES) - 1)):
+            best = pc.if_else(pc.equal(scores[c], top), c, best)
+        # The softmax of the best class, its own exp(score - top) is 1
+        total = pc.exp(pc.subtract(scores[0], top))
+        for s in scores[1:]:
+            total = pc.add(total, pc.exp(pc.subtract(s, top)))
+        probabilities = pc.divide(1.0, total)
+        return [
+            (CLASSES[b], p) for b, p in zip(best.to_pylist(), probabilities.to_pylist())
+        ]
+
+    def fit(
+        self,
+        texts: list[str],
+        labels: list[CheatingSentiment],
+        epochs: int = 5,
+        learning_rate: float = 0.2,
+        seed: int = 0,
+    ):
+        examples = [
+            (hash_features(text, self.n_features), CLASSES.index(label))
+            for text, label in zip(texts, labels)
+        ]
+        rng = random.Random(seed)
+        w = self.weights
+        for epoch in range(epochs):
+            rng.shuffle(examples)
+            lr = learning_rate / (1 + epoch)
+            for features, label in examples:
+                probabilities = self.softmax(self.scores(features))
+                # Gradient of the cross entropy, the probability minus the target
+                for c in range(len(CLASSES)):
+                    g = lr * (probabilities[c] - (c == label))
+                    if g == 0:
+                        continue
+                    self.bias[c] -= g
+                    for f in features:
+                        w[3 * f + c] -= g
+
+    def save(self, path: str):
+        header = {"n_features": self.n_features, "bias": self.bias}
+        with open(path, "wb") as f:
+            f.write(json.dumps(header).encode() + b"\n")
+            self.weights.tofile(f)
+
+    @classmethod
+    def load(cls, path: str) -> "LinearClassifier":
+        with open(path, "rb") as f:
+            header = json.loads(f.readline())
+            weights = array("d")
+            weights.fromfile(f, header["n_features"] * len(CLASSES))
+        return cls(header["n_features"], weights, header["bias"])
+
+
+class LocalClassifier(LLMClient):
+    # Labels reviews with a LinearClassifier on the CPU and only sends the ones it
+    # isn't confident about to the escalation client. Without one every review
+    # gets the classifier's label.
+    max_batch_reviews = CLASSIFIER_BATCH_SIZE
+
+    def __init__(
+        self,
+        classifier: LinearClassifier,
+        escalate: LLMClient | None = None,
+        escalate_limiter: AsyncLimiter | None = None,
+        confidence_threshold: float = CLASSIFIER_CONFIDENCE_THRESHOLD,
+        escalate_batch_token_budget: int | None = None,
+    ):
+        self.classifier = classifier
+        self.escalate = escalate
+        self.escalate_limiter = escalate_limiter or AsyncLimiter(
+            max_concurrency=None, max_requests_per_second=None
+        )
+        self.confidence_threshold = confidence_threshold
+        self.escalate_batch_token_budget = escalate_batch_token_budget
+        # Only the reviews labelled by the classifier, the escalated ones are in
+        # the escalation client's usage
+        self.usage = LLMUsage()
+        self.n_escalated = 0
+        # Hashing the weights takes a while, and the model is part of every cache key
+        self.model = f"{MODEL_PREFIX}{classifier.version}"
+        if escalate is not None:
+            self.model += f"+{escalate.get_model()}"
+
+    def get_model(self) -> str:
+        return self.model
+
+    def get_models(self) -> set[str]:
+        if self.escalate is None:
+            return {self.model}
+        return {self.model} | self.escalate.get_models()
+
+    def tag_escalated(self, result: ReviewWithSentiment) -> ReviewWithSentiment:
+        # Escalated labels are the LLM's, so the classifier can learn from them
+        if result.model is None:
+            result.model = self.escalate.get_model()
+        return result
+
+    def should_escalate(self, confidence: float) -> bool:
+        return self.escalate is not None and confidence < self.confidence_threshold
+
+    async def cheating_ref_in_review(
+        self, review: SteamReview, steam_product: SteamProduct
+    ) -> ReviewWithSentiment:
+        [(sentiment, confidence)] = self.classifier.predict([review.review])
+        if self.should_escalate(confidence):
+            self.n_escalated += 1
+            result = await self.escalate_limiter.run(
+                self.escalate.cheating_ref_in_review, review, steam_product
+            )
+            return self.tag_escalated(result)
+
+        self.usage.n_requests += 1
+        self.usage.n_reviews += 1
+        return ReviewWithSentiment(
+            steam_product=steam_product,
+            steam_review=review,
+            cheating_sentiment=sentiment,
+            confidence=confidence,
+        )
+
+    async def cheating_ref_in_reviews(
+        self, reviews: list[SteamReview], steam_product: SteamProduct
+    ) -> list[ReviewWithSentiment]:
+        # Scored in a thread so Steam pages and escalated requests keep moving
+        predictions = await asyncio.to_thread(
+            self.classifier.predict, [r.review for r in reviews]
+        )
+        results = [
+            ReviewWithSentiment(
+                steam_product=steam_product,
+                steam_review=review,
+                cheating_sentiment=sentiment,
+                confidence=confidence,
+            )
+            for review, (sentiment, confidence) in zip(reviews, predictions)
+        ]
+
+        escalated = [
+            i
+            for i, (_, confidence) in enumerate(predictions)
+            if self.should_escalate(confidence)
+        ]
+        self.usage.n_requests += 1
+        self.usage.n_reviews += len(reviews) - len(escalated)
+        if len(escalated) == 0:
+            return results
+
+        self.n_escalated += len(escalated)
+        log.debug(f"escalating {len(escalated)} of {len(reviews)} reviews")
+        # Reviews the escalation client fails on come back without a sentiment and
+        # end up in the dead letters like any other failed review
+        escalated_results = await classify_reviews(
+            self.escalate,
+            [reviews[i] for i in escalated],
+            steam_product,
+            self.escalate_limiter,
+            batch_token_budget=self.escalate_batch_token_budget,
+        )
+        for i, result in zip(escalated, escalated_results):
+            results[i] = self.tag_escalated(result)
+
+        return results
+
+    async def complete_chat(self, prompt: str, response_format: dict) -> httpx.Response:
+        if self.escalate is None:
+            raise RuntimeError("the local classifier has no chat backend")
+        return await self.escalate.complete_chat(prompt, response_format)
+
+    async def close(self):
+        if self.escalate is not None:
+            await self.escalate.close()
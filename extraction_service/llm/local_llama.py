@@ -1,16 +1,74 @@
+import asyncio
+import hashlib
 import json
+import math
+import time
 import httpx
 from log import log
+from metrics import metrics
 from defined_types import (
     SteamProduct,
     SteamReview,
     CheatingSentiment,
     ReviewWithSentiment,
 )
-from .client import LLMClient
+from http_client import create_http_client
+from .client import (
+    SENTIMENT_RESPONSE_FORMAT,
+    LLMClient,
+    LLMUsage,
+    raise_for_overload,
+)
 
 LLM_MAX_CONCURRENT = 10
 LLM_MAX_REQUESTS_PER_SECOND = 10
+LLM_INITIAL_CONCURRENT = LLM_MAX_CONCURRENT
+LLM_INITIAL_REQUESTS_PER_SECOND = LLM_MAX_REQUESTS_PER_SECOND
+# Upper bound only, the number of requests in flight is set by the limiter, which
+# main sizes to the number of slots the server reports
+HTTP_MAX_CONNECTIONS = 32
+
+# With single_token the server may only generate one of the sentiments and stops
+# after the first token, which is enough to tell them apart. The probabilities of
+# the most likely first tokens give the confidence.
+SINGLE_TOKEN_GRAMMAR = "root ::= " + " | ".join(
+    f'"{s.value}"' for s in CheatingSentiment
+)
+SINGLE_TOKEN_TOP_LOGPROBS = 10
+
+
+def sentiments_with_prefix(token: str) -> list[CheatingSentiment]:
+    token = token.strip().lower()
+    if token == "":
+        return []
+    return [s for s in CheatingSentiment if s.value.startswith(token)]
+
+
+def parse_single_token(
+    resp_json: dict,
+) -> tuple[CheatingSentiment | None, float | None]:
+    choice = resp_json["choices"][0]
+    candidates = sentiments_with_prefix(choice["message"]["content"] or "")
+
+    probabilities = {s: 0.0 for s in CheatingSentiment}
+    logprobs = (choice.get("logprobs") or {}).get("content") or []
+    if len(logprobs) > 0:
+        for top in logprobs[0].get("top_logprobs", []):
+            # A token shared by several sentiments, like "n", counts for none
+            matches = sentiments_with_prefix(top["token"])
+            if len(matches) == 1:
+                probabilities[matches[0]] += math.exp(top["logprob"])
+
+    if len(candidates) != 1:
+        # The token alone is ambiguous, the likeliest sentiment it starts decides
+        candidates = [s for s in candidates if probabilities[s] > 0]
+        if len(candidates) == 0:
+            return None, None
+        candidates = [max(candidates, key=probabilities.__getitem__)]
+
+    sentiment = candidates[0]
+    total = sum(probabilities.values())
+    return sentiment, probabilities[sentiment] / total if total > 0 else None
 
 
 class LocalLlama(LLMClient):
@@ -18,88 +76,190 @@ class LocalLlama(LLMClient):
     llm_url = "http://localhost:8080/v1/chat/completions"
     model = "Mistral-Small-3.1-24B-Instruct-2503-GGUF"
 
-    def __init__(self, base_prompt: str | None = None):
+    def __init__(
+        self,
+        base_prompt: str | None = None,
+        llm_url: str | None = None,
+        max_connections: int = HTTP_MAX_CONNECTIONS,
+        transport: httpx.AsyncBaseTransport | None = None,
+        single_token: bool = False,
+    ):
         if base_prompt is not None:
             self.base_prompt = base_prompt
 
+        if llm_url is not None:
+            self.llm_url = llm_url
+
+        self.http_client = create_http_client(max_connections, transport=transport)
+        self.usage = LLMUsage()
+        # Free llama-server slot ids, requests are pinned to a slot so the slot's KV
+        # cache still holds the shared prompt prefix from its previous request
+        self.free_slots: asyncio.Queue[int] | None = None
+        self.single_token = single_token
+
     def get_model(self) -> str:
         return self.model
 
+    def get_prompt_version(self) -> str:
+        # Labels read from one grammar constrained token aren't comparable to the
+        # JSON answers, so a replay relabels them when the mode changes
+        version = super().get_prompt_version()
+        if not self.single_token:
+            return version
+        h = hashlib.sha256(f"{version}\x1f{SINGLE_TOKEN_GRAMMAR}".encode())
+        return h.hexdigest()[:12]
+
+    async def check_health(self) -> bool:
+        # llama-server answers 503 while the model is loading
+        url = httpx.URL(self.llm_url)
+        try:
+            resp = await self.http_client.get(url.copy_with(path="/health"), timeout=5)
+        except httpx.HTTPError:
+            return False
+        return resp.is_success
+
+    async def discover_slots(self) -> int | None:
+        url = httpx.URL(self.llm_url)
+        n_slots = None
+        try:
+            resp = await self.http_client.get(url.copy_with(path="/props"))
+            if resp.is_success:
+                n_slots = resp.json().get("total_slots")
+
+            if n_slots is None:
+                resp = await self.http_client.get(url.copy_with(path="/slots"))
+                if resp.is_success:
+                    n_slots = len(resp.json())
+        except (httpx.HTTPError, json.JSONDecodeError) as e:
+            log.warning(f"failed to discover llama-server slots: {e!r}")
+
+        if not n_slots:
+            log.warning("llama-server slot count unknown, requests are not pinned")
+            return None
+
+        log.info(f"llama-server has {n_slots} slots")
+        self.free_slots = asyncio.Queue()
+        for slot in range(n_slots):
+            self.free_slots.put_nowait(slot)
+
+        return n_slots
+
+    async def complete_chat(self, prompt: str, response_format: dict) -> httpx.Response:
+        # The system message and the instructions in the prompt are identical for
+        # every request and the review comes last, so with cache_prompt the server
+        # only has to process the review tokens
+        body = {
+            "model": self.model,
+            "messages": [
+                {
+                    "role": "system",
+                    "content": "You are a helpful assistant that only outputs correct JSON.",
+                },
+                {"role": "user", "content": prompt},
+            ],
+            "response_format": response_format,
+            "cache_prompt": True,
+        }
+        return await self.post_to_slot(body)
+
+    async def complete_single_token(self, prompt: str) -> httpx.Response:
+        # Decodes one token instead of a JSON object, grammar is a llama-server
+        # extension of the chat completion API
+        body = {
+            "model": self.model,
+            "messages": [
+                {
+                    "role": "system",
+                    "content": "You are a helpful assistant that only outputs the answer.",
+                },
+                {"role": "user", "content": prompt},
+            ],
+            "grammar": SINGLE_TOKEN_GRAMMAR,
+            "max_tokens": 1,
+            "temperature": 0,
+            "logprobs": True,
+            "top_logprobs": SINGLE_TOKEN_TOP_LOGPROBS,
+            "cache_prompt": True,
+        }
+        return await self.post_to_slot(body)
+
+    async def post_to_slot(self, body: dict) -> httpx.Response:
+        if self.free_slots is None:
+            return await self.post(body)
+
+        slot = await self.free_slots.get()
+        try:
+            body["id_slot"] = slot
+            return await self.post(body)
+        finally:
+            self.free_slots.put_nowait(slot)
+
+    async def post(self, body: dict) -> httpx.Response:
+        start = time.perf_counter()
+        resp = await self.http_client.post(
+            url=self.llm_url,
+            headers={
+                "Content-Type": "application/json",
+            },
+            json=body,
+        )
+        # By server, every llama-server of a router runs the same model
+        metrics.observe(
+            "llm_request_seconds",
+            time.perf_counter() - start,
+            backend=httpx.URL(self.llm_url).netloc.decode(),
+        )
+        raise_for_overload(resp)
+        return resp
+
     async def cheating_ref_in_review(
         self, review: SteamReview, steam_product: SteamProduct
     ) -> ReviewWithSentiment:
 
         prompt = self.generate_prompt(review)
 
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(
-                url=self.llm_url,
-                headers={
-                    "Content-Type": "application/json",
-                },
-                json={
-                    "model": self.model,
-                    "messages": [
-                        {
-                            "role": "system",
-                            "content": "You are a helpful assistant that only outputs correct JSON.",
-                        },
-                        {"role": "user", "content": prompt},
-                    ],
-                    "response_format": {
-                        "type": "json_schema",
-                        "json_schema": {
-                            "name": "cheating_sentiment",
-                            "strict": True,
-                            "schema": {
-                                "type": "object",
-                                "properties": {
-                                    "cheating_sentiment": {
-                                        "type": "string",
-                                        "description": "The cheating sentiment in the review, either 'positive', 'negative' or 'not mentioned'",
-                                    }
-                                },
-                            },
-                            "required": ["cheating_sentiment"],
-                            "additionalProperties": False,
-                        },
-                    },
-                },
-                timeout=240,
-            )
+        if self.single_token:
+            resp = await self.complete_single_token(prompt)
+        else:
+            resp = await self.complete_chat(prompt, SENTIMENT_RESPONSE_FORMAT)
 
-            # resp.raise_for_status()
         if resp.is_error:
             log.warning(
                 f"failed to extract sentiment for review: {review.recommendation_id} got error code: {resp.status_code} - {resp.reason_phrase}"
             )
-            return ReviewWithSentiment(
-                steam_product=steam_product,
-                steam_review=review,
-                cheating_sentiment=None,
-            )
+        # Raised so the caller can retry it, or park the review in the dead letters
+        resp.raise_for_status()
 
         resp_json = resp.json()
+        self.usage.record(resp_json, 1)
 
         cheating_sentiment = None
+        confidence = None
         try:
-            cheating_sentiment_dict = json.loads(
-                resp_json["choices"][0]["message"]["content"]
-            )
-            cheating_sentiment = CheatingSentiment.from_str(
-                cheating_sentiment_dict.get("cheating_sentiment")
-            )
+            if self.single_token:
+                cheating_sentiment, confidence = parse_single_token(resp_json)
+            else:
+                cheating_sentiment_dict = json.loads(
+                    resp_json["choices"][0]["message"]["content"]
+                )
+                cheating_sentiment = CheatingSentiment.from_str(
+                    cheating_sentiment_dict.get("cheating_sentiment")
+                )
 
         except KeyError as e:
             log.error(f"failed to find key: {e}")
+        except (json.JSONDecodeError, AttributeError, TypeError) as e:
+            # Valid JSON that isn't the expected object, like "positive" or []
+            log.error(f"failed to parse sentiment: {e!r}")
 
         review_with_sentiment = ReviewWithSentiment(
             steam_product=steam_product,
             steam_review=review,
             cheating_sentiment=cheating_sentiment,
+            confidence=confidence,
         )
 
         return review_with_sentiment
 
-    def close(self):
-        pass
+    async def close(self):
+        await self.http_client.aclose()
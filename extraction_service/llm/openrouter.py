@@ -1,67 +1,92 @@
 import json
+import time
 from log import log
+from metrics import metrics
 import httpx
 from steam_product import SteamReview, SteamProduct
 import os
-from .client import LLMClient
+from http_client import create_http_client
+from .client import (
+    SENTIMENT_RESPONSE_FORMAT,
+    LLMClient,
+    LLMUsage,
+    raise_for_overload,
+)
 from defined_types import ReviewWithSentiment, CheatingSentiment
 
 
-LLM_MAX_CONCURRENT = 5
-LLM_MAX_REQUESTS_PER_SECOND = 2
+# Ceilings for the adaptive limiter, it starts at the initial values and only
+# goes higher while OpenRouter keeps up
+LLM_MAX_CONCURRENT = 20
+LLM_MAX_REQUESTS_PER_SECOND = 20
+LLM_INITIAL_CONCURRENT = 5
+LLM_INITIAL_REQUESTS_PER_SECOND = 2
+HTTP_MAX_CONNECTIONS = LLM_MAX_CONCURRENT
+DEFAULT_MODEL = "google/gemma-3-27b-it"
+# Dollars per million tokens for the default model, used to cap the spend when
+# OpenRouter only takes the overflow of the local servers
+PROMPT_COST_PER_MILLION_TOKENS = 0.1
+COMPLETION_COST_PER_MILLION_TOKENS = 0.2
 
 
 class OpenRouter(LLMClient):
-    def __init__(self, model: str, base_prompt: str | None = None):
+    api_url = "https://openrouter.ai/api/v1/chat/completions"
+
+    def __init__(
+        self,
+        model: str,
+        base_prompt: str | None = None,
+        api_url: str | None = None,
+        max_connections: int = HTTP_MAX_CONNECTIONS,
+        transport: httpx.AsyncBaseTransport | None = None,
+    ):
         if base_prompt is not None:
             self.base_prompt = base_prompt
 
         self.model = model
 
+        if api_url is not None:
+            self.api_url = api_url
+
         self.api_key = os.getenv("OPEN_ROUTER_API_KEY")
         if self.api_key is None:
             raise RuntimeError("OPEN_ROUTER_API_KEY is missing")
 
+        self.http_client = create_http_client(max_connections, transport=transport)
+        self.usage = LLMUsage()
+
     def get_model(self):
         return self.model
 
+    async def complete_chat(self, prompt: str, response_format: dict) -> httpx.Response:
+        start = time.perf_counter()
+        resp = await self.http_client.post(
+            url=self.api_url,
+            headers={
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json",
+            },
+            json={
+                "model": self.model,
+                "messages": [{"role": "user", "content": prompt}],
+                "response_format": response_format,
+            },
+        )
+        metrics.observe(
+            "llm_request_seconds",
+            time.perf_counter() - start,
+            backend=httpx.URL(self.api_url).netloc.decode(),
+        )
+        raise_for_overload(resp)
+        return resp
+
     async def cheating_ref_in_review(
         self, review: SteamReview, steam_product: SteamProduct
     ) -> ReviewWithSentiment:
         prompt = self.generate_prompt(review)
 
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(
-                url="https://openrouter.ai/api/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {self.api_key}",
-                    "Content-Type": "application/json",
-                },
-                json={
-                    "model": self.model,
-                    "messages": [{"role": "user", "content": prompt}],
-                    "response_format": {
-                        "type": "json_schema",
-                        "json_schema": {
-                            "name": "cheating_sentiment",
-                            "strict": True,
-                            "schema": {
-                                "type": "object",
-                                "properties": {
-                                    "cheating_sentiment": {
-                                        "type": "string",
-                                        "description": "The cheating sentiment in the review, either 'positive', 'negative' or 'not mentioned'",
-                                    }
-                                },
-                            },
-                            "required": ["cheating_sentiment"],
-                            "additionalProperties": False,
-                        },
-                    },
-                },
-                timeout=240,
-            )
-            resp.raise_for_status()
+        resp = await self.complete_chat(prompt, SENTIMENT_RESPONSE_FORMAT)
+        resp.raise_for_status()
 
         if resp.is_error:
             log.warning(
@@ -74,6 +99,7 @@ class OpenRouter(LLMClient):
             )
 
         resp_json = resp.json()
+        self.usage.record(resp_json, 1)
 
         cheating_sentiment = None
         try:
@@ -86,6 +112,9 @@ class OpenRouter(LLMClient):
 
         except KeyError as e:
             log.error(f"failed to find key: {e}")
+        except (json.JSONDecodeError, AttributeError, TypeError) as e:
+            # Valid JSON that isn't the expected object, like "positive" or []
+            log.error(f"failed to parse sentiment: {e!r}")
 
         review_with_sentiment = ReviewWithSentiment(
             steam_product=steam_product,
@@ -95,5 +124,5 @@ class OpenRouter(LLMClient):
 
         return review_with_sentiment
 
-    def close(self):
-        pass
+    async def close(self):
+        await self.http_client.aclose()
@@ -0,0 +1,313 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from enum import StrEnum
+from typing import Awaitable, Callable
+
+import httpx
+from defined_types import ReviewWithSentiment, SteamProduct, SteamReview
+from log import log
+from metrics import metrics
+from .client import BackendOverloadedError, LLMClient, LLMUsage, is_retryable
+
+ROUTER_FAILURE_THRESHOLD = 3
+ROUTER_COOLDOWN_SECONDS = 30
+ROUTER_HEALTH_CHECK_INTERVAL_SECONDS = 10
+
+
+class RoutingStrategy(StrEnum):
+    LEAST_OUTSTANDING = "least-outstanding"
+    LATENCY = "latency"
+
+
+@dataclass
+class Backend:
+    client: LLMClient
+    # Requests the backend takes at once, e.g. its llama-server slots
+    max_outstanding: int
+    name: str | None = None
+    # Paid backends are only used once every free one is saturated
+    prompt_cost_per_million_tokens: float = 0
+    completion_cost_per_million_tokens: float = 0
+
+    outstanding: int = 0
+    latency_average: float | None = None
+    consecutive_failures: int = 0
+    # Set by failed requests and Retry-After, only time clears it
+    unhealthy_until: float = 0
+    # Set and cleared by the health checks
+    failed_health_check: bool = False
+    n_requests: int = 0
+    n_failures: int = 0
+
+    def __post_init__(self):
+        if self.name is None:
+            self.name = self.client.get_model()
+
+    @property
+    def paid(self) -> bool:
+        return (
+            self.prompt_cost_per_million_tokens > 0
+            or self.completion_cost_per_million_tokens > 0
+        )
+
+    def spent(self) -> float:
+        usage = self.client.usage
+        return (
+            usage.prompt_tokens * self.prompt_cost_per_million_tokens
+            + usage.completion_tokens * self.completion_cost_per_million_tokens
+        ) / 1_000_000
+
+    def is_healthy(self, t: float) -> bool:
+        return not self.failed_health_check and t >= self.unhealthy_until
+
+    def expected_latency(self) -> float:
+        # A backend without a measured latency yet is tried first, to measure it
+        return (
+            (self.latency_average or 0) * (self.outstanding + 1) / self.max_outstanding
+        )
+
+    def on_success(self, latency: float):
+        self.n_requests += 1
+        self.consecutive_failures = 0
+        if self.latency_average is None:
+            self.latency_average = latency
+        self.latency_average = 0.9 * self.latency_average + 0.1 * latency
+
+    def on_failure(self, e: Exception, failure_threshold: int, cooldown: float):
+        self.n_requests += 1
+        self.n_failures += 1
+        self.consecutive_failures += 1
+        t = time.perf_counter()
+        if isinstance(e, BackendOverloadedError) and e.retry_after is not None:
+            self.unhealthy_until = max(self.unhealthy_until, t + e.retry_after)
+        if self.consecutive_failures >= failure_threshold:
+            log.warning(
+                f"taking LLM backend {self.name} out for {cooldown}s after "
+                f"{self.consecutive_failures} failures, last one {e!r}"
+            )
+            self.unhealthy_until = max(self.unhealthy_until, t + cooldown)
+
+    def metrics(self) -> dict[str, float | int]:
+        return {
+            "requests": self.n_requests,
+            "failures": self.n_failures,
+            "reviews": self.client.usage.n_reviews,
+            "latency_average": round(self.latency_average or 0, 3),
+            "spent": round(self.spent(), 4),
+        }
+
+
+class LLMRouter(LLMClient):
+    """
+    Spreads requests over a pool of backends, by the fewest outstanding requests
+    relative to the backend's capacity or by the shortest expected latency. Free
+    backends are preferred, paid ones only take the requests the free ones have no
+    room for, until max_spend dollars are spent. A backend failing failure_threshold
+    times in a row is taken out for cooldown seconds, one failing its health check
+    until it passes one. A request that fails on one backend is tried on the others
+    before the error is passed on to the caller's retries.
+    """
+
+    def __init__(
+        self,
+        backends: list[Backend],
+        strategy: RoutingStrategy = RoutingStrategy.LEAST_OUTSTANDING,
+        max_spend: float | None = None,
+        failure_threshold: int = ROUTER_FAILURE_THRESHOLD,
+        cooldown: float = ROUTER_COOLDOWN_SECONDS,
+    ):
+        if len(backends) == 0:
+            raise ValueError("the router needs at least one backend")
+
+        self.backends = backends
+        self.strategy = strategy
+        self.max_spend = max_spend
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.condition = asyncio.Condition()
+        self.health_check_task: asyncio.Task | None = None
+        self.health_check_interval = ROUTER_HEALTH_CHECK_INTERVAL_SECONDS
+
+    @property
+    def usage(self) -> LLMUsage:
+        usage = LLMUsage()
+        for backend in self.backends:
+            usage.n_requests += backend.client.usage.n_requests
+            usage.n_reviews += backend.client.usage.n_reviews
+            usage.prompt_tokens += backend.client.usage.prompt_tokens
+            usage.completion_tokens += backend.client.usage.completion_tokens
+        return usage
+
+    def max_outstanding(self) -> int:
+        return sum(backend.max_outstanding for backend in self.backends)
+
+    def spent(self) -> float:
+        return sum(backend.spent() for backend in self.backends)
+
+    def get_model(self) -> str:
+        # Only names the pool, every label is tagged with the backend that gave it
+        return "+".join(sorted({b.client.get_model() for b in self.backends}))
+
+    def get_models(self) -> set[str]:
+        return {self.get_model()}.union(*[b.client.get_models() for b in self.backends])
+
+    def is_usable(self, backend: Backend, t: float) -> bool:
+        if not backend.is_healthy(t):
+            return False
+        return (
+            not backend.paid or self.max_spend is None or self.spent() < self.max_spend
+        )
+
+    def pick(self, exclude: set[int]) -> Backend | None:
+        t = time.perf_counter()
+        available = [
+            b
+            for b in self.backends
+            if id(b) not in exclude
+            and b.outstanding < b.max_outstanding
+            and self.is_usable(b, t)
+        ]
+        free = [b for b in available if not b.paid]
+        candidates = free if len(free) > 0 else available
+        if len(candidates) == 0:
+            return None
+
+        if self.strategy == RoutingStrategy.LATENCY:
+            return min(candidates, key=Backend.expected_latency)
+        return min(
+            candidates,
+            key=lambda b: (b.outstanding / b.max_outstanding, b.latency_average or 0),
+        )
+
+    async def acquire(self, exclude: set[int]) -> Backend:
+        # Waits while the usable backends are all saturated, gives up once none is
+        # usable at all
+        async with self.condition:
+            while True:
+                backend = self.pick(exclude)
+                if backend is not None:
+                    backend.outstanding += 1
+                    return backend
+
+                t = time.perf_counter()
+                usable = [
+                    b
+                    for b in self.backends
+                    if id(b) not in exclude and self.is_usable(b, t)
+                ]
+                if len(usable) == 0:
+                    # Backends that failed their health check come back with the
+                    # next check, at most one interval away
+                    unhealthy_until = [
+                        b.unhealthy_until
+                        if b.unhealthy_until > t
+                        else t + self.health_check_interval
+                        for b in self.backends
+                        if not b.is_healthy(t)
+                    ]
+                    raise BackendOverloadedError(
+                        503,
+                        min(unhealthy_until) - t if len(unhealthy_until) > 0 else None,
+                    )
+                await self.condition.wait()
+
+    async def release(self, backend: Backend):
+        async with self.condition:
+            backend.outstanding -= 1
+            self.condition.notify_all()
+
+    async def run(self, func: Callable[[LLMClient], Awaitable]):
+        tried: set[int] = set()
+        last_error: Exception | None = None
+        while True:
+            try:
+                backend = await self.acquire(tried)
+            except BackendOverloadedError:
+                if last_error is not None:
+                    raise last_error
+                raise
+
+            start = time.perf_counter()
+            try:
+                result = await func(backend.client)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                backend.on_failure(e, self.failure_threshold, self.cooldown)
+                tried.add(id(backend))
+                last_error = e
+                continue
+            finally:
+                await self.release(backend)
+
+            backend.on_success(time.perf_counter() - start)
+            metrics.inc("llm_router_requests", backend=backend.name)
+            return result
+
+    @staticmethod
+    def tag(client: LLMClient, result: ReviewWithSentiment) -> ReviewWithSentiment:
+        if result.model is None:
+            result.model = client.get_model()
+        return result
+
+    async def cheating_ref_in_review(
+        self, review: SteamReview, steam_product: SteamProduct
+    ) -> ReviewWithSentiment:
+        async def classify(client: LLMClient) -> ReviewWithSentiment:
+            return self.tag(
+                client, await client.cheating_ref_in_review(review, steam_product)
+            )
+
+        return await self.run(classify)
+
+    async def cheating_ref_in_reviews(
+        self, reviews: list[SteamReview], steam_product: SteamProduct
+    ) -> list[ReviewWithSentiment]:
+        async def classify(client: LLMClient) -> list[ReviewWithSentiment]:
+            results = await client.cheating_ref_in_reviews(reviews, steam_product)
+            return [self.tag(client, r) for r in results]
+
+        return await self.run(classify)
+
+    async def complete_chat(self, prompt: str, response_format: dict) -> httpx.Response:
+        return await self.run(
+            lambda client: client.complete_chat(prompt, response_format)
+        )
+
+    async def check_health(self) -> bool:
+        results = await asyncio.gather(
+            *[b.client.check_health() for b in self.backends]
+        )
+        t = time.perf_counter()
+        async with self.condition:
+            for backend, healthy in zip(self.backends, results):
+                # A passed check doesn't cut a cooldown or Retry-After short, the
+                # health endpoint can answer while completions still fail
+                if healthy and backend.failed_health_check:
+                    log.info(f"LLM backend {backend.name} passed its health check")
+                elif not healthy and not backend.failed_health_check:
+                    log.warning(f"LLM backend {backend.name} failed its health check")
+                backend.failed_health_check = not healthy
+            self.condition.notify_all()
+
+        return any(results)
+
+    async def check_health_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await self.check_health()
+
+    def start_health_checks(
+        self, interval: float = ROUTER_HEALTH_CHECK_INTERVAL_SECONDS
+    ):
+        self.health_check_interval = interval
+        self.health_check_task = asyncio.create_task(self.check_health_loop(interval))
+
+    def metrics(self) -> dict[str, dict[str, float | int]]:
+        return {backend.name: backend.metrics() for backend in self.backends}
+
+    async def close(self):
+        if self.health_check_task is not None:
+            self.health_check_task.cancel()
+        await asyncio.gather(*[b.client.close() for b in self.backends])
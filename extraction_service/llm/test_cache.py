@@ -0,0 +1,59 @@
+from cache import SentimentCache
+from defined_types import CheatingSentiment
+
+
+def test_sentiment_cache_normalizes_review_text():
+    a = SentimentCache.make_key("model", "prompt", "Cheaters!!")
+    b = SentimentCache.make_key("model", "prompt", "  cheaters ")
+    c = SentimentCache.make_key("other model", "prompt", "cheaters")
+
+    assert a == b
+    assert a != c
+
+
+def test_sentiment_cache_evicts_least_recently_used(tmp_path):
+    cache = SentimentCache(str(tmp_path / "cache.sqlite"), max_entries=10)
+
+    for i in range(10):
+        cache.put(f"key {i}", CheatingSentiment.NEGATIVE)
+    # Touch the oldest entry so it survives the eviction
+    assert cache.get("key 0") == CheatingSentiment.NEGATIVE
+
+    cache.put("key 10", CheatingSentiment.POSITIVE)
+
+    assert cache.get("key 0") == CheatingSentiment.NEGATIVE
+    assert cache.get("key 1") is None
+    assert cache.get("key 10") == CheatingSentiment.POSITIVE
+    assert cache.hits == 3
+    assert cache.misses == 1
+    assert cache.hit_rate == 0.75
+
+    cache.close()
+
+
+def test_sentiment_cache_commits_in_batches(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = SentimentCache(path, max_entries=100, flush_size=3)
+
+    cache.put_many(
+        [("a", CheatingSentiment.NEGATIVE), ("b", CheatingSentiment.POSITIVE)]
+    )
+    # Waiting writes are already served, but not committed yet
+    assert cache.get_many(["a", "b", "c"]) == {
+        "a": CheatingSentiment.NEGATIVE,
+        "b": CheatingSentiment.POSITIVE,
+    }
+    assert SentimentCache(path, max_entries=100).n_entries == 0
+
+    cache.put("c", CheatingSentiment.NOT_MENTIONED)
+    assert SentimentCache(path, max_entries=100).n_entries == 3
+
+    cache.put("d", CheatingSentiment.NEGATIVE)
+    cache.close()
+    reopened = SentimentCache(path, max_entries=100)
+    assert reopened.get_many(["a", "d"]) == {
+        "a": CheatingSentiment.NEGATIVE,
+        "d": CheatingSentiment.NEGATIVE,
+    }
+    assert reopened.hits == 2
+    reopened.close()
@@ -2,8 +2,23 @@ import asyncio
 from datetime import datetime
 import time
 
+import httpx
 import pytest
-from client import AsyncLimiter
+from cache import SentimentCache
+from client import (
+    AdaptiveLimiter,
+    AsyncLimiter,
+    BackendOverloadedError,
+    ReviewPrefilter,
+    RetryPolicy,
+    extract_cheating_sentiment,
+    run_with_retry,
+    stream_cheating_sentiment,
+)
+from conftest import MockLLMClient
+from defined_types import CheatingSentiment, PrefilterRecall
+from llm.local_llama import LocalLlama
+from mocks import generate_mock_review, generate_mock_steam_product
 
 
 @pytest.mark.asyncio
@@ -87,3 +102,365 @@ async def test_async_limiter_no_max_concurrency_rps():
     assert completed_tasks == n_tasks
     assert elapsed_time >= 2
     assert elapsed_time <= 2.5
+
+
+@pytest.mark.asyncio
+async def test_stream_cheating_sentiment_flushes_in_chunks():
+
+    n_pages = 3
+    page_size = 10
+    chunk_size = 4
+    fetched_pages = 0
+
+    async def pages():
+        nonlocal fetched_pages
+        for p in range(n_pages):
+            fetched_pages += 1
+            page = []
+            for i in range(page_size):
+                review = generate_mock_review(f"review {p} {i}")
+                review.recommendation_id = p * page_size + i
+                page.append(review)
+            yield page
+
+    chunks = []
+
+    async def on_chunk(chunk):
+        chunks.append([r.steam_review.recommendation_id for r in chunk])
+
+    client = MockLLMClient()
+    n_classified = await stream_cheating_sentiment(
+        client=client,
+        pages=pages(),
+        steam_product=generate_mock_steam_product(),
+        limiter=AsyncLimiter(max_concurrency=3, max_requests_per_second=None),
+        on_chunk=on_chunk,
+        n_workers=3,
+        queue_size=2,
+        chunk_size=chunk_size,
+    )
+
+    assert n_classified == n_pages * page_size
+    assert client.n_calls == n_pages * page_size
+    assert fetched_pages == n_pages
+    assert all(len(c) <= chunk_size for c in chunks)
+    assert sorted(i for c in chunks for i in c) == list(range(n_pages * page_size))
+
+
+@pytest.mark.asyncio
+async def test_extract_cheating_sentiment_reuses_cached_sentiments(tmp_path):
+
+    cache = SentimentCache(str(tmp_path / "cache.sqlite"), max_entries=100)
+    client = MockLLMClient(latency=0.01)
+    limiter = AsyncLimiter(max_concurrency=5, max_requests_per_second=None)
+    reviews = [generate_mock_review(t) for t in ["Cheaters!", "cheaters", "gg"]]
+
+    first = await extract_cheating_sentiment(
+        client, reviews, generate_mock_steam_product(), limiter, cache
+    )
+    second = await extract_cheating_sentiment(
+        client, reviews, generate_mock_steam_product(), limiter, cache
+    )
+
+    # The duplicate in the first run waits for the in-flight call
+    assert client.n_calls == 2
+    assert all(
+        r.cheating_sentiment == CheatingSentiment.NOT_MENTIONED for r in first + second
+    )
+    assert cache.hits == 4
+
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_extract_cheating_sentiment_prefilter_skips_llm():
+
+    prefilter = ReviewPrefilter(PrefilterRecall.MEDIUM)
+    client = MockLLMClient()
+    limiter = AsyncLimiter(max_concurrency=5, max_requests_per_second=None)
+    texts = ["so many HACKERS", "got banned for nothing", "fun with friends"]
+    reviews = [generate_mock_review(t) for t in texts]
+
+    results = await extract_cheating_sentiment(
+        client, reviews, generate_mock_steam_product(), limiter, prefilter=prefilter
+    )
+
+    assert client.n_calls == 2
+    assert prefilter.n_checked == 3
+    assert prefilter.n_skipped == 1
+    assert results[2].cheating_sentiment == CheatingSentiment.NOT_MENTIONED
+    # Tagged so the label isn't mistaken for the LLM's
+    assert results[2].model == "prefilter-medium"
+    assert results[0].model is None
+    assert not ReviewPrefilter(PrefilterRecall.LOW).may_mention_cheating(texts[1])
+
+
+@pytest.mark.asyncio
+async def test_extract_cheating_sentiment_batches_and_falls_back():
+
+    client = MockLLMClient(
+        batch_sentiment=CheatingSentiment.NEGATIVE, drop_from_batch=3
+    )
+    limiter = AsyncLimiter(max_concurrency=5, max_requests_per_second=None)
+    reviews = []
+    for i in range(5):
+        review = generate_mock_review("x" * 40)
+        review.recommendation_id = i
+        reviews.append(review)
+
+    # 11 estimated tokens per review, so two reviews fit in each batch
+    results = await extract_cheating_sentiment(
+        client,
+        reviews,
+        generate_mock_steam_product(),
+        limiter,
+        batch_token_budget=25,
+    )
+
+    assert client.n_batch_calls == 2
+    # The last review is alone in its batch and review 3 is missing from the
+    # batch answer, both go through the single review path
+    assert client.n_calls == 2
+    assert [r.steam_review.recommendation_id for r in results] == list(range(5))
+    assert results[0].cheating_sentiment == CheatingSentiment.NEGATIVE
+    assert results[3].cheating_sentiment == CheatingSentiment.NOT_MENTIONED
+    # Review 3 is counted in its batch and again on its own
+    assert client.usage.n_requests == 4
+    assert client.usage.n_reviews == 6
+
+
+class SimulatedBackend:
+    def __init__(self, capacity: int, latency: float, retry_after: float | None):
+        self.capacity = capacity
+        self.latency = latency
+        self.retry_after = retry_after
+        self.active = 0
+        self.max_active = 0
+        self.n_overloaded = 0
+
+    async def request(self):
+        if self.active >= self.capacity:
+            self.n_overloaded += 1
+            raise BackendOverloadedError(429, self.retry_after)
+
+        self.active += 1
+        self.max_active = max(self.active, self.max_active)
+        await asyncio.sleep(self.latency)
+        self.active -= 1
+
+
+@pytest.mark.asyncio
+async def test_adaptive_limiter_backs_off_when_overloaded():
+
+    backend = SimulatedBackend(capacity=3, latency=0.05, retry_after=0.1)
+    limiter = AdaptiveLimiter(max_concurrency=10, max_requests_per_second=1000)
+    retry_policy = RetryPolicy(max_attempts=20, base_delay=0.01)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(
+        *[run_with_retry(limiter, retry_policy, backend.request) for _ in range(30)]
+    )
+    elapsed_time = time.perf_counter() - start_time
+
+    assert backend.n_overloaded > 0
+    assert limiter.n_decreases > 0
+    assert limiter.metrics()["concurrency"] < 10
+    assert limiter.metrics()["in_flight"] == 0
+    # At least one Retry-After pause was waited out
+    assert elapsed_time >= 0.1
+
+
+@pytest.mark.asyncio
+async def test_adaptive_limiter_grows_while_healthy():
+
+    backend = SimulatedBackend(capacity=100, latency=0.01, retry_after=None)
+    limiter = AdaptiveLimiter(
+        max_concurrency=8,
+        max_requests_per_second=1000,
+        initial_concurrency=1,
+        initial_requests_per_second=100,
+    )
+
+    await asyncio.gather(*[limiter.run(backend.request) for _ in range(60)])
+
+    assert backend.n_overloaded == 0
+    assert limiter.metrics()["concurrency"] > 1
+    assert backend.max_active > 1
+
+
+@pytest.mark.asyncio
+async def test_adaptive_limiter_leaves_retries_to_the_caller():
+
+    backend = SimulatedBackend(capacity=0, latency=0, retry_after=0)
+    limiter = AdaptiveLimiter(max_concurrency=2, max_requests_per_second=1000)
+
+    with pytest.raises(BackendOverloadedError):
+        await limiter.run(backend.request)
+    assert backend.n_overloaded == 1
+    assert limiter.n_overloaded == 1
+
+    # The retry policy alone decides how often the call is made
+    with pytest.raises(BackendOverloadedError):
+        await run_with_retry(
+            limiter, RetryPolicy(max_attempts=3, base_delay=0.01), backend.request
+        )
+    assert backend.n_overloaded == 4
+    assert limiter.in_flight == 0
+
+
+def test_adaptive_limiter_backs_off_on_latency_spike():
+
+    limiter = AdaptiveLimiter(max_concurrency=8, max_requests_per_second=8)
+
+    limiter.on_success(0.1)
+    limiter.on_success(0.1)
+    limiter.on_success(1.0)
+
+    assert limiter.n_decreases == 1
+    assert limiter.metrics()["concurrency"] == 4
+
+
+@pytest.mark.asyncio
+async def test_extract_cheating_sentiment_retries_transient_errors():
+    client = MockLLMClient(n_failures=2)
+    limiter = AsyncLimiter(max_concurrency=None, max_requests_per_second=None)
+    retry_policy = RetryPolicy(max_attempts=3, base_delay=0.01)
+
+    reviews_with_sentiment = await extract_cheating_sentiment(
+        client,
+        [generate_mock_review("gg")],
+        generate_mock_steam_product(),
+        limiter,
+        retry_policy=retry_policy,
+    )
+
+    assert client.n_calls == 3
+    assert (
+        reviews_with_sentiment[0].cheating_sentiment == CheatingSentiment.NOT_MENTIONED
+    )
+
+
+@pytest.mark.asyncio
+async def test_extract_cheating_sentiment_gives_up_without_raising():
+    client = MockLLMClient(n_failures=10)
+    limiter = AsyncLimiter(max_concurrency=None, max_requests_per_second=None)
+    retry_policy = RetryPolicy(max_attempts=3, base_delay=0.01)
+
+    reviews_with_sentiment = await extract_cheating_sentiment(
+        client,
+        [generate_mock_review("gg")],
+        generate_mock_steam_product(),
+        limiter,
+        retry_policy=retry_policy,
+    )
+
+    assert client.n_calls == 3
+    assert reviews_with_sentiment[0].cheating_sentiment is None
+
+
+def test_adaptive_limiter_adopts_lasting_latency_shift():
+
+    limiter = AdaptiveLimiter(
+        max_concurrency=16,
+        max_requests_per_second=20,
+        initial_concurrency=4,
+        initial_requests_per_second=4,
+    )
+    for _ in range(50):
+        limiter.on_success(0.1)
+
+    # Every call is five times slower from now on, e.g. a slower model
+    for _ in range(200):
+        limiter.on_success(0.5)
+
+    # Backed off when the shift started, then grew back at the new latency
+    assert limiter.n_decreases >= 1
+    assert limiter.latency_average == pytest.approx(0.5, rel=0.05)
+    assert limiter.concurrency == limiter.max_concurrency
+
+
+class GarbledLLMClient(MockLLMClient):
+    # Answers with a body that isn't JSON, like a proxy's error page
+    async def cheating_ref_in_review(self, review, steam_product):
+        self.n_calls += 1
+        resp = httpx.Response(200, text="<html>bad gateway</html>")
+        resp.json()
+
+
+@pytest.mark.asyncio
+async def test_extract_cheating_sentiment_gives_up_on_unparseable_response():
+    client = GarbledLLMClient()
+    limiter = AsyncLimiter(max_concurrency=None, max_requests_per_second=None)
+    retry_policy = RetryPolicy(max_attempts=3, base_delay=0.01)
+
+    reviews_with_sentiment = await extract_cheating_sentiment(
+        client,
+        [generate_mock_review("gg")],
+        generate_mock_steam_product(),
+        limiter,
+        retry_policy=retry_policy,
+    )
+
+    # Not retried, the review comes back without a sentiment for the dead letters
+    assert client.n_calls == 1
+    assert reviews_with_sentiment[0].cheating_sentiment is None
+
+
+@pytest.mark.asyncio
+async def test_batch_prompt_edit_invalidates_cached_sentiments(tmp_path):
+
+    cache = SentimentCache(str(tmp_path / "cache.sqlite"), max_entries=100)
+    client = MockLLMClient()
+    limiter = AsyncLimiter(max_concurrency=5, max_requests_per_second=None)
+    reviews = []
+    for i in range(2):
+        review = generate_mock_review(f"review {i}")
+        review.recommendation_id = i
+        reviews.append(review)
+
+    async def classify():
+        return await extract_cheating_sentiment(
+            client,
+            reviews,
+            generate_mock_steam_product(),
+            limiter,
+            cache,
+            batch_token_budget=1000,
+        )
+
+    await classify()
+    await classify()
+    assert client.n_batch_calls == 1
+
+    # Only the batch prompt changes, the cached labels came from the old one
+    client.batch_prompt += " "
+    await classify()
+    assert client.n_batch_calls == 2
+
+    cache.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("content", ['"positive"', "[]", '{"cheating_sentiment": 1}'])
+async def test_extract_cheating_sentiment_gives_up_on_non_object_answer(content):
+    def answer(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(
+            200, json={"choices": [{"message": {"content": content}}]}
+        )
+
+    client = LocalLlama(
+        llm_url="http://llama/v1/chat/completions",
+        transport=httpx.MockTransport(answer),
+    )
+    limiter = AsyncLimiter(max_concurrency=None, max_requests_per_second=None)
+
+    reviews_with_sentiment = await extract_cheating_sentiment(
+        client,
+        [generate_mock_review("gg")],
+        generate_mock_steam_product(),
+        limiter,
+    )
+    await client.close()
+
+    # Valid JSON of the wrong shape is a failed review, not a crash
+    assert reviews_with_sentiment[0].cheating_sentiment is None
@@ -0,0 +1,90 @@
+import pytest
+from conftest import MockLLMClient
+from defined_types import CheatingSentiment
+from llm.client import AsyncLimiter, classify_reviews
+from llm.local_classifier import (
+    CLASSES,
+    CLASSIFIER_BATCH_TOKEN_BUDGET,
+    LinearClassifier,
+    LocalClassifier,
+    hash_features,
+)
+from mocks import generate_mock_review, generate_mock_steam_product
+
+TRAINING_SET = [
+    ("cheaters everywhere, uninstalled", CheatingSentiment.NEGATIVE),
+    ("every lobby has a hacker with aimbot", CheatingSentiment.NEGATIVE),
+    ("the anticheat works, no cheaters at all", CheatingSentiment.POSITIVE),
+    ("cheaters get banned fast, great anticheat", CheatingSentiment.POSITIVE),
+    ("great maps and fun weapons", CheatingSentiment.NOT_MENTIONED),
+    ("servers lag and the devs never update", CheatingSentiment.NOT_MENTIONED),
+] * 20
+
+
+def trained_classifier() -> LinearClassifier:
+    classifier = LinearClassifier(n_features=2**12)
+    classifier.fit([t for t, _ in TRAINING_SET], [s for _, s in TRAINING_SET])
+    return classifier
+
+
+def test_linear_classifier_learns_and_round_trips(tmp_path):
+    classifier = trained_classifier()
+    texts = ["so many cheaters", "fun weapons", "no cheaters, anticheat works"]
+    predictions = classifier.predict(texts)
+    assert [s for s, _ in predictions] == [
+        CheatingSentiment.NEGATIVE,
+        CheatingSentiment.NOT_MENTIONED,
+        CheatingSentiment.POSITIVE,
+    ]
+    assert all(0 < confidence <= 1 for _, confidence in predictions)
+
+    path = str(tmp_path / "classifier.bin")
+    classifier.save(path)
+    loaded = LinearClassifier.load(path)
+    assert loaded.predict(texts) == predictions
+    assert loaded.version == classifier.version
+
+
+def test_linear_classifier_batch_scores_match_per_review_scores():
+    classifier = trained_classifier()
+    # An empty review only has the bias, and a repeated one is scored twice
+    texts = [t for t, _ in TRAINING_SET[:6]] + ["", "cheaters everywhere, uninstalled"]
+    features = [hash_features(t, classifier.n_features) for t in texts]
+
+    scores = classifier.batch_scores(features)
+    for i, f in enumerate(features):
+        assert [s[i].as_py() for s in scores] == pytest.approx(classifier.scores(f))
+    for (sentiment, confidence), f in zip(classifier.predict(texts), features):
+        probabilities = classifier.softmax(classifier.scores(f))
+        assert confidence == pytest.approx(max(probabilities))
+        assert CLASSES.index(sentiment) == probabilities.index(max(probabilities))
+    assert classifier.predict([]) == []
+
+
+@pytest.mark.asyncio
+async def test_local_classifier_escalates_unsure_reviews():
+    escalation = MockLLMClient(CheatingSentiment.POSITIVE, model="escalation")
+    client = LocalClassifier(
+        trained_classifier(), escalate=escalation, confidence_threshold=0.8
+    )
+    texts = ["cheaters everywhere"] * 50 + ["great maps, fun weapons"] * 50 + ["xyzzy"]
+    reviews = [generate_mock_review(t) for t in texts]
+
+    results = await classify_reviews(
+        client,
+        reviews,
+        generate_mock_steam_product(),
+        AsyncLimiter(max_concurrency=None, max_requests_per_second=None),
+        batch_token_budget=CLASSIFIER_BATCH_TOKEN_BUDGET,
+    )
+
+    # Nothing is known about the last review, only it goes to the escalation client
+    assert escalation.reviews == ["xyzzy"]
+    assert client.n_escalated == 1
+    assert client.usage.n_requests == 1
+    assert client.usage.n_reviews == 100
+    assert results[0].cheating_sentiment == CheatingSentiment.NEGATIVE
+    assert results[0].confidence >= 0.8
+    assert results[50].cheating_sentiment == CheatingSentiment.NOT_MENTIONED
+    assert results[-1].cheating_sentiment == CheatingSentiment.POSITIVE
+    assert client.get_model().endswith("+escalation")
@@ -0,0 +1,124 @@
+import asyncio
+import math
+
+import pytest
+from benchmarks.stub_server import StubServer, sentiment_chat_route
+from defined_types import CheatingSentiment
+from llm.client import SENTIMENT_RESPONSE_FORMAT
+from llm.local_llama import LocalLlama, parse_single_token
+from mocks import generate_mock_review, generate_mock_steam_product
+
+CHAT_PATH = "/v1/chat/completions"
+
+
+@pytest.mark.asyncio
+async def test_local_llama_pins_requests_to_discovered_slots():
+
+    n_slots = 2
+    routes = {
+        "/props": lambda _: (200, {"total_slots": n_slots}),
+        CHAT_PATH: sentiment_chat_route(),
+    }
+
+    with StubServer(routes=routes) as stub:
+        client = LocalLlama(llm_url=stub.url + CHAT_PATH)
+        assert await client.discover_slots() == n_slots
+
+        reviews = [generate_mock_review(f"review {i}") for i in range(6)]
+        await asyncio.gather(
+            *[
+                client.cheating_ref_in_review(r, generate_mock_steam_product())
+                for r in reviews
+            ]
+        )
+        await client.close()
+
+    chat_requests = [r.body for r in stub.requests if r.path == CHAT_PATH]
+    assert len(chat_requests) == len(reviews)
+    assert all(body["cache_prompt"] for body in chat_requests)
+    assert {body["id_slot"] for body in chat_requests} == set(range(n_slots))
+
+    # Everything before the review text is the same in every request
+    system_messages = {body["messages"][0]["content"] for body in chat_requests}
+    assert len(system_messages) == 1
+    prefix = client.base_prompt.split("{review}")[0]
+    assert all(
+        body["messages"][1]["content"].startswith(prefix) for body in chat_requests
+    )
+
+
+@pytest.mark.asyncio
+async def test_local_llama_without_slot_info_does_not_pin():
+
+    with StubServer(routes={CHAT_PATH: sentiment_chat_route()}) as stub:
+        client = LocalLlama(llm_url=stub.url + CHAT_PATH)
+        assert await client.discover_slots() is None
+
+        await client.cheating_ref_in_review(
+            generate_mock_review("gg"), generate_mock_steam_product()
+        )
+        await client.close()
+
+    chat_requests = [r.body for r in stub.requests if r.path == CHAT_PATH]
+    assert "id_slot" not in chat_requests[0]
+    assert chat_requests[0]["cache_prompt"]
+
+
+@pytest.mark.asyncio
+async def test_local_llama_single_token():
+
+    routes = {CHAT_PATH: sentiment_chat_route(sentiment="negative")}
+    with StubServer(routes=routes) as stub:
+        client = LocalLlama(llm_url=stub.url + CHAT_PATH, single_token=True)
+        result = await client.cheating_ref_in_review(
+            generate_mock_review("cheaters everywhere"), generate_mock_steam_product()
+        )
+        await client.close()
+
+    assert result.cheating_sentiment == CheatingSentiment.NEGATIVE
+    assert result.confidence == pytest.approx(0.9)
+    body = stub.requests[0].body
+    assert body["max_tokens"] == 1
+    assert "response_format" not in body
+    assert body["grammar"] == 'root ::= "positive" | "not mentioned" | "negative"'
+    # Labels from the two modes aren't mixed up
+    assert client.get_prompt_version() != LocalLlama().get_prompt_version()
+
+
+def single_token_response(content: str, top: dict[str, float]) -> dict:
+    top_logprobs = [{"token": t, "logprob": math.log(p)} for t, p in top.items()]
+    return {
+        "choices": [
+            {
+                "message": {"content": content},
+                "logprobs": {"content": [{"top_logprobs": top_logprobs}]},
+            }
+        ]
+    }
+
+
+def test_parse_single_token():
+    sentiment, confidence = parse_single_token(
+        single_token_response(" pos", {" pos": 0.6, "neg": 0.2, "not": 0.2})
+    )
+    assert sentiment == CheatingSentiment.POSITIVE
+    assert confidence == pytest.approx(0.6)
+
+    # "n" starts both negative and not mentioned, the logprobs decide
+    sentiment, _ = parse_single_token(
+        single_token_response("n", {"n": 0.5, "not": 0.3, "neg": 0.1})
+    )
+    assert sentiment == CheatingSentiment.NOT_MENTIONED
+
+    # Servers without logprobs still get a label, without a confidence
+    response = {"choices": [{"message": {"content": "negative"}}]}
+    assert parse_single_token(response) == (CheatingSentiment.NEGATIVE, None)
+
+
+def test_sentiment_response_format_is_enforced():
+    schema = SENTIMENT_RESPONSE_FORMAT["json_schema"]["schema"]
+    assert schema["required"] == ["cheating_sentiment"]
+    assert schema["additionalProperties"] is False
+    assert set(schema["properties"]["cheating_sentiment"]["enum"]) == {
+        s.value for s in CheatingSentiment
+    }
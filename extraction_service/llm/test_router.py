@@ -0,0 +1,127 @@
+import asyncio
+import time
+
+import pytest
+from conftest import MockLLMClient
+from defined_types import ReviewWithSentiment
+from llm.router import Backend, LLMRouter, RoutingStrategy
+from mocks import generate_mock_review, generate_mock_steam_product
+
+
+async def classify(router: LLMRouter, n: int) -> list[ReviewWithSentiment]:
+    steam_product = generate_mock_steam_product()
+    return await asyncio.gather(
+        *[
+            router.cheating_ref_in_review(
+                generate_mock_review(f"review {i}"), steam_product
+            )
+            for i in range(n)
+        ]
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("strategy", list(RoutingStrategy))
+async def test_router_spreads_requests_over_backends(strategy):
+    clients = [MockLLMClient(latency=0.01), MockLLMClient(latency=0.01)]
+    router = LLMRouter(
+        [Backend(client, max_outstanding=2) for client in clients], strategy=strategy
+    )
+
+    await classify(router, 20)
+
+    assert router.usage.n_reviews == 20
+    assert all(client.max_in_flight == 2 for client in clients)
+    assert all(client.usage.n_reviews >= 5 for client in clients)
+
+
+@pytest.mark.asyncio
+async def test_router_takes_failing_backend_out():
+    sick = MockLLMClient(latency=0.01, fail=True)
+    well = MockLLMClient(latency=0.01)
+    router = LLMRouter(
+        [Backend(sick, max_outstanding=1), Backend(well, max_outstanding=1)],
+        failure_threshold=2,
+        cooldown=0.2,
+    )
+
+    results = await classify(router, 10)
+
+    assert all(r.cheating_sentiment is not None for r in results)
+    assert well.usage.n_reviews == 10
+    sick_backend = router.backends[0]
+    assert sick_backend.n_failures == 2
+    assert not sick_backend.is_healthy(time.perf_counter())
+
+    # A passed health check doesn't end the cooldown, only time does
+    sick.fail = False
+    await router.check_health()
+    await classify(router, 10)
+    assert sick.usage.n_reviews == 0
+
+    await asyncio.sleep(0.2)
+    await classify(router, 10)
+    assert sick.usage.n_reviews > 0
+
+
+@pytest.mark.asyncio
+async def test_router_failed_health_check_takes_backend_out():
+    down = MockLLMClient(latency=0.01, healthy=False)
+    up = MockLLMClient(latency=0.01)
+    router = LLMRouter(
+        [Backend(down, max_outstanding=4), Backend(up, max_outstanding=4)]
+    )
+
+    assert await router.check_health()
+    await classify(router, 8)
+    assert down.usage.n_reviews == 0
+
+    # Passing the next check brings it back
+    down.healthy = True
+    await router.check_health()
+    await classify(router, 8)
+    assert down.usage.n_reviews > 0
+
+
+@pytest.mark.asyncio
+async def test_router_spills_over_to_paid_backend_up_to_spend_cap():
+    free = MockLLMClient(latency=0.05)
+    paid = MockLLMClient(latency=0.01)
+    router = LLMRouter(
+        [
+            Backend(free, max_outstanding=2),
+            # One request costs 0.001 + 0.00002 dollars
+            Backend(
+                paid,
+                max_outstanding=2,
+                prompt_cost_per_million_tokens=1,
+                completion_cost_per_million_tokens=2,
+            ),
+        ],
+        max_spend=0.003,
+    )
+
+    # Within its capacity the free backend takes everything
+    await classify(router, 2)
+    assert paid.usage.n_reviews == 0
+
+    await classify(router, 20)
+    assert paid.usage.n_reviews == 4
+    assert free.usage.n_reviews == 18
+    assert router.spent() > 0.003
+
+
+@pytest.mark.asyncio
+async def test_router_tags_labels_with_the_answering_backend():
+    local = MockLLMClient(latency=0.01, model="local")
+    remote = MockLLMClient(latency=0.01, model="remote")
+    router = LLMRouter(
+        [Backend(local, max_outstanding=1), Backend(remote, max_outstanding=1)]
+    )
+
+    results = await classify(router, 10)
+
+    assert router.get_models() == {"local", "remote", "local+remote"}
+    models = [r.model for r in results]
+    assert models.count("local") == local.usage.n_reviews
+    assert models.count("remote") == remote.usage.n_reviews
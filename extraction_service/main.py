@@ -1,84 +1,580 @@
 import argparse
 import asyncio
+import os
+import time
+from dataclasses import dataclass
 from datetime import date, datetime, timedelta, timezone
+from typing import AsyncIterator
 
+import httpx
 from dotenv import load_dotenv
 
 import firebase
+from archive import ReviewArchive
+from checkpoints import PageCheckpointer
 from config import (
+    DEAD_LETTERS_PATH,
     DEFAULT_LOOKBACK_WINDOW_HOURS,
+    LOCAL_CLASSIFIER_PATH,
+    REVIEW_ARCHIVE_PATH,
+    SENTIMENT_CACHE_MAX_ENTRIES,
+    SENTIMENT_CACHE_PATH,
+    SQLITE_STORE_PATH,
     STEAM_REQUEST_PER_SECOND,
-    apex,
-    arc,
-    bf6,
-    cs2,
-    finals,
-    marvel,
-    pubg,
-    tarkov,
+    STEAM_APPS,
+    STEAM_CHECKPOINT_PAGES,
+    STREAM_FLUSH_SIZE,
+    STREAM_QUEUE_SIZE,
+)
+from dead_letters import DeadLetterQueue
+from defined_types import (
+    CheatingSentiment,
+    IngestState,
+    LLMServiceType,
+    PrefilterRecall,
+    ReviewBatch,
+    ReviewWithSentiment,
+    SteamCheckpoint,
+    SteamProduct,
+    SteamReview,
+    StorageType,
+    StoredLabel,
+)
+from llm import local_classifier, local_llama, openrouter
+from llm.local_classifier import LinearClassifier, LocalClassifier
+from llm.router import Backend, LLMRouter, RoutingStrategy
+from llm.cache import SentimentCache
+from llm.client import (
+    AdaptiveLimiter,
+    AsyncLimiter,
+    LLMClient,
+    ReviewPrefilter,
+    extract_cheating_sentiment,
+    stream_cheating_sentiment,
 )
-from defined_types import LLMServiceType, ReviewWithSentiment, SteamProduct
-from llm import local_llama, openrouter
-from llm.client import LLMClient, extract_cheating_sentiment
 from log import log
+from metrics import metrics
 from mocks import generate_mock_review, generate_mock_steam_product
-from steam_product import fetch_steam_reviews, steam_review_base_url
+from storage.firestore import FirestoreStore
+from storage.sqlite import SqliteStore
+from storage.store import ReviewStore
+from steam_product import (
+    create_steam_http_client,
+    fetch_steam_reviews,
+    fetch_steam_reviews_sliced,
+    iter_steam_review_cursor_pages,
+    steam_review_base_url,
+)
 
 load_dotenv()
 
 
-def get_dates(reviews_with_sentiments: list[ReviewWithSentiment]) -> set[date]:
-
-    dates = set(
-        [r.steam_review.timestamp_created.date() for r in reviews_with_sentiments]
-    )
-    return dates
+@dataclass
+class Pipeline:
+    store: ReviewStore
+    llm_client: LLMClient
+    llm_limiter: AsyncLimiter
+    steam_limiter: AsyncLimiter
+    steam_http_client: httpx.AsyncClient
+    dead_letters: DeadLetterQueue
+    cache: SentimentCache | None = None
+    prefilter: ReviewPrefilter | None = None
+    batch_token_budget: int | None = None
+    strict_steam_parsing: bool = False
+    archive: ReviewArchive | None = None
+    steam_base_url: str = steam_review_base_url
 
 
-async def extract_for_steam_product(
-    db: firebase.AsyncClient,
+async def archive_reviews(
+    pipeline: Pipeline,
     steam_product: SteamProduct,
-    llm_client: LLMClient,
-    llm_max_concurrent: int,
-    llm_max_requests_per_second: int,
+    reviews_with_sentiment: list[ReviewWithSentiment],
 ):
+    if pipeline.archive is None:
+        return
+
+    # Encoding and writing parquet would hold up the event loop
+    await asyncio.to_thread(
+        pipeline.archive.append,
+        steam_product,
+        reviews_with_sentiment,
+        pipeline.llm_client.get_model(),
+        pipeline.llm_client.get_prompt_version(),
+    )
+
 
-    last_created_ts = await firebase.get_last_review_ts(db, steam_product.app_id)
-    if last_created_ts is None:
-        last_created_ts = datetime.now(timezone.utc) - timedelta(
-            hours=DEFAULT_LOOKBACK_WINDOW_HOURS
+async def compact_archive(pipeline: Pipeline, steam_apps: list[SteamProduct]):
+    # Each written chunk is a file of its own, merged once a day has many
+    if pipeline.archive is None:
+        return
+
+    for steam_product in steam_apps:
+        n_days = await asyncio.to_thread(pipeline.archive.compact, steam_product.app_id)
+        if n_days > 0:
+            log.info(
+                f"compacted {n_days} archived days for app_id {steam_product.app_id}"
+            )
+
+
+def park_failed_reviews(
+    pipeline: Pipeline,
+    steam_product: SteamProduct,
+    reviews_with_sentiment: list[ReviewWithSentiment],
+) -> ReviewBatch:
+    # Reviews the LLM failed on are parked instead of dropped, the next run retries
+    # them before fetching anything new. Only the columns of the classified ones are
+    # kept, not their texts.
+    failed = [
+        r.steam_review for r in reviews_with_sentiment if r.cheating_sentiment is None
+    ]
+    if len(failed) > 0:
+        log.warning(
+            f"adding {len(failed)} reviews for app_id {steam_product.app_id} to the dead letters"
         )
+        pipeline.dead_letters.add(steam_product, failed)
 
-    reviews = await fetch_steam_reviews(
+    return ReviewBatch.from_reviews(
         steam_product,
-        steam_review_base_url,
-        from_dt=last_created_ts,
-        request_per_second=STEAM_REQUEST_PER_SECOND,
+        reviews_with_sentiment,
+        pipeline.llm_client.get_model(),
+        pipeline.llm_client.get_prompt_version(),
+    ).classified()
+
+
+async def store_review_batch(
+    pipeline: Pipeline,
+    review_batch: ReviewBatch,
+    known_new_after: datetime | None = None,
+    ingest_state: IngestState | None = None,
+) -> set[date]:
+    await pipeline.store.insert_reviews(
+        review_batch, known_new_after=known_new_after, ingest_state=ingest_state
     )
 
+    return review_batch.dates()
+
+
+async def drain_dead_letters(
+    pipeline: Pipeline, steam_product: SteamProduct
+) -> set[date]:
+    reviews = pipeline.dead_letters.get(steam_product)
+    if len(reviews) == 0:
+        return set()
+
+    log.info(f"retrying {len(reviews)} dead letters for app_id {steam_product.app_id}")
     reviews_with_sentiment = await extract_cheating_sentiment(
-        client=llm_client,
+        client=pipeline.llm_client,
         reviews=reviews,
         steam_product=steam_product,
-        max_concurrent=llm_max_concurrent,
-        max_request_per_seconds=llm_max_requests_per_second,
+        limiter=pipeline.llm_limiter,
+        cache=pipeline.cache,
+        prefilter=pipeline.prefilter,
+        batch_token_budget=pipeline.batch_token_budget,
     )
 
-    await firebase.insert_reviews(
-        db=db,
+    await archive_reviews(pipeline, steam_product, reviews_with_sentiment)
+    # The ones that failed again stay, with their failure count bumped
+    review_batch = park_failed_reviews(pipeline, steam_product, reviews_with_sentiment)
+    updated_dates = await store_review_batch(pipeline, review_batch)
+    pipeline.dead_letters.remove(steam_product, list(review_batch.recommendation_ids))
+
+    return updated_dates
+
+
+def advance_ingest_state(
+    ingest_state: IngestState, checkpoint: SteamCheckpoint
+) -> IngestState:
+    # The whole window of the checkpoint is written
+    timestamps = [
+        ts
+        for ts in (ingest_state.last_review_ts, checkpoint.newest_review_ts)
+        if ts is not None
+    ]
+
+    return ingest_state.model_copy(
+        update={
+            "last_review_ts": max(timestamps, default=None),
+            "pending_review_ts": None,
+            "product_known": True,
+            "checkpoint": None,
+        }
+    )
+
+
+async def extract_for_steam_product(
+    pipeline: Pipeline,
+    steam_product: SteamProduct,
+    ingest_state: IngestState,
+    stream: bool = False,
+    backfill_slices: int | None = None,
+):
+    if not ingest_state.product_known:
+        await pipeline.store.ensure_steam_product(steam_product)
+
+    updated_dates = await drain_dead_letters(pipeline, steam_product)
+
+    checkpoint = ingest_state.checkpoint
+    if checkpoint is None:
+        from_dt = ingest_state.last_review_ts
+        if from_dt is None:
+            from_dt = datetime.now(timezone.utc) - timedelta(
+                hours=DEFAULT_LOOKBACK_WINDOW_HOURS
+            )
+        checkpoint = SteamCheckpoint(from_dt=from_dt)
+    else:
+        # Reviews newer than the interrupted window are picked up by the next run
+        log.info(
+            f"resuming app_id {steam_product.app_id} from its checkpoint, written "
+            f"down to {checkpoint.oldest_review_ts}"
+        )
+
+    if stream:
+        updated_dates |= await stream_for_steam_product(
+            pipeline, steam_product, ingest_state, checkpoint
+        )
+    else:
+        # Slices can't resume from a cursor, a checkpointed window is finished the
+        # sequential way
+        if backfill_slices is not None and checkpoint.cursor == "*":
+            reviews = await fetch_steam_reviews_sliced(
+                steam_product,
+                pipeline.steam_base_url,
+                from_dt=checkpoint.from_dt,
+                to_dt=datetime.now(timezone.utc),
+                n_slices=backfill_slices,
+                limiter=pipeline.steam_limiter,
+                http_client=pipeline.steam_http_client,
+                strict=pipeline.strict_steam_parsing,
+            )
+        else:
+            reviews = await fetch_steam_reviews(
+                steam_product,
+                pipeline.steam_base_url,
+                from_dt=checkpoint.from_dt,
+                limiter=pipeline.steam_limiter,
+                http_client=pipeline.steam_http_client,
+                cursor=checkpoint.cursor,
+                strict=pipeline.strict_steam_parsing,
+            )
+
+        checkpoint.update_newest(reviews)
+
+        reviews_with_sentiment = await extract_cheating_sentiment(
+            client=pipeline.llm_client,
+            reviews=reviews,
+            steam_product=steam_product,
+            limiter=pipeline.llm_limiter,
+            cache=pipeline.cache,
+            prefilter=pipeline.prefilter,
+            batch_token_budget=pipeline.batch_token_budget,
+        )
+        await archive_reviews(pipeline, steam_product, reviews_with_sentiment)
+        review_batch = park_failed_reviews(
+            pipeline, steam_product, reviews_with_sentiment
+        )
+        # Frees the review texts before writing
+        del reviews, reviews_with_sentiment
+
+        updated_dates |= await store_review_batch(
+            pipeline,
+            review_batch,
+            known_new_after=ingest_state.known_new_after(),
+            ingest_state=advance_ingest_state(ingest_state, checkpoint),
+        )
+
+    log.info(
+        f"updated the summaries of {len(updated_dates)} days for app_id "
+        f"{steam_product.app_id}"
+    )
+
+
+async def stream_for_steam_product(
+    pipeline: Pipeline,
+    steam_product: SteamProduct,
+    ingest_state: IngestState,
+    checkpoint: SteamCheckpoint,
+) -> set[date]:
+    updated_dates: set[date] = set()
+    known_new_after = ingest_state.known_new_after()
+
+    # Chunks are written newest first, the watermark only moves once all of them
+    # are. Until then any review created before now may already be stored.
+    if ingest_state.pending_review_ts is None:
+        await pipeline.store.set_pending_review_ts(
+            steam_product.app_id, datetime.now(timezone.utc)
+        )
+
+    async def save_checkpoint(checkpoint: SteamCheckpoint):
+        await pipeline.store.set_checkpoint(steam_product.app_id, checkpoint)
+
+    checkpointer = PageCheckpointer(checkpoint, STEAM_CHECKPOINT_PAGES, save_checkpoint)
+
+    async def insert_chunk(chunk: list[ReviewWithSentiment]):
+        await archive_reviews(pipeline, steam_product, chunk)
+        review_batch = park_failed_reviews(pipeline, steam_product, chunk)
+        updated_dates.update(
+            await store_review_batch(
+                pipeline, review_batch, known_new_after=known_new_after
+            )
+        )
+        await checkpointer.written([r.steam_review.recommendation_id for r in chunk])
+
+    async def pages() -> AsyncIterator[list[SteamReview]]:
+        async for page, next_cursor in iter_steam_review_cursor_pages(
+            steam_product,
+            pipeline.steam_base_url,
+            from_dt=checkpoint.from_dt,
+            limiter=pipeline.steam_limiter,
+            http_client=pipeline.steam_http_client,
+            cursor=checkpoint.cursor,
+            strict=pipeline.strict_steam_parsing,
+        ):
+            checkpointer.add_page(page, next_cursor)
+            yield page
+
+    n_classified = await stream_cheating_sentiment(
+        client=pipeline.llm_client,
+        pages=pages(),
         steam_product=steam_product,
-        reviews_with_sentiment=reviews_with_sentiment,
+        limiter=pipeline.llm_limiter,
+        on_chunk=insert_chunk,
+        n_workers=pipeline.llm_limiter.max_concurrency or 1,
+        queue_size=STREAM_QUEUE_SIZE,
+        chunk_size=STREAM_FLUSH_SIZE,
+        cache=pipeline.cache,
+        prefilter=pipeline.prefilter,
+        batch_token_budget=pipeline.batch_token_budget,
+    )
+    log.info(f"classified {n_classified} reviews for app_id {steam_product.app_id}")
+
+    await pipeline.store.set_ingest_state(
+        advance_ingest_state(ingest_state, checkpointer.checkpoint)
     )
 
-    updated_dates = get_dates(reviews_with_sentiment)
+    return updated_dates
 
-    await firebase.summarize_reviews(db, steam_product, updated_dates)
+
+async def replay_archive(
+    pipeline: Pipeline,
+    steam_product: SteamProduct,
+    from_date: date,
+    to_date: date,
+    reclassify: bool = False,
+) -> int:
+    # Labels the archived reviews again with the current model and prompt, Steam
+    # isn't contacted. Reviews already labelled by them are skipped, so a replay
+    # that was interrupted continues where it stopped. A replay only writes the
+    # archive, so the archive records its progress. Reclassifying writes the store
+    # first, and a review the replay already archived may not be stored with the new
+    # label yet, so its progress is read from the labels in the store.
+    model = pipeline.llm_client.get_model()
+    # A router tags labels with the backend that gave them. Labels the prefilter
+    # gave have a model of their own, so they are never current, and the replay
+    # doesn't prefilter so the LLM labels them
+    models = pipeline.llm_client.get_models()
+    prompt_version = pipeline.llm_client.get_prompt_version()
+    previous: dict[int, CheatingSentiment | None] = {}
+    n_changed = 0
+
+    async def pages() -> AsyncIterator[list[SteamReview]]:
+        for archived in pipeline.archive.read(steam_product.app_id, from_date, to_date):
+            labels = {
+                a.steam_review.recommendation_id: StoredLabel(
+                    a.sentiment, a.model, a.prompt_version
+                )
+                for a in archived
+            }
+            if reclassify:
+                # Reviews missing from the store are added with the new label
+                stored = await pipeline.store.get_review_labels(
+                    steam_product.app_id, list(labels)
+                )
+                labels = {
+                    review_id: stored.get(review_id, StoredLabel(None))
+                    for review_id in labels
+                }
+
+            page = []
+            for a in archived:
+                label = labels[a.steam_review.recommendation_id]
+                if label.model in models and label.prompt_version == prompt_version:
+                    continue
+                previous[a.steam_review.recommendation_id] = label.sentiment
+                page.append(a.steam_review)
+            if len(page) > 0:
+                yield page
+
+    async def on_chunk(chunk: list[ReviewWithSentiment]):
+        nonlocal n_changed
+        # Reviews that fail keep their old label and are retried by the next replay
+        if reclassify:
+            review_batch = ReviewBatch.from_reviews(
+                steam_product, chunk, model, prompt_version
+            ).classified()
+            # Every review is looked up, the summaries only move for changed labels
+            await store_review_batch(pipeline, review_batch)
+        await archive_reviews(pipeline, steam_product, chunk)
+        for r in chunk:
+            sentiment = previous.pop(r.steam_review.recommendation_id)
+            if r.cheating_sentiment is not None and r.cheating_sentiment != sentiment:
+                n_changed += 1
+
+    n_classified = await stream_cheating_sentiment(
+        client=pipeline.llm_client,
+        pages=pages(),
+        steam_product=steam_product,
+        limiter=pipeline.llm_limiter,
+        on_chunk=on_chunk,
+        n_workers=pipeline.llm_limiter.max_concurrency or 1,
+        queue_size=STREAM_QUEUE_SIZE,
+        chunk_size=STREAM_FLUSH_SIZE,
+        cache=pipeline.cache,
+        batch_token_budget=pipeline.batch_token_budget,
+    )
+    log.info(
+        f"{'reclassified' if reclassify else 'replayed'} {n_classified} archived "
+        f"reviews for app_id {steam_product.app_id}, {n_changed} got a different label"
+    )
+
+    return n_classified
+
+
+async def create_llm_router(
+    llama_urls: list[str],
+    strategy: RoutingStrategy,
+    max_openrouter_spend: float | None,
+    single_token: bool = False,
+) -> LLMRouter:
+    # One backend per llama-server, sized to its slots. OpenRouter takes the
+    # overflow when its key is set
+    backends = []
+    for url in llama_urls:
+        client = local_llama.LocalLlama(llm_url=url, single_token=single_token)
+        n_slots = await client.discover_slots()
+        backends.append(
+            Backend(
+                client=client,
+                max_outstanding=n_slots or local_llama.LLM_MAX_CONCURRENT,
+                name=httpx.URL(url).netloc.decode(),
+            )
+        )
+
+    if os.getenv("OPEN_ROUTER_API_KEY") is not None:
+        client = openrouter.OpenRouter(openrouter.DEFAULT_MODEL)
+        backends.append(
+            Backend(
+                client=client,
+                max_outstanding=openrouter.LLM_MAX_CONCURRENT,
+                name=httpx.URL(client.api_url).netloc.decode(),
+                prompt_cost_per_million_tokens=openrouter.PROMPT_COST_PER_MILLION_TOKENS,
+                completion_cost_per_million_tokens=openrouter.COMPLETION_COST_PER_MILLION_TOKENS,
+            )
+        )
+    else:
+        log.info("OPEN_ROUTER_API_KEY is missing, the router has no spillover")
+
+    return LLMRouter(backends, strategy=strategy, max_spend=max_openrouter_spend)
+
+
+async def create_llm_client(
+    service_type: LLMServiceType, args: argparse.Namespace, limiter_name: str
+) -> tuple[LLMClient, AdaptiveLimiter]:
+    match service_type:
+        case LLMServiceType.LOCAL:
+            llm_client = local_llama.LocalLlama(single_token=args.single_token)
+            llm_max_concurrent = local_llama.LLM_MAX_CONCURRENT
+            llm_initial_concurrent = local_llama.LLM_INITIAL_CONCURRENT
+            # One request per server slot, more would just queue on the server
+            n_slots = await llm_client.discover_slots()
+            if n_slots is not None:
+                llm_max_concurrent = llm_initial_concurrent = n_slots
+            llm_max_requests_per_second = local_llama.LLM_MAX_REQUESTS_PER_SECOND
+            llm_initial_requests_per_second = (
+                local_llama.LLM_INITIAL_REQUESTS_PER_SECOND
+            )
+        case LLMServiceType.OPENROUTER:
+            llm_client = openrouter.OpenRouter(openrouter.DEFAULT_MODEL)
+            llm_max_concurrent = openrouter.LLM_MAX_CONCURRENT
+            llm_initial_concurrent = openrouter.LLM_INITIAL_CONCURRENT
+            llm_max_requests_per_second = openrouter.LLM_MAX_REQUESTS_PER_SECOND
+            llm_initial_requests_per_second = openrouter.LLM_INITIAL_REQUESTS_PER_SECOND
+        case LLMServiceType.ROUTER:
+            llm_client = await create_llm_router(
+                args.llama_urls,
+                RoutingStrategy(args.routing_strategy),
+                args.max_openrouter_spend,
+                args.single_token,
+            )
+            llm_client.start_health_checks()
+            # The router balances the backends, the limiter only has to let through
+            # enough requests to fill all of them
+            llm_max_concurrent = llm_initial_concurrent = llm_client.max_outstanding()
+            llm_max_requests_per_second = llm_initial_requests_per_second = (
+                local_llama.LLM_MAX_REQUESTS_PER_SECOND * len(llm_client.backends)
+            )
+        case LLMServiceType.CLASSIFIER:
+            escalate, escalate_limiter = None, None
+            if args.escalate_to is not None:
+                escalate, escalate_limiter = await create_llm_client(
+                    LLMServiceType(args.escalate_to), args, "llm_escalate"
+                )
+            llm_client = LocalClassifier(
+                LinearClassifier.load(args.classifier_path),
+                escalate=escalate,
+                escalate_limiter=escalate_limiter,
+                confidence_threshold=args.classifier_confidence,
+                escalate_batch_token_budget=args.batch_token_budget,
+            )
+            # Scoring is CPU bound, a few batches in flight keep the escalations
+            # going while another batch is scored. Batches that wait on
+            # escalations are slow, that's no reason to back off
+            return llm_client, AdaptiveLimiter(
+                max_concurrency=local_classifier.CLASSIFIER_MAX_CONCURRENT,
+                max_requests_per_second=local_classifier.CLASSIFIER_MAX_REQUESTS_PER_SECOND,
+                latency_tolerance=float("inf"),
+                name=limiter_name,
+            )
+
+    llm_limiter = AdaptiveLimiter(
+        max_concurrency=llm_max_concurrent,
+        max_requests_per_second=llm_max_requests_per_second,
+        initial_concurrency=llm_initial_concurrent,
+        initial_requests_per_second=llm_initial_requests_per_second,
+        name=limiter_name,
+    )
+    return llm_client, llm_limiter
+
+
+def log_llm_usage(llm_client: LLMClient, elapsed: float):
+    usage = llm_client.usage
+    if usage.n_reviews == 0:
+        return
+
+    backend = llm_client.get_model()
+    metrics.set("llm_reviews", usage.n_reviews, backend=backend)
+    metrics.set("llm_reviews_per_second", usage.n_reviews / elapsed, backend=backend)
+    metrics.set(
+        "llm_tokens_per_second",
+        (usage.prompt_tokens + usage.completion_tokens) / elapsed,
+        backend=backend,
+    )
+
+    log.info(
+        f"{llm_client.get_model()}: {usage.n_reviews} reviews in {usage.n_requests} "
+        f"requests, {usage.tokens_per_review():.0f} tokens per review, "
+        f"{elapsed / usage.n_reviews * 1000:.1f}s per 1k reviews"
+    )
 
 
 async def main():
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("--summarize-only", action="store_true")
+    parser.add_argument(
+        "--summarize-only",
+        action="store_true",
+        help="Recompute the daily summaries of the last 10 days from the stored "
+        "reviews, repairs summaries the incremental counters got wrong",
+    )
     parser.add_argument(
         "--test-review",
         type=str,
@@ -90,53 +586,342 @@ async def main():
         choices=[s.value for s in LLMServiceType],
         required=True,
     )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Classify and store reviews page by page instead of collecting them all "
+        "first, keeps memory bounded for large backfills. The watermark only moves "
+        "once the whole window is written, an interrupted run starts over",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always ask the LLM instead of reusing cached sentiments for identical "
+        "review texts",
+    )
+    parser.add_argument(
+        "--prefilter",
+        type=str,
+        choices=[r.value for r in PrefilterRecall],
+        help="Label reviews without any cheating related keyword as not mentioned "
+        "without asking the LLM, higher recall levels match more keywords",
+    )
+    parser.add_argument(
+        "--batch-token-budget",
+        type=int,
+        help="Send several reviews per LLM request, packing up to this many "
+        "estimated review tokens into each request",
+    )
+    parser.add_argument(
+        "--backfill-slices",
+        type=int,
+        help="Split the window since the last run into this many time slices and "
+        "page through them concurrently, speeds up large backfills. Not used with "
+        "--stream",
+    )
+    parser.add_argument(
+        "--strict-steam-parsing",
+        action="store_true",
+        help="Validate every field of the Steam responses with pydantic instead of "
+        "only decoding the fields the pipeline uses",
+    )
+    parser.add_argument(
+        "--no-archive",
+        action="store_true",
+        help="Don't keep the classified reviews and their labels in the local "
+        "review archive",
+    )
+    parser.add_argument(
+        "--replay-days",
+        type=int,
+        help="Label the archived reviews of the last N days again with the current "
+        "model and prompt instead of fetching from Steam, the new labels are added "
+        "to the archive",
+    )
+    parser.add_argument(
+        "--reclassify",
+        action="store_true",
+        help="Label the archived reviews between --from-date and --to-date again "
+        "with the current model and prompt and replace the stored labels, the daily "
+        "summaries follow the changed labels. Stopping and running it again "
+        "continues with the reviews that aren't done yet",
+    )
+    parser.add_argument(
+        "--from-date",
+        type=date.fromisoformat,
+        help="First day to reclassify, YYYY-MM-DD",
+    )
+    parser.add_argument(
+        "--to-date",
+        type=date.fromisoformat,
+        help="Last day to reclassify, YYYY-MM-DD, today by default",
+    )
+    parser.add_argument(
+        "--app-ids",
+        type=int,
+        nargs="+",
+        help="Only run for these apps",
+    )
+    parser.add_argument(
+        "--metrics-out",
+        type=str,
+        help="Write the per stage timings and throughput of the run to this file, in "
+        "the Prometheus text format if it ends in .prom and as JSON lines otherwise",
+    )
+    parser.add_argument(
+        "--metrics-summary",
+        action="store_true",
+        help="Log a table of the per stage timings and throughput at the end of the run",
+    )
+    parser.add_argument(
+        "--storage",
+        type=str,
+        choices=[s.value for s in StorageType],
+        default=StorageType.FIRESTORE.value,
+        help="Where to keep the reviews, summaries and ingest state. sqlite keeps "
+        f"them in {SQLITE_STORE_PATH} and needs no credentials",
+    )
+    parser.add_argument(
+        "--llama-urls",
+        type=str,
+        nargs="+",
+        default=[local_llama.LocalLlama.llm_url],
+        help="Chat completion URLs of the llama-servers the router spreads the "
+        "requests over",
+    )
+    parser.add_argument(
+        "--routing-strategy",
+        type=str,
+        choices=[s.value for s in RoutingStrategy],
+        default=RoutingStrategy.LEAST_OUTSTANDING.value,
+        help="How the router picks a llama-server, by the fewest requests in flight "
+        "for its slots or by the shortest expected latency",
+    )
+    parser.add_argument(
+        "--max-openrouter-spend",
+        type=float,
+        help="Dollars the router may spend on OpenRouter when the llama-servers are "
+        "saturated, unlimited by default",
+    )
+    parser.add_argument(
+        "--single-token",
+        action="store_true",
+        help="Let llama-server only generate the first token of one of the "
+        "sentiments instead of a JSON object, and take the confidence from its "
+        "probabilities. Only for single review requests, batches stay JSON",
+    )
+    parser.add_argument(
+        "--classifier-path",
+        type=str,
+        default=LOCAL_CLASSIFIER_PATH,
+        help="Local classifier used by --llm-service-type classifier, trained with "
+        "eval_classifier.py --out",
+    )
+    parser.add_argument(
+        "--classifier-confidence",
+        type=float,
+        default=local_classifier.CLASSIFIER_CONFIDENCE_THRESHOLD,
+        help="Reviews the local classifier labels with a lower probability are "
+        "sent to --escalate-to",
+    )
+    parser.add_argument(
+        "--escalate-to",
+        type=str,
+        choices=[
+            LLMServiceType.LOCAL.value,
+            LLMServiceType.OPENROUTER.value,
+            LLMServiceType.ROUTER.value,
+        ],
+        help="LLM backend for the reviews the local classifier isn't confident "
+        "about, without one the classifier labels every review",
+    )
     args = parser.parse_args()
 
-    firestore_client = firebase.get_firestore_client()
+    match args.storage:
+        case StorageType.FIRESTORE.value:
+            store = FirestoreStore(firebase.get_firestore_client())
+        case StorageType.SQLITE.value:
+            store = SqliteStore(SQLITE_STORE_PATH)
 
-    match args.llm_service_type:
-        case LLMServiceType.LOCAL.value:
-            llm_client = local_llama.LocalLlama()
-            llm_max_concurrent = local_llama.LLM_MAX_CONCURRENT
-            llm_max_requests_per_second = local_llama.LLM_MAX_REQUESTS_PER_SECOND
-        case LLMServiceType.OPENROUTER.value:
-            model = "google/gemma-3-27b-it"
-            llm_client = openrouter.OpenRouter(model)
-            llm_max_concurrent = openrouter.LLM_MAX_CONCURRENT
-            llm_max_requests_per_second = openrouter.LLM_MAX_REQUESTS_PER_SECOND
-        case _:
-            log.error(f"unknown LLM Client Type: {args.model_service}")
-            return
+    # Shared by every app so that running them concurrently doesn't multiply the
+    # request rate seen by the LLM backend or by Steam.
+    llm_client, llm_limiter = await create_llm_client(
+        LLMServiceType(args.llm_service_type), args, "llm"
+    )
+    batch_token_budget = args.batch_token_budget
+    if isinstance(llm_client, LocalClassifier) and batch_token_budget is None:
+        batch_token_budget = local_classifier.CLASSIFIER_BATCH_TOKEN_BUDGET
+    steam_limiter = AsyncLimiter(
+        max_concurrency=None,
+        max_requests_per_second=STEAM_REQUEST_PER_SECOND,
+        name="steam",
+    )
 
-    if args.test_review is not None:
-        review = generate_mock_review(args.test_review)
-        reviews_with_sentiment = await extract_cheating_sentiment(
-            llm_client,
-            reviews=[review],
-            steam_product=generate_mock_steam_product(),
-            max_concurrent=llm_max_concurrent,
-            max_request_per_seconds=llm_max_requests_per_second,
-        )
+    cache = (
+        None
+        if args.no_cache
+        else SentimentCache(SENTIMENT_CACHE_PATH, SENTIMENT_CACHE_MAX_ENTRIES)
+    )
 
-        log.info(f"returned sentiment: {reviews_with_sentiment[0].cheating_sentiment}")
-        return
+    prefilter = (
+        None
+        if args.prefilter is None
+        else ReviewPrefilter(PrefilterRecall(args.prefilter))
+    )
+
+    dead_letters = DeadLetterQueue(DEAD_LETTERS_PATH)
 
-    steam_apps = [finals, arc, bf6, cs2, pubg, marvel, tarkov, apex]
-    if args.summarize_only:
-        for app in steam_apps:
+    start_time = time.perf_counter()
+    try:
+        if args.test_review is not None:
+            review = generate_mock_review(args.test_review)
+            reviews_with_sentiment = await extract_cheating_sentiment(
+                llm_client,
+                reviews=[review],
+                steam_product=generate_mock_steam_product(),
+                limiter=llm_limiter,
+                cache=cache,
+                prefilter=prefilter,
+                batch_token_budget=batch_token_budget,
+            )
+
+            log.info(
+                f"returned sentiment: {reviews_with_sentiment[0].cheating_sentiment}"
+            )
+            return
+
+        steam_apps = STEAM_APPS
+        if args.app_ids is not None:
+            steam_apps = [app for app in STEAM_APPS if app.app_id in args.app_ids]
+        if args.summarize_only:
             today = datetime.now().date()
-            last_10_days = [today - timedelta(days=i) for i in range(10)]
-            await firebase.summarize_reviews(firestore_client, app, set(last_10_days))
-        return
+            last_10_days = {today - timedelta(days=i) for i in range(10)}
+            await asyncio.gather(
+                *[store.summarize_reviews(app, last_10_days) for app in steam_apps]
+            )
+            return
 
-    for app in steam_apps:
-        await extract_for_steam_product(
-            db=firestore_client,
-            steam_product=app,
+        steam_http_client = create_steam_http_client()
+        pipeline = Pipeline(
+            store=store,
             llm_client=llm_client,
-            llm_max_concurrent=llm_max_concurrent,
-            llm_max_requests_per_second=llm_max_requests_per_second,
+            llm_limiter=llm_limiter,
+            steam_limiter=steam_limiter,
+            steam_http_client=steam_http_client,
+            dead_letters=dead_letters,
+            cache=cache,
+            prefilter=prefilter,
+            batch_token_budget=batch_token_budget,
+            strict_steam_parsing=args.strict_steam_parsing,
+            archive=None if args.no_archive else ReviewArchive(REVIEW_ARCHIVE_PATH),
         )
+        if args.replay_days is not None or args.reclassify:
+            if pipeline.archive is None:
+                log.error("replaying needs the review archive")
+                return
+            today = datetime.now(timezone.utc).date()
+            if args.reclassify:
+                if args.from_date is None:
+                    log.error("--reclassify needs --from-date")
+                    return
+                from_date = args.from_date
+                to_date = today if args.to_date is None else args.to_date
+            else:
+                from_date = today - timedelta(days=args.replay_days - 1)
+                to_date = today
+            try:
+                await asyncio.gather(
+                    *[
+                        replay_archive(
+                            pipeline, app, from_date, to_date, args.reclassify
+                        )
+                        for app in steam_apps
+                    ]
+                )
+                await compact_archive(pipeline, steam_apps)
+            finally:
+                await steam_http_client.aclose()
+            return
+
+        ingest_states = await store.get_ingest_states(steam_apps)
+        try:
+            results = await asyncio.gather(
+                *[
+                    extract_for_steam_product(
+                        pipeline,
+                        app,
+                        ingest_states[app.app_id],
+                        stream=args.stream,
+                        backfill_slices=args.backfill_slices,
+                    )
+                    for app in steam_apps
+                ],
+                return_exceptions=True,
+            )
+        finally:
+            await steam_http_client.aclose()
+
+        failed = [
+            (app, r)
+            for app, r in zip(steam_apps, results)
+            if isinstance(r, BaseException)
+        ]
+        for app, e in failed:
+            log.error(f"extraction failed for app_id {app.app_id}: {e!r}")
+        await compact_archive(pipeline, steam_apps)
+        if len(failed) > 0:
+            raise failed[0][1]
+
+    finally:
+        await llm_client.close()
+        await store.close()
+        log_llm_usage(llm_client, time.perf_counter() - start_time)
+        log.info(f"LLM limiter at end of run: {llm_limiter.metrics()}")
+        router = llm_client
+        if isinstance(llm_client, LocalClassifier) and llm_client.escalate is not None:
+            router = llm_client.escalate
+            log.info(
+                f"local classifier escalated {llm_client.n_escalated} reviews to "
+                f"{router.get_model()}"
+            )
+            log_llm_usage(router, time.perf_counter() - start_time)
+            metrics.set("classifier_escalated", llm_client.n_escalated)
+        if isinstance(router, LLMRouter):
+            for name, backend_metrics in router.metrics().items():
+                log.info(f"LLM backend {name} at end of run: {backend_metrics}")
+                for metric, value in backend_metrics.items():
+                    metrics.set(f"llm_backend_{metric}", value, backend=name)
+        if cache is not None:
+            log.info(
+                f"sentiment cache: {cache.hits} hits, {cache.misses} misses, "
+                f"hit rate {cache.hit_rate:.1%}"
+            )
+            cache.close()
+        if prefilter is not None:
+            log.info(
+                f"prefilter skipped the LLM for {prefilter.n_skipped} of "
+                f"{prefilter.n_checked} reviews"
+            )
+        n_dead_letters = dead_letters.count()
+        if n_dead_letters > 0:
+            log.warning(f"{n_dead_letters} reviews are waiting in the dead letters")
+        n_dead_letters_given_up = dead_letters.count_given_up()
+        dead_letters.close()
+
+        metrics.set("run_seconds", time.perf_counter() - start_time)
+        metrics.set("dead_letters", n_dead_letters)
+        metrics.set("dead_letters_given_up", n_dead_letters_given_up)
+        for name, value in llm_limiter.metrics().items():
+            metrics.set(f"llm_limiter_{name}", value)
+        if cache is not None:
+            metrics.set("sentiment_cache_hits", cache.hits)
+            metrics.set("sentiment_cache_misses", cache.misses)
+        if prefilter is not None:
+            metrics.set("prefilter_skipped", prefilter.n_skipped)
+        if args.metrics_out is not None:
+            metrics.write(args.metrics_out)
+        if args.metrics_summary:
+            log.info(f"run metrics:\n{metrics.summary_table()}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,184 @@
+import json
+import os
+import time
+from bisect import bisect_left
+from dataclasses import dataclass, field
+
+# Upper bounds in seconds, wide enough for Steam pages, LLM calls and Firestore
+# commits alike
+LATENCY_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+@dataclass
+class Histogram:
+    buckets: tuple[float, ...]
+    # One count per bucket plus one for everything above the last bound
+    bucket_counts: list[int] = field(default_factory=list)
+    count: int = 0
+    total: float = 0
+
+    def __post_init__(self):
+        if len(self.bucket_counts) == 0:
+            self.bucket_counts = [0] * (len(self.buckets) + 1)
+
+    def observe(self, value: float):
+        self.bucket_counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q: float) -> float:
+        # Interpolated within the bucket holding the q-th observation, good enough to
+        # tell a 50ms stage from a 500ms one
+        if self.count == 0:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.bucket_counts):
+            if n > 0 and seen + n >= rank:
+                lower = 0 if i == 0 else self.buckets[i - 1]
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+def format_labels(labels: Labels) -> str:
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class Metrics:
+    # Collected in memory for the whole run and written out once at the end
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.start = time.perf_counter()
+        self.histograms: dict[tuple[str, Labels], Histogram] = {}
+        self.counters: dict[tuple[str, Labels], float] = {}
+        self.gauges: dict[tuple[str, Labels], float] = {}
+
+    def observe(self, name: str, value: float, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        if key not in self.histograms:
+            self.histograms[key] = Histogram(self.buckets)
+        self.histograms[key].observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: str):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def to_json_lines(self) -> str:
+        lines = []
+        for (name, labels), h in sorted(self.histograms.items()):
+            lines.append(
+                {
+                    "type": "histogram",
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": h.count,
+                    "sum": h.total,
+                    "p50": h.quantile(0.5),
+                    "p90": h.quantile(0.9),
+                    "p99": h.quantile(0.99),
+                    "buckets": dict(
+                        zip([*map(str, self.buckets), "+Inf"], h.bucket_counts)
+                    ),
+                }
+            )
+        for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+            for (name, labels), value in sorted(values.items()):
+                lines.append(
+                    {"type": kind, "name": name, "labels": dict(labels), "value": value}
+                )
+        return "".join(json.dumps(line) + "\n" for line in lines)
+
+    def to_prometheus(self) -> str:
+        lines = []
+        for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+            for name in sorted({name for name, _ in values}):
+                lines.append(f"# TYPE {name} {kind}")
+                for (n, labels), value in sorted(values.items()):
+                    if n == name:
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+
+        for name in sorted({name for name, _ in self.histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (n, labels), h in sorted(self.histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(
+                    [*map(str, self.buckets), "+Inf"], h.bucket_counts
+                ):
+                    cumulative += count
+                    bucket_labels = format_labels((*labels, ("le", bound)))
+                    lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {h.total}")
+                lines.append(f"{name}_count{format_labels(labels)} {h.count}")
+
+        return "".join(line + "\n" for line in lines)
+
+    def write(self, path: str):
+        # Prometheus text format for the node exporter's textfile collector, JSON
+        # lines otherwise. Written next to the file and renamed over it, so the
+        # collector never reads half a file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            if path.endswith(".prom"):
+                f.write(self.to_prometheus())
+            else:
+                f.write(self.to_json_lines())
+        os.replace(tmp_path, path)
+
+    def summary_table(self) -> str:
+        rows = [("stage", "count", "total s", "p50 ms", "p90 ms", "p99 ms")]
+        for (name, labels), h in sorted(self.histograms.items()):
+            rows.append(
+                (
+                    name + format_labels(labels),
+                    str(h.count),
+                    f"{h.total:.1f}",
+                    f"{h.quantile(0.5) * 1000:.0f}",
+                    f"{h.quantile(0.9) * 1000:.0f}",
+                    f"{h.quantile(0.99) * 1000:.0f}",
+                )
+            )
+        for (name, labels), value in sorted({**self.counters, **self.gauges}.items()):
+            rows.append((name + format_labels(labels), f"{value:g}", "", "", "", ""))
+
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        return "\n".join(
+            "  ".join(
+                cell.ljust(w) if i == 0 else cell.rjust(w)
+                for i, (cell, w) in enumerate(zip(row, widths))
+            )
+            for row in rows
+        )
+
+
+metrics = Metrics()
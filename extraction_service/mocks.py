@@ -1,5 +1,11 @@
-from datetime import datetime, timezone
-from defined_types import Author, SteamReview, SteamProduct
+from datetime import datetime, timedelta, timezone
+
+from defined_types import (
+    Author,
+    SteamApiReview,
+    SteamReview,
+    SteamProduct,
+)
 
 
 def generate_mock_author() -> Author:
@@ -16,6 +22,16 @@ def generate_mock_author() -> Author:
 
 def generate_mock_review(review_text: str) -> SteamReview:
     return SteamReview(
+        recommendation_id=0,
+        review=review_text,
+        timestamp_created=datetime.now(tz=timezone.utc),
+        timestamp_updated=datetime.now(tz=timezone.utc),
+        language="en",
+    )
+
+
+def generate_mock_api_review(review_text: str) -> SteamApiReview:
+    return SteamApiReview(
         recommendationid=0,
         author=generate_mock_author(),
         language="en",
@@ -34,5 +50,19 @@ def generate_mock_review(review_text: str) -> SteamReview:
     )
 
 
+def generate_mock_reviews(
+    n: int, newest: datetime, spacing: timedelta = timedelta(minutes=1)
+) -> list[SteamReview]:
+    # Newest first, with distinct ids and creation timestamps
+    reviews = []
+    for i in range(n):
+        review = generate_mock_review(f"review {i}")
+        review.recommendation_id = i + 1
+        review.timestamp_created = newest - i * spacing
+        review.timestamp_updated = review.timestamp_created
+        reviews.append(review)
+    return reviews
+
+
 def generate_mock_steam_product() -> SteamProduct:
     return SteamProduct(name="test product", app_id=0)
@@ -1,66 +1,230 @@
 import asyncio
 from log import log
+from metrics import metrics
 import datetime
+import time
 import httpx
+from typing import AsyncIterator
 from pydantic import ValidationError
+from pydantic_core import from_json
 from defined_types import SteamProduct, SteamReview, SteamReviews
+from http_client import create_http_client
+from llm.client import AsyncLimiter
 
 steam_review_base_url = "https://store.steampowered.com/appreviews/{app_id}"
+STEAM_HTTP_MAX_CONNECTIONS = 4
 
 
-async def fetch_steam_reviews(
+def decode_steam_reviews_page(content: bytes) -> tuple[list[SteamReview], str]:
+    # pydantic's JSON parser, a few times faster than json.loads on these pages
+    data = from_json(content)
+    reviews = [SteamReview.from_dict(r) for r in data['reviews']]
+    return reviews, data['cursor']
+
+
+def create_steam_http_client(
+    max_connections: int = STEAM_HTTP_MAX_CONNECTIONS,
+    transport: httpx.AsyncBaseTransport | None = None
+) -> httpx.AsyncClient:
+    return create_http_client(max_connections, timeout=60, transport=transport)
+
+
+async def get_page(
+    http_client: httpx.AsyncClient, url: str, params: dict
+) -> httpx.Response:
+    start = time.perf_counter()
+    res = await http_client.get(url, params=params)
+    metrics.observe('steam_page_seconds', time.perf_counter() - start)
+    return res
+
+
+async def iter_steam_review_cursor_pages(
     prod: SteamProduct,
     base_url: str,
     from_dt: datetime.datetime,
-    request_per_second: float,
-    only_english: bool = True
-) -> list[SteamReview]:
+    limiter: AsyncLimiter,
+    http_client: httpx.AsyncClient,
+    only_english: bool = True,
+    cursor: str = '*',
+    to_dt: datetime.datetime | None = None,
+    strict: bool = False
+) -> AsyncIterator[tuple[list[SteamReview], str]]:
+    # Yields every page with the cursor of the page after it, a later fetch can
+    # resume from that cursor. With to_dt only reviews created up to it are fetched.
 
     log.info(
         f'fetching reviews for app_id {prod.app_id} from {from_dt.isoformat()}'
     )
 
-    reviews: list[SteamReview] = []
+    n_reviews = 0
 
     params = {
         'json': 1,
         'filter': 'recent',
         'num_per_page': 100,
         'language': 'all',
-        'cursor': "*",
+        'cursor': cursor,
         'purchase_type': 'all'
     }
 
     if only_english:
         params['language'] = 'english'
 
+    if to_dt is not None:
+        params['date_range_type'] = 'include'
+        params['start_date'] = int(from_dt.timestamp())
+        params['end_date'] = int(to_dt.timestamp())
+
     while True:
-        async with httpx.AsyncClient() as client:
-            res = await client.get(
-                base_url.format(app_id=prod.app_id),
-                params=params
-            )
-            log.info(res.url)
+        res = await limiter.run(
+            get_page,
+            http_client,
+            base_url.format(app_id=prod.app_id),
+            params
+        )
+        log.debug(res.url)
 
         res.raise_for_status()
 
         try:
-            batch = SteamReviews.model_validate(res.json())
-        except ValidationError as e:
+            if strict:
+                batch = SteamReviews.model_validate_json(res.content)
+                reviews = [r.to_review() for r in batch.reviews]
+                next_cursor = batch.cursor
+            else:
+                reviews, next_cursor = decode_steam_reviews_page(res.content)
+        except (ValidationError, ValueError, KeyError, TypeError) as e:
             log.error('Failed to parse steam reviews: ', e)
-            log.info(res.json())
+            log.info(res.text)
             break
 
-        for review in batch.reviews:
+        if len(reviews) == 0:
+            log.info('no more reviews available, stopping')
+            break
+
+        page: list[SteamReview] = []
+        reached_older = False
+        for review in reviews:
+            if to_dt is not None and review.timestamp_created > to_dt:
+                continue
             if review.timestamp_created >= from_dt:
-                reviews.append(review)
+                page.append(review)
             else:
-                log.info('reached older reviews, stopping')
-                log.info(f'found {len(reviews)} reviews')
-                return reviews
+                reached_older = True
+                break
+
+        n_reviews += len(page)
+        metrics.inc('steam_reviews_fetched', len(page))
+        if len(page) > 0:
+            yield page, next_cursor
+
+        if reached_older:
+            log.info('reached older reviews, stopping')
+            break
+
+        params['cursor'] = next_cursor
+
+    log.info(f'found {n_reviews} reviews')
+
+
+async def iter_steam_review_pages(
+    prod: SteamProduct,
+    base_url: str,
+    from_dt: datetime.datetime,
+    limiter: AsyncLimiter,
+    http_client: httpx.AsyncClient,
+    only_english: bool = True,
+    cursor: str = '*',
+    strict: bool = False
+) -> AsyncIterator[list[SteamReview]]:
+
+    async for page, _ in iter_steam_review_cursor_pages(
+        prod,
+        base_url,
+        from_dt,
+        limiter,
+        http_client,
+        only_english,
+        cursor,
+        strict=strict
+    ):
+        yield page
 
-        params['cursor'] = batch.cursor
-        await asyncio.sleep(1/request_per_second)
 
-    log.info(f'found {len(reviews)} reviews')
+async def fetch_steam_reviews(
+    prod: SteamProduct,
+    base_url: str,
+    from_dt: datetime.datetime,
+    limiter: AsyncLimiter,
+    http_client: httpx.AsyncClient,
+    only_english: bool = True,
+    cursor: str = '*',
+    strict: bool = False
+) -> list[SteamReview]:
+
+    reviews: list[SteamReview] = []
+    async for page in iter_steam_review_pages(
+        prod,
+        base_url,
+        from_dt,
+        limiter,
+        http_client,
+        only_english,
+        cursor,
+        strict=strict
+    ):
+        reviews.extend(page)
+
     return reviews
+
+
+async def fetch_steam_reviews_sliced(
+    prod: SteamProduct,
+    base_url: str,
+    from_dt: datetime.datetime,
+    to_dt: datetime.datetime,
+    n_slices: int,
+    limiter: AsyncLimiter,
+    http_client: httpx.AsyncClient,
+    only_english: bool = True,
+    strict: bool = False
+) -> list[SteamReview]:
+    # Paging within a slice is sequential since every page needs the previous
+    # cursor, the slices are paged concurrently and share the limiter. Slice bounds
+    # are inclusive, a review on a bound is fetched twice and deduplicated here.
+    slice_span = (to_dt - from_dt) / n_slices
+    slices = [
+        (from_dt + i * slice_span, from_dt + (i + 1) * slice_span)
+        for i in range(n_slices)
+    ]
+    log.info(f'fetching reviews for app_id {prod.app_id} in {n_slices} slices')
+
+    async def fetch_slice(
+        slice_from_dt: datetime.datetime, slice_to_dt: datetime.datetime
+    ) -> list[SteamReview]:
+        reviews: list[SteamReview] = []
+        async for page, _ in iter_steam_review_cursor_pages(
+            prod,
+            base_url,
+            slice_from_dt,
+            limiter,
+            http_client,
+            only_english,
+            to_dt=slice_to_dt,
+            strict=strict
+        ):
+            reviews.extend(page)
+        return reviews
+
+    slice_reviews = await asyncio.gather(
+        *[fetch_slice(slice_from_dt, slice_to_dt) for slice_from_dt, slice_to_dt in slices]
+    )
+
+    reviews_by_id: dict[int, SteamReview] = {}
+    for reviews in slice_reviews:
+        for review in reviews:
+            reviews_by_id[review.recommendation_id] = review
+
+    return sorted(
+        reviews_by_id.values(), key=lambda r: r.timestamp_created, reverse=True
+    )
@@ -0,0 +1,88 @@
+from datetime import date, datetime
+
+import firebase
+from config import FIRESTORE_MAX_CONCURRENT_COMMITS, FIRESTORE_MAX_CONCURRENT_QUERIES
+from defined_types import (
+    CheatingSentiment,
+    IngestState,
+    ReviewBatch,
+    SteamCheckpoint,
+    SteamProduct,
+    StoredLabel,
+)
+from llm.client import AsyncLimiter
+from storage.store import ReviewStore
+
+
+class FirestoreStore(ReviewStore):
+    def __init__(
+        self,
+        db: firebase.AsyncClient,
+        commit_limiter: AsyncLimiter | None = None,
+        query_limiter: AsyncLimiter | None = None,
+    ):
+        self.db = db
+        # Shared by every app, bound the batch commits and the aggregation queries
+        # in flight
+        self.commit_limiter = commit_limiter or AsyncLimiter(
+            max_concurrency=FIRESTORE_MAX_CONCURRENT_COMMITS,
+            max_requests_per_second=None,
+            name="firestore_commits",
+        )
+        self.query_limiter = query_limiter or AsyncLimiter(
+            max_concurrency=FIRESTORE_MAX_CONCURRENT_QUERIES,
+            max_requests_per_second=None,
+            name="firestore_queries",
+        )
+
+    async def get_ingest_states(
+        self, steam_products: list[SteamProduct]
+    ) -> dict[int, IngestState]:
+        return await firebase.get_ingest_states(self.db, steam_products)
+
+    async def set_ingest_state(self, ingest_state: IngestState):
+        await firebase.set_ingest_state(self.db, ingest_state)
+
+    async def set_checkpoint(self, app_id: int, checkpoint: SteamCheckpoint):
+        await firebase.set_checkpoint(self.db, app_id, checkpoint)
+
+    async def set_pending_review_ts(self, app_id: int, pending_review_ts: datetime):
+        await firebase.set_pending_review_ts(self.db, app_id, pending_review_ts)
+
+    async def ensure_steam_product(self, steam_product: SteamProduct):
+        await firebase.ensure_steam_product(self.db, steam_product)
+
+    async def insert_reviews(
+        self,
+        review_batch: ReviewBatch,
+        known_new_after: datetime | None = None,
+        ingest_state: IngestState | None = None,
+    ):
+        await firebase.insert_reviews(
+            self.db,
+            review_batch,
+            known_new_after=known_new_after,
+            limiter=self.commit_limiter,
+            ingest_state=ingest_state,
+        )
+
+    async def get_review_sentiments(
+        self, app_id: int, review_ids: list[int]
+    ) -> dict[int, CheatingSentiment | None]:
+        return await firebase.get_review_sentiments(self.db, app_id, review_ids)
+
+    async def get_review_labels(
+        self, app_id: int, review_ids: list[int]
+    ) -> dict[int, StoredLabel]:
+        return await firebase.get_review_labels(self.db, app_id, review_ids)
+
+    async def summarize_reviews(self, steam_product: SteamProduct, dts: set[date]):
+        await firebase.summarize_reviews(
+            self.db, steam_product, dts, self.query_limiter
+        )
+
+    async def get_summary(self, app_id: int, dt: date) -> dict[str, int] | None:
+        return await firebase.get_summarized_reviews(self.db, app_id, dt)
+
+    async def close(self):
+        self.db.close()
@@ -0,0 +1,295 @@
+import asyncio
+import sqlite3
+import threading
+from collections.abc import Callable
+from datetime import date, datetime, time, timedelta, timezone
+
+from defined_types import (
+    EPOCH,
+    CheatingSentiment,
+    IngestState,
+    ReviewBatch,
+    SteamCheckpoint,
+    SteamProduct,
+    StoredLabel,
+)
+from log import log
+from storage.store import ReviewStore, summary_deltas
+
+# Bound variables per lookup query, well below SQLite's limit
+LOOKUP_CHUNK_SIZE = 900
+
+
+def to_micros(dt: datetime) -> int:
+    return (dt - EPOCH) // timedelta(microseconds=1)
+
+
+class SqliteStore(ReviewStore):
+    # Everything in one local file, for offline runs, tests and benchmarks. Timestamps
+    # are microseconds since the epoch like in ReviewBatch, so a batch is inserted
+    # straight from its columns. sqlite3 calls block, so every query runs on a worker
+    # thread, one at a time under the lock.
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS apps (
+                app_id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS reviews (
+                app_id INTEGER NOT NULL,
+                recommendation_id INTEGER NOT NULL,
+                sentiment TEXT,
+                timestamp_created INTEGER NOT NULL,
+                model TEXT,
+                prompt_version TEXT,
+                PRIMARY KEY (app_id, recommendation_id)
+            );
+            CREATE INDEX IF NOT EXISTS reviews_timestamp_created
+                ON reviews (app_id, timestamp_created);
+            CREATE TABLE IF NOT EXISTS summarized_reviews (
+                app_id INTEGER NOT NULL,
+                date TEXT NOT NULL,
+                sentiment TEXT NOT NULL,
+                n INTEGER NOT NULL,
+                PRIMARY KEY (app_id, date, sentiment)
+            );
+            CREATE TABLE IF NOT EXISTS ingest_state (
+                app_id INTEGER PRIMARY KEY,
+                state TEXT NOT NULL
+            );
+            """
+        )
+        self.conn.commit()
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        def locked():
+            with self.lock:
+                return fn(*args, **kwargs)
+
+        return await asyncio.to_thread(locked)
+
+    def get_ingest_state(self, app_id: int) -> IngestState | None:
+        row = self.conn.execute(
+            "SELECT state FROM ingest_state WHERE app_id = ?", (app_id,)
+        ).fetchone()
+        return None if row is None else IngestState.model_validate_json(row[0])
+
+    def put_ingest_state(self, ingest_state: IngestState):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO ingest_state VALUES (?, ?)",
+            (ingest_state.app_id, ingest_state.model_dump_json()),
+        )
+
+    def update_ingest_state(self, app_id: int, **update):
+        ingest_state = self.get_ingest_state(app_id) or IngestState(app_id=app_id)
+        self.put_ingest_state(ingest_state.model_copy(update=update))
+        self.conn.commit()
+
+    async def get_ingest_states(
+        self, steam_products: list[SteamProduct]
+    ) -> dict[int, IngestState]:
+        return await self.run(self.select_ingest_states, steam_products)
+
+    def select_ingest_states(
+        self, steam_products: list[SteamProduct]
+    ) -> dict[int, IngestState]:
+        states = {}
+        for steam_product in steam_products:
+            app_id = steam_product.app_id
+            ingest_state = self.get_ingest_state(app_id)
+            if ingest_state is None:
+                (last_micros,) = self.conn.execute(
+                    "SELECT MAX(timestamp_created) FROM reviews WHERE app_id = ?",
+                    (app_id,),
+                ).fetchone()
+                product_known = (
+                    self.conn.execute(
+                        "SELECT 1 FROM apps WHERE app_id = ?", (app_id,)
+                    ).fetchone()
+                    is not None
+                )
+                ingest_state = IngestState(
+                    app_id=app_id,
+                    last_review_ts=None
+                    if last_micros is None
+                    else EPOCH + timedelta(microseconds=last_micros),
+                    product_known=product_known,
+                )
+            states[app_id] = ingest_state
+
+        return states
+
+    def write_ingest_state(self, ingest_state: IngestState):
+        self.put_ingest_state(ingest_state)
+        self.conn.commit()
+
+    async def set_ingest_state(self, ingest_state: IngestState):
+        await self.run(self.write_ingest_state, ingest_state)
+
+    async def set_checkpoint(self, app_id: int, checkpoint: SteamCheckpoint):
+        await self.run(self.update_ingest_state, app_id, checkpoint=checkpoint)
+
+    async def set_pending_review_ts(self, app_id: int, pending_review_ts: datetime):
+        await self.run(
+            self.update_ingest_state, app_id, pending_review_ts=pending_review_ts
+        )
+
+    async def ensure_steam_product(self, steam_product: SteamProduct):
+        await self.run(self.insert_steam_product, steam_product)
+
+    def insert_steam_product(self, steam_product: SteamProduct):
+        self.conn.execute(
+            "INSERT OR IGNORE INTO apps VALUES (?, ?)",
+            (steam_product.app_id, steam_product.name),
+        )
+        self.conn.commit()
+
+    def select_review_sentiments(
+        self, app_id: int, review_ids: list[int]
+    ) -> dict[int, CheatingSentiment | None]:
+        sentiments = {}
+        for start in range(0, len(review_ids), LOOKUP_CHUNK_SIZE):
+            chunk = review_ids[start : start + LOOKUP_CHUNK_SIZE]
+            rows = self.conn.execute(
+                "SELECT recommendation_id, sentiment FROM reviews WHERE app_id = ? "
+                f"AND recommendation_id IN ({','.join('?' * len(chunk))})",
+                (app_id, *chunk),
+            )
+            for review_id, sentiment in rows:
+                sentiments[review_id] = CheatingSentiment.from_str(sentiment)
+
+        return sentiments
+
+    async def get_review_sentiments(
+        self, app_id: int, review_ids: list[int]
+    ) -> dict[int, CheatingSentiment | None]:
+        return await self.run(self.select_review_sentiments, app_id, review_ids)
+
+    async def get_review_labels(
+        self, app_id: int, review_ids: list[int]
+    ) -> dict[int, StoredLabel]:
+        return await self.run(self.select_review_labels, app_id, review_ids)
+
+    def select_review_labels(
+        self, app_id: int, review_ids: list[int]
+    ) -> dict[int, StoredLabel]:
+        labels = {}
+        for start in range(0, len(review_ids), LOOKUP_CHUNK_SIZE):
+            chunk = review_ids[start : start + LOOKUP_CHUNK_SIZE]
+            rows = self.conn.execute(
+                "SELECT recommendation_id, sentiment, model, prompt_version FROM "
+                "reviews WHERE app_id = ? "
+                f"AND recommendation_id IN ({','.join('?' * len(chunk))})",
+                (app_id, *chunk),
+            )
+            for review_id, sentiment, model, prompt_version in rows:
+                labels[review_id] = StoredLabel(
+                    CheatingSentiment.from_str(sentiment), model, prompt_version
+                )
+
+        return labels
+
+    async def insert_reviews(
+        self,
+        review_batch: ReviewBatch,
+        known_new_after: datetime | None = None,
+        ingest_state: IngestState | None = None,
+    ):
+        await self.run(self.write_reviews, review_batch, known_new_after, ingest_state)
+
+    def write_reviews(
+        self,
+        review_batch: ReviewBatch,
+        known_new_after: datetime | None,
+        ingest_state: IngestState | None,
+    ):
+        # A single transaction, the reviews, the summaries and the ingest state are
+        # written together or not at all
+        app_id = review_batch.steam_product.app_id
+        review_batch = review_batch.classified()
+
+        known_new_after_micros = (
+            None if known_new_after is None else to_micros(known_new_after)
+        )
+        maybe_stored = [
+            review_id
+            for review_id, ts in zip(
+                review_batch.recommendation_ids, review_batch.timestamps_created
+            )
+            if known_new_after_micros is None or ts <= known_new_after_micros
+        ]
+        stored_sentiments = self.select_review_sentiments(app_id, maybe_stored)
+        deltas = summary_deltas(review_batch, stored_sentiments)
+
+        with self.conn:
+            self.conn.executemany(
+                """INSERT INTO reviews VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (app_id, recommendation_id) DO UPDATE SET
+                    sentiment = excluded.sentiment,
+                    timestamp_created = excluded.timestamp_created,
+                    model = excluded.model,
+                    prompt_version = excluded.prompt_version""",
+                [
+                    (
+                        app_id,
+                        review_id,
+                        review_batch.sentiment(i).value,
+                        review_batch.timestamps_created[i],
+                        review_batch.model_of(i),
+                        review_batch.prompt_version,
+                    )
+                    for i, review_id in enumerate(review_batch.recommendation_ids)
+                ],
+            )
+            self.conn.executemany(
+                """INSERT INTO summarized_reviews VALUES (?, ?, ?, ?)
+                ON CONFLICT (app_id, date, sentiment) DO UPDATE SET
+                    n = n + excluded.n""",
+                [
+                    (app_id, dt.isoformat(), sentiment, n)
+                    for dt, delta in deltas.items()
+                    for sentiment, n in delta.items()
+                ],
+            )
+            if ingest_state is not None:
+                self.put_ingest_state(ingest_state)
+
+        log.info(f"inserted {len(review_batch)} reviews for app_id {app_id}")
+
+    async def summarize_reviews(self, steam_product: SteamProduct, dts: set[date]):
+        await self.run(self.write_summaries, steam_product.app_id, dts)
+
+    def write_summaries(self, app_id: int, dts: set[date]):
+        with self.conn:
+            for dt in dts:
+                start = datetime.combine(dt, time.min, tzinfo=timezone.utc)
+                counts = {sentiment.value: 0 for sentiment in CheatingSentiment}
+                rows = self.conn.execute(
+                    "SELECT sentiment, COUNT(*) FROM reviews WHERE app_id = ? "
+                    "AND timestamp_created >= ? AND timestamp_created < ? "
+                    "AND sentiment IS NOT NULL GROUP BY sentiment",
+                    (app_id, to_micros(start), to_micros(start + timedelta(days=1))),
+                )
+                counts.update(dict(rows))
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO summarized_reviews VALUES (?, ?, ?, ?)",
+                    [(app_id, dt.isoformat(), s, n) for s, n in counts.items()],
+                )
+
+    async def get_summary(self, app_id: int, dt: date) -> dict[str, int] | None:
+        return await self.run(self.select_summary, app_id, dt)
+
+    def select_summary(self, app_id: int, dt: date) -> dict[str, int] | None:
+        rows = self.conn.execute(
+            "SELECT sentiment, n FROM summarized_reviews WHERE app_id = ? AND date = ?",
+            (app_id, dt.isoformat()),
+        ).fetchall()
+        return dict(rows) if len(rows) > 0 else None
+
+    async def close(self):
+        await self.run(self.conn.close)
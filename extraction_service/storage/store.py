@@ -0,0 +1,107 @@
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from datetime import date, datetime
+
+from defined_types import (
+    CheatingSentiment,
+    IngestState,
+    ReviewBatch,
+    SteamCheckpoint,
+    SteamProduct,
+    StoredLabel,
+)
+
+
+def summary_deltas(
+    review_batch: ReviewBatch,
+    stored_sentiments: dict[int, CheatingSentiment | None],
+) -> dict[date, dict[str, int]]:
+    # Counter changes for the daily summaries, a new review adds one to its
+    # sentiment and a reclassified one moves from its stored sentiment to the new one
+    deltas: dict[date, dict[str, int]] = defaultdict(
+        lambda: {sentiment.value: 0 for sentiment in CheatingSentiment}
+    )
+    for i, review_id in enumerate(review_batch.recommendation_ids):
+        sentiment = review_batch.sentiment(i)
+        if sentiment is None:
+            continue
+
+        dt = review_batch.timestamp_created(i).date()
+        if review_id in stored_sentiments:
+            stored = stored_sentiments[review_id]
+            if stored == sentiment:
+                continue
+            if stored is not None:
+                deltas[dt][stored.value] -= 1
+
+        deltas[dt][sentiment.value] += 1
+
+    return dict(deltas)
+
+
+class ReviewStore(ABC):
+    # Where the pipeline keeps the products, the reviews with their sentiments, the
+    # daily summaries and the ingest state of every app
+
+    @abstractmethod
+    async def get_ingest_states(
+        self, steam_products: list[SteamProduct]
+    ) -> dict[int, IngestState]:
+        pass
+
+    @abstractmethod
+    async def set_ingest_state(self, ingest_state: IngestState):
+        pass
+
+    @abstractmethod
+    async def set_checkpoint(self, app_id: int, checkpoint: SteamCheckpoint):
+        pass
+
+    @abstractmethod
+    async def set_pending_review_ts(self, app_id: int, pending_review_ts: datetime):
+        # The stored watermark stays where it was until the reviews are written
+        pass
+
+    @abstractmethod
+    async def ensure_steam_product(self, steam_product: SteamProduct):
+        pass
+
+    @abstractmethod
+    async def insert_reviews(
+        self,
+        review_batch: ReviewBatch,
+        known_new_after: datetime | None = None,
+        ingest_state: IngestState | None = None,
+    ):
+        # Stores the reviews and moves the daily summaries by their summary_deltas.
+        # Reviews created after known_new_after can't be stored yet, everything else
+        # is looked up first so a review that's stored again isn't counted twice.
+        # The ingest state is only written once all the reviews are.
+        pass
+
+    @abstractmethod
+    async def get_review_sentiments(
+        self, app_id: int, review_ids: list[int]
+    ) -> dict[int, CheatingSentiment | None]:
+        # Stored reviews only, ids that aren't stored are missing from the result
+        pass
+
+    @abstractmethod
+    async def get_review_labels(
+        self, app_id: int, review_ids: list[int]
+    ) -> dict[int, StoredLabel]:
+        # Like get_review_sentiments, with the model and prompt that gave the label
+        pass
+
+    @abstractmethod
+    async def summarize_reviews(self, steam_product: SteamProduct, dts: set[date]):
+        # Full recompute of the daily summaries, only needed to repair them
+        pass
+
+    @abstractmethod
+    async def get_summary(self, app_id: int, dt: date) -> dict[str, int] | None:
+        pass
+
+    @abstractmethod
+    async def close(self):
+        pass
@@ -0,0 +1,129 @@
+import asyncio
+from datetime import date, datetime, timezone
+
+import pytest
+
+from defined_types import (
+    CheatingSentiment,
+    IngestState,
+    ReviewBatch,
+    ReviewWithSentiment,
+    SteamCheckpoint,
+)
+from mocks import generate_mock_review, generate_mock_steam_product
+from storage.sqlite import SqliteStore
+
+
+def review_with_sentiment(
+    recommendation_id: int, day: int, sentiment: CheatingSentiment | None
+) -> ReviewWithSentiment:
+    review = generate_mock_review("gg")
+    review.recommendation_id = recommendation_id
+    review.timestamp_created = datetime(2025, 1, day, 12, tzinfo=timezone.utc)
+    return ReviewWithSentiment(
+        steam_product=generate_mock_steam_product(),
+        steam_review=review,
+        cheating_sentiment=sentiment,
+    )
+
+
+def summary(positive: int, not_mentioned: int, negative: int) -> dict[str, int]:
+    return {
+        CheatingSentiment.POSITIVE.value: positive,
+        CheatingSentiment.NOT_MENTIONED.value: not_mentioned,
+        CheatingSentiment.NEGATIVE.value: negative,
+    }
+
+
+@pytest.mark.asyncio
+async def test_sqlite_store_keeps_summaries_in_step(tmp_path):
+    store = SqliteStore(str(tmp_path / "reviews.sqlite"))
+    steam_product = generate_mock_steam_product()
+    app_id = steam_product.app_id
+    reviews = [
+        review_with_sentiment(1, 1, CheatingSentiment.NEGATIVE),
+        review_with_sentiment(2, 1, CheatingSentiment.NEGATIVE),
+        review_with_sentiment(3, 2, CheatingSentiment.POSITIVE),
+        review_with_sentiment(4, 2, None),
+    ]
+    await store.insert_reviews(ReviewBatch.from_reviews(steam_product, reviews))
+    # Inserting the same reviews again must not count them twice
+    await store.insert_reviews(ReviewBatch.from_reviews(steam_product, reviews))
+    assert await store.get_summary(app_id, date(2025, 1, 1)) == summary(0, 0, 2)
+    assert await store.get_summary(app_id, date(2025, 1, 2)) == summary(1, 0, 0)
+
+    reviews[0].cheating_sentiment = CheatingSentiment.NOT_MENTIONED
+    await store.insert_reviews(
+        ReviewBatch.from_reviews(steam_product, reviews[:1], "new model", "v2")
+    )
+    assert await store.get_summary(app_id, date(2025, 1, 1)) == summary(0, 1, 1)
+
+    store.conn.execute("UPDATE summarized_reviews SET n = 100")
+    await store.summarize_reviews(
+        steam_product, {date(2025, 1, 1), date(2025, 1, 2), date(2025, 1, 3)}
+    )
+    assert await store.get_summary(app_id, date(2025, 1, 1)) == summary(0, 1, 1)
+    assert await store.get_summary(app_id, date(2025, 1, 2)) == summary(1, 0, 0)
+    assert await store.get_summary(app_id, date(2025, 1, 3)) == summary(0, 0, 0)
+
+    await store.close()
+
+
+@pytest.mark.asyncio
+async def test_sqlite_store_ingest_state(tmp_path):
+    path = str(tmp_path / "reviews.sqlite")
+    store = SqliteStore(path)
+    steam_product = generate_mock_steam_product()
+    app_id = steam_product.app_id
+
+    states = await store.get_ingest_states([steam_product])
+    assert states[app_id] == IngestState(app_id=app_id)
+
+    await store.ensure_steam_product(steam_product)
+    reviews = [review_with_sentiment(1, 2, CheatingSentiment.NEGATIVE)]
+    await store.insert_reviews(ReviewBatch.from_reviews(steam_product, reviews))
+    # Without a state the watermark comes from the stored reviews
+    states = await store.get_ingest_states([steam_product])
+    assert states[app_id].last_review_ts == reviews[0].steam_review.timestamp_created
+    assert states[app_id].product_known
+
+    checkpoint = SteamCheckpoint(cursor="abc", from_dt=datetime(2025, 1, 1))
+    await store.set_checkpoint(app_id, checkpoint)
+    pending_review_ts = datetime(2025, 1, 3, tzinfo=timezone.utc)
+    await store.set_pending_review_ts(app_id, pending_review_ts)
+    await store.close()
+
+    store = SqliteStore(path)
+    states = await store.get_ingest_states([steam_product])
+    assert states[app_id].checkpoint == checkpoint
+    assert states[app_id].pending_review_ts == pending_review_ts
+
+    ingest_state = IngestState(
+        app_id=app_id, last_review_ts=pending_review_ts, product_known=True
+    )
+    await store.insert_reviews(
+        ReviewBatch.from_reviews(steam_product, []), ingest_state=ingest_state
+    )
+    states = await store.get_ingest_states([steam_product])
+    assert states[app_id] == ingest_state
+    await store.close()
+
+
+@pytest.mark.asyncio
+async def test_sqlite_store_concurrent_inserts(tmp_path):
+    store = SqliteStore(str(tmp_path / "reviews.sqlite"))
+    steam_product = generate_mock_steam_product()
+    batches = [
+        ReviewBatch.from_reviews(
+            steam_product,
+            [review_with_sentiment(i, 1, CheatingSentiment.NEGATIVE) for i in ids],
+        )
+        for ids in (range(0, 60), range(40, 100), range(80, 140))
+    ]
+
+    # The inserts run on worker threads, overlapping reviews still count once
+    await asyncio.gather(*[store.insert_reviews(b) for b in batches])
+    assert await store.get_summary(steam_product.app_id, date(2025, 1, 1)) == summary(
+        0, 0, 140
+    )
+    await store.close()
@@ -0,0 +1,119 @@
+from datetime import date, datetime, timedelta, timezone
+
+from archive import ReviewArchive
+from defined_types import CheatingSentiment, ReviewBatch, ReviewWithSentiment
+from mocks import generate_mock_reviews, generate_mock_steam_product
+
+
+def test_archive_keeps_the_newest_label_per_review(tmp_path):
+    archive = ReviewArchive(str(tmp_path))
+    steam_product = generate_mock_steam_product()
+    # Spans two days, newest first
+    reviews = generate_mock_reviews(
+        4, datetime(2025, 1, 2, 1, tzinfo=timezone.utc), timedelta(hours=1)
+    )
+
+    archive.append(
+        steam_product,
+        [
+            ReviewWithSentiment(steam_product, r, CheatingSentiment.NOT_MENTIONED)
+            for r in reviews
+        ]
+        # Not classified, so not archived
+        + [ReviewWithSentiment(steam_product, reviews[0], None)],
+        "old model",
+        "v1",
+    )
+    archive.append(
+        steam_product,
+        [
+            ReviewWithSentiment(
+                steam_product, reviews[0], CheatingSentiment.NEGATIVE, confidence=0.75
+            )
+        ],
+        "new model",
+        "v2",
+    )
+
+    assert archive.days(steam_product.app_id) == [date(2025, 1, 1), date(2025, 1, 2)]
+    assert archive.days(steam_product.app_id, from_date=date(2025, 1, 2)) == [
+        date(2025, 1, 2)
+    ]
+
+    newest_day = archive.read_day(steam_product.app_id, date(2025, 1, 2))
+    assert [a.steam_review for a in newest_day] == reviews[:2]
+    assert [
+        (a.sentiment, a.model, a.prompt_version, a.confidence) for a in newest_day
+    ] == [
+        (CheatingSentiment.NEGATIVE, "new model", "v2", 0.75),
+        (CheatingSentiment.NOT_MENTIONED, "old model", "v1", None),
+    ]
+
+    pages = list(archive.read(steam_product.app_id))
+    assert [[a.steam_review for a in page] for page in pages] == [
+        reviews[:2],
+        reviews[2:],
+    ]
+    assert list(archive.read(1)) == []
+
+
+def test_review_batch_keeps_the_model_of_each_review():
+    steam_product = generate_mock_steam_product()
+    reviews = generate_mock_reviews(3, datetime(2025, 1, 1, tzinfo=timezone.utc))
+    batch = ReviewBatch.from_reviews(
+        steam_product,
+        [
+            ReviewWithSentiment(steam_product, reviews[0], None),
+            ReviewWithSentiment(
+                steam_product, reviews[1], CheatingSentiment.NEGATIVE, model="local"
+            ),
+            ReviewWithSentiment(steam_product, reviews[2], CheatingSentiment.POSITIVE),
+        ],
+        "local+remote",
+        "v1",
+    )
+
+    assert [batch.model_of(i) for i in range(3)] == [
+        "local+remote",
+        "local",
+        "local+remote",
+    ]
+    classified = batch.classified()
+    assert [classified.model_of(i) for i in range(2)] == ["local", "local+remote"]
+    assert classified[1:].model_of(0) == "local+remote"
+
+    # A batch answered by its own model only keeps that
+    assert (
+        ReviewBatch.from_reviews(
+            steam_product,
+            [ReviewWithSentiment(steam_product, reviews[0], None, model="remote")],
+            "remote",
+        ).row_models
+        is None
+    )
+
+
+def test_archive_compacts_a_day_into_one_file(tmp_path):
+    archive = ReviewArchive(str(tmp_path))
+    steam_product = generate_mock_steam_product()
+    reviews = generate_mock_reviews(3, datetime(2025, 1, 1, 12, tzinfo=timezone.utc))
+    for i, sentiment in enumerate(CheatingSentiment):
+        archive.append(
+            steam_product,
+            [ReviewWithSentiment(steam_product, r, sentiment) for r in reviews],
+            f"model {i}",
+            "v1",
+        )
+    before = archive.read_day(steam_product.app_id, date(2025, 1, 1))
+
+    assert archive.compact(steam_product.app_id, min_files=4) == 0
+    assert archive.compact(steam_product.app_id, min_files=3) == 1
+    assert len(archive.day_files(steam_product.app_id, date(2025, 1, 1))) == 1
+    assert archive.read_day(steam_product.app_id, date(2025, 1, 1)) == before
+    # Older labels are kept
+    assert (
+        archive.read_day(
+            steam_product.app_id, date(2025, 1, 1), lambda m: m == "model 0"
+        )[0].model
+        == "model 0"
+    )
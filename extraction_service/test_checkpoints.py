@@ -0,0 +1,41 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from checkpoints import PageCheckpointer
+from defined_types import SteamCheckpoint, SteamReview
+from mocks import generate_mock_reviews
+
+
+def ids(reviews: list[SteamReview]) -> list[int]:
+    return [r.recommendation_id for r in reviews]
+
+
+@pytest.mark.asyncio
+async def test_checkpoint_only_passes_completely_written_pages():
+    newest = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    reviews = generate_mock_reviews(30, newest)
+    pages = [reviews[0:10], reviews[10:20], reviews[20:30]]
+    saved: list[SteamCheckpoint] = []
+
+    async def save(checkpoint: SteamCheckpoint):
+        saved.append(checkpoint)
+
+    checkpointer = PageCheckpointer(
+        SteamCheckpoint(from_dt=reviews[-1].timestamp_created), 1, save
+    )
+    for i, page in enumerate(pages):
+        checkpointer.add_page(page, f"cursor {i + 1}")
+
+    # The second page is written first, the checkpoint can't move past the first
+    await checkpointer.written(ids(pages[1]))
+    await checkpointer.written(ids(pages[0][:5]))
+    assert saved == []
+
+    await checkpointer.written(ids(pages[0][5:]))
+    assert saved[-1].cursor == "cursor 2"
+    assert saved[-1].oldest_review_ts == pages[1][-1].timestamp_created
+    assert saved[-1].newest_review_ts == newest
+
+    await checkpointer.written(ids(pages[2]))
+    assert saved[-1].cursor == "cursor 3"
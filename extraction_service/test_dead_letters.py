@@ -0,0 +1,36 @@
+from datetime import datetime, timezone
+
+from dead_letters import DeadLetterQueue
+from defined_types import SteamProduct
+from mocks import generate_mock_reviews, generate_mock_steam_product
+
+
+def test_dead_letters_retry_until_max_attempts(tmp_path):
+    dead_letters = DeadLetterQueue(str(tmp_path / "dead_letters.sqlite"), 3)
+    steam_product = generate_mock_steam_product()
+    other_product = SteamProduct(name="other product", app_id=1)
+    # Whole second timestamps like Steam's, so they survive the round trip
+    reviews = generate_mock_reviews(3, datetime(2025, 1, 1, tzinfo=timezone.utc))
+
+    dead_letters.add(steam_product, reviews)
+    dead_letters.add(other_product, reviews[:1])
+    assert dead_letters.get(steam_product) == reviews
+    assert dead_letters.get(other_product) == reviews[:1]
+    assert dead_letters.count() == 4
+
+    # Classified on the next run
+    dead_letters.remove(steam_product, [1])
+    assert dead_letters.get(steam_product) == reviews[1:]
+
+    # Failing again bumps the count, the third failure is the last one
+    dead_letters.add(steam_product, reviews[1:])
+    dead_letters.add(steam_product, reviews[2:])
+    assert dead_letters.get(steam_product) == reviews[1:2]
+    assert dead_letters.count() == 2
+    assert dead_letters.count_given_up() == 1
+
+    dead_letters.add(steam_product, reviews[1:2])
+    assert dead_letters.get(steam_product) == []
+    assert dead_letters.get(other_product) == reviews[:1]
+    assert dead_letters.count_given_up() == 2
+    dead_letters.close()
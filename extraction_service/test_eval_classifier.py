@@ -0,0 +1,105 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from archive import ReviewArchive
+from defined_types import (
+    CheatingSentiment,
+    ReviewBatch,
+    ReviewWithSentiment,
+    SteamReview,
+)
+from eval_classifier import load_labelled_reviews
+from mocks import generate_mock_reviews, generate_mock_steam_product
+from storage.sqlite import SqliteStore
+
+
+@pytest.mark.asyncio
+async def test_load_labelled_reviews_skips_classifier_labels(tmp_path):
+    archive = ReviewArchive(str(tmp_path / "archive"))
+    store = SqliteStore(str(tmp_path / "reviews.sqlite"))
+    steam_product = generate_mock_steam_product()
+    reviews = generate_mock_reviews(3, datetime.now(timezone.utc))
+
+    def labelled(sentiment: CheatingSentiment) -> list[ReviewWithSentiment]:
+        return [ReviewWithSentiment(steam_product, r, sentiment) for r in reviews]
+
+    archive.append(steam_product, labelled(CheatingSentiment.NEGATIVE), "llm", "v1")
+    # Newer labels from the classifier, all of them are skipped
+    archive.append(
+        steam_product,
+        labelled(CheatingSentiment.POSITIVE)[1:],
+        "local-classifier-abc+llm",
+        "v1",
+    )
+    archive.append(
+        steam_product,
+        labelled(CheatingSentiment.NOT_MENTIONED)[:1],
+        "local-classifier-abc",
+        "v1",
+    )
+    # The store only wins with an LLM label
+    await store.insert_reviews(
+        ReviewBatch.from_reviews(
+            steam_product,
+            labelled(CheatingSentiment.POSITIVE)[2:],
+            "local-classifier-abc",
+            "v1",
+        )
+    )
+    await store.insert_reviews(
+        ReviewBatch.from_reviews(
+            steam_product, labelled(CheatingSentiment.POSITIVE)[1:2], "llm", "v2"
+        )
+    )
+
+    result = await load_labelled_reviews(archive, store, 1, [steam_product.app_id])
+
+    assert sorted((r.recommendation_id, s) for r, s in result) == [
+        (1, CheatingSentiment.NEGATIVE),
+        (2, CheatingSentiment.POSITIVE),
+        (3, CheatingSentiment.NEGATIVE),
+    ]
+    await store.close()
+
+
+@pytest.mark.asyncio
+async def test_load_labelled_reviews_skips_prefilter_labels(tmp_path):
+    archive = ReviewArchive(str(tmp_path / "archive"))
+    store = SqliteStore(str(tmp_path / "reviews.sqlite"))
+    steam_product = generate_mock_steam_product()
+    reviews = generate_mock_reviews(3, datetime.now(timezone.utc))
+
+    def prefiltered(review: SteamReview) -> ReviewWithSentiment:
+        return ReviewWithSentiment(
+            steam_product,
+            review,
+            CheatingSentiment.NOT_MENTIONED,
+            model="prefilter-low",
+        )
+
+    archive.append(
+        steam_product,
+        [
+            ReviewWithSentiment(steam_product, r, CheatingSentiment.NEGATIVE)
+            for r in reviews[:2]
+        ],
+        "llm",
+        "v1",
+    )
+    # Newer, but only the keywords were checked. The last review has no LLM
+    # label at all
+    archive.append(
+        steam_product, [prefiltered(reviews[0]), prefiltered(reviews[2])], "llm", "v2"
+    )
+    await store.insert_reviews(
+        ReviewBatch.from_reviews(steam_product, [prefiltered(reviews[1])], "llm", "v2")
+    )
+
+    result = await load_labelled_reviews(archive, store, 1, [steam_product.app_id])
+
+    assert sorted((r.recommendation_id, s) for r, s in result) == [
+        (1, CheatingSentiment.NEGATIVE),
+        (2, CheatingSentiment.NEGATIVE),
+    ]
+    await store.close()
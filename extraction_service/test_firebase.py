@@ -0,0 +1,184 @@
+import os
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+from google.api_core.exceptions import (
+    Aborted,
+    DeadlineExceeded,
+    ResourceExhausted,
+    ServiceUnavailable,
+)
+from google.cloud.firestore_v1.async_client import AsyncClient
+
+from defined_types import (
+    CheatingSentiment,
+    IngestState,
+    ReviewBatch,
+    ReviewWithSentiment,
+    SteamProduct,
+)
+from firebase import (
+    commit_batch,
+    get_ingest_states,
+    insert_reviews,
+    summarize_reviews,
+    summary_deltas,
+)
+from llm.client import AsyncLimiter, RetryPolicy
+from mocks import generate_mock_review, generate_mock_steam_product
+
+
+def review_with_sentiment(
+    recommendation_id: int, day: int, sentiment: CheatingSentiment | None
+) -> ReviewWithSentiment:
+    review = generate_mock_review("gg")
+    review.recommendation_id = recommendation_id
+    review.timestamp_created = datetime(2025, 1, day, 12, tzinfo=timezone.utc)
+    return ReviewWithSentiment(
+        steam_product=generate_mock_steam_product(),
+        steam_review=review,
+        cheating_sentiment=sentiment,
+    )
+
+
+def test_summary_deltas_only_counts_changes():
+    reviews = [
+        review_with_sentiment(1, 1, CheatingSentiment.NEGATIVE),
+        review_with_sentiment(2, 1, CheatingSentiment.NEGATIVE),
+        review_with_sentiment(3, 2, CheatingSentiment.NOT_MENTIONED),
+        review_with_sentiment(4, 2, CheatingSentiment.POSITIVE),
+        review_with_sentiment(5, 3, None),
+    ]
+    stored_sentiments = {
+        2: CheatingSentiment.NEGATIVE,
+        3: CheatingSentiment.NEGATIVE,
+    }
+
+    review_batch = ReviewBatch.from_reviews(generate_mock_steam_product(), reviews)
+    deltas = summary_deltas(review_batch, stored_sentiments)
+
+    day_1 = datetime(2025, 1, 1).date()
+    day_2 = datetime(2025, 1, 2).date()
+    assert set(deltas) == {day_1, day_2}
+    assert deltas[day_1][CheatingSentiment.NEGATIVE.value] == 1
+    assert deltas[day_2][CheatingSentiment.NEGATIVE.value] == -1
+    assert deltas[day_2][CheatingSentiment.NOT_MENTIONED.value] == 1
+    assert deltas[day_2][CheatingSentiment.POSITIVE.value] == 1
+
+
+class FlakyBatch:
+    def __init__(self, errors: list[Exception]):
+        self.errors = errors
+        self.n_commits = 0
+
+    async def commit(self, retry=None):
+        self.n_commits += 1
+        if len(self.errors) > 0:
+            raise self.errors.pop(0)
+
+
+@pytest.mark.asyncio
+async def test_commit_batch_only_retries_unapplied_commits():
+    limiter = AsyncLimiter(max_concurrency=None, max_requests_per_second=None)
+    retry_policy = RetryPolicy(base_delay=0.01)
+
+    batch = FlakyBatch([Aborted("contention"), ResourceExhausted("quota")])
+    await commit_batch(batch, 0, limiter, retry_policy)
+    assert batch.n_commits == 3
+
+    # The commit might have been applied, retrying could count it twice
+    for error in (DeadlineExceeded("deadline exceeded"), ServiceUnavailable("down")):
+        batch = FlakyBatch([error])
+        with pytest.raises(type(error)):
+            await commit_batch(batch, 0, limiter, retry_policy)
+        assert batch.n_commits == 1
+
+
+needs_emulator = pytest.mark.skipif(
+    "FIRESTORE_EMULATOR_HOST" not in os.environ,
+    reason="needs the Firestore emulator",
+)
+
+
+@needs_emulator
+@pytest.mark.asyncio
+async def test_summarize_reviews_repairs_summaries():
+    db = AsyncClient(project="demo-cheating-sentiment")
+    steam_product = SteamProduct(name="test product", app_id=uuid.uuid4().int % 10**9)
+    sentiments = [CheatingSentiment.NEGATIVE] * 3 + [CheatingSentiment.POSITIVE]
+    reviews = [
+        review_with_sentiment(i, 1, sentiment) for i, sentiment in enumerate(sentiments)
+    ]
+    await insert_reviews(db, ReviewBatch.from_reviews(steam_product, reviews))
+    # Inserting the same reviews again must not count them twice
+    await insert_reviews(db, ReviewBatch.from_reviews(steam_product, reviews))
+
+    summary_ref = db.document(
+        f"apps/{steam_product.app_id}/summarized_reviews/2025-01-01"
+    )
+    expected = {
+        CheatingSentiment.POSITIVE.value: 1,
+        CheatingSentiment.NOT_MENTIONED.value: 0,
+        CheatingSentiment.NEGATIVE.value: 3,
+    }
+    assert (await summary_ref.get()).to_dict() == expected
+
+    await summary_ref.set({CheatingSentiment.NEGATIVE.value: 100})
+    await summarize_reviews(db, steam_product, {datetime(2025, 1, 1).date()})
+
+    assert (await summary_ref.get()).to_dict() == expected
+
+
+@needs_emulator
+@pytest.mark.asyncio
+async def test_ingest_state_is_written_with_the_reviews():
+    db = AsyncClient(project="demo-cheating-sentiment")
+    steam_product = SteamProduct(name="test product", app_id=uuid.uuid4().int % 10**9)
+
+    states = await get_ingest_states(db, [steam_product])
+    assert states[steam_product.app_id].last_review_ts is None
+    assert not states[steam_product.app_id].product_known
+
+    reviews = [review_with_sentiment(1, 2, CheatingSentiment.NEGATIVE)]
+    ingest_state = IngestState(
+        app_id=steam_product.app_id,
+        last_review_ts=reviews[0].steam_review.timestamp_created,
+        product_known=True,
+    )
+    await insert_reviews(
+        db,
+        ReviewBatch.from_reviews(steam_product, reviews),
+        ingest_state=ingest_state,
+    )
+
+    states = await get_ingest_states(db, [steam_product])
+    assert states[steam_product.app_id] == ingest_state
+
+
+@needs_emulator
+@pytest.mark.asyncio
+async def test_reclassified_reviews_replace_their_labels():
+    db = AsyncClient(project="demo-cheating-sentiment")
+    steam_product = SteamProduct(name="test product", app_id=uuid.uuid4().int % 10**9)
+    reviews = [
+        review_with_sentiment(i, 1, CheatingSentiment.NOT_MENTIONED) for i in range(3)
+    ]
+    await insert_reviews(db, ReviewBatch.from_reviews(steam_product, reviews))
+
+    reviews[0].cheating_sentiment = CheatingSentiment.NEGATIVE
+    await insert_reviews(
+        db, ReviewBatch.from_reviews(steam_product, reviews, "new model", "v2")
+    )
+
+    summary_ref = db.document(
+        f"apps/{steam_product.app_id}/summarized_reviews/2025-01-01"
+    )
+    assert (await summary_ref.get()).to_dict() == {
+        CheatingSentiment.POSITIVE.value: 0,
+        CheatingSentiment.NOT_MENTIONED.value: 2,
+        CheatingSentiment.NEGATIVE.value: 1,
+    }
+    review = await db.document(f"apps/{steam_product.app_id}/reviews/0").get()
+    assert review.get("model") == "new model"
+    assert review.get("prompt_version") == "v2"
@@ -0,0 +1,146 @@
+from datetime import date, datetime, timedelta, timezone
+
+import httpx
+import pytest
+
+import main
+from archive import ReviewArchive
+from conftest import MockLLMClient
+from dead_letters import DeadLetterQueue
+from defined_types import (
+    CheatingSentiment,
+    PrefilterRecall,
+    ReviewBatch,
+    ReviewWithSentiment,
+)
+from llm.client import AsyncLimiter, ReviewPrefilter, extract_cheating_sentiment
+from mocks import generate_mock_reviews, generate_mock_steam_product
+from storage.sqlite import SqliteStore
+
+DAY = date(2025, 1, 1)
+
+
+async def create_pipeline(tmp_path, n_reviews: int) -> main.Pipeline:
+    # The store and the archive hold n_reviews reviews of one day, labelled
+    # NOT_MENTIONED by an older model
+    pipeline = main.Pipeline(
+        store=SqliteStore(str(tmp_path / "reviews.sqlite")),
+        llm_client=MockLLMClient(CheatingSentiment.NEGATIVE),
+        llm_limiter=AsyncLimiter(max_concurrency=None, max_requests_per_second=None),
+        steam_limiter=AsyncLimiter(max_concurrency=None, max_requests_per_second=None),
+        steam_http_client=httpx.AsyncClient(),
+        dead_letters=DeadLetterQueue(str(tmp_path / "dead_letters.sqlite")),
+        archive=ReviewArchive(str(tmp_path / "archive")),
+    )
+    steam_product = generate_mock_steam_product()
+    reviews = generate_mock_reviews(
+        n_reviews, datetime(2025, 1, 1, 23, tzinfo=timezone.utc), timedelta(minutes=1)
+    )
+    labelled = [
+        ReviewWithSentiment(steam_product, r, CheatingSentiment.NOT_MENTIONED)
+        for r in reviews
+    ]
+    await pipeline.store.insert_reviews(
+        ReviewBatch.from_reviews(steam_product, labelled, "old model", "v1")
+    )
+    pipeline.archive.append(steam_product, labelled, "old model", "v1")
+    return pipeline
+
+
+async def stored_models(pipeline: main.Pipeline, n_reviews: int) -> set[str]:
+    labels = await pipeline.store.get_review_labels(0, list(range(1, n_reviews + 1)))
+    return {label.model for label in labels.values()}
+
+
+@pytest.mark.asyncio
+async def test_reclassify_after_replay_relabels_the_store(tmp_path):
+    pipeline = await create_pipeline(tmp_path, 4)
+    steam_product = generate_mock_steam_product()
+
+    # The replay only labels the archive
+    assert await main.replay_archive(pipeline, steam_product, DAY, DAY) == 4
+    assert await main.replay_archive(pipeline, steam_product, DAY, DAY) == 0
+    assert await stored_models(pipeline, 4) == {"old model"}
+
+    assert await main.replay_archive(pipeline, steam_product, DAY, DAY, True) == 4
+    assert await stored_models(pipeline, 4) == {"mock"}
+    assert await pipeline.store.get_summary(0, DAY) == {
+        CheatingSentiment.POSITIVE.value: 0,
+        CheatingSentiment.NOT_MENTIONED.value: 0,
+        CheatingSentiment.NEGATIVE.value: 4,
+    }
+    assert await main.replay_archive(pipeline, steam_product, DAY, DAY, True) == 0
+
+    # A new prompt makes every label stale again
+    pipeline.llm_client.base_prompt += " "
+    assert await main.replay_archive(pipeline, steam_product, DAY, DAY, True) == 4
+    await pipeline.steam_http_client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_interrupted_reclassify_resumes(tmp_path, monkeypatch):
+    pipeline = await create_pipeline(tmp_path, 6)
+    steam_product = generate_mock_steam_product()
+    monkeypatch.setattr(main, "STREAM_FLUSH_SIZE", 2)
+
+    insert_reviews = pipeline.store.insert_reviews
+    n_inserts = 0
+
+    async def insert_reviews_once(*args, **kwargs):
+        nonlocal n_inserts
+        n_inserts += 1
+        if n_inserts > 1:
+            raise ConnectionError("store went away")
+        await insert_reviews(*args, **kwargs)
+
+    monkeypatch.setattr(pipeline.store, "insert_reviews", insert_reviews_once)
+    with pytest.raises(ExceptionGroup) as exc_info:
+        await main.replay_archive(pipeline, steam_product, DAY, DAY, True)
+    assert exc_info.group_contains(ConnectionError)
+
+    monkeypatch.setattr(pipeline.store, "insert_reviews", insert_reviews)
+    pipeline.llm_client.reviews.clear()
+    assert await main.replay_archive(pipeline, steam_product, DAY, DAY, True) == 4
+    assert len(pipeline.llm_client.reviews) == 4
+    assert await stored_models(pipeline, 6) == {"mock"}
+    assert await pipeline.store.get_summary(0, DAY) == {
+        CheatingSentiment.POSITIVE.value: 0,
+        CheatingSentiment.NOT_MENTIONED.value: 0,
+        CheatingSentiment.NEGATIVE.value: 6,
+    }
+    await pipeline.steam_http_client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_reclassify_sends_prefiltered_reviews_to_the_llm(tmp_path):
+    pipeline = await create_pipeline(tmp_path, 0)
+    pipeline.prefilter = ReviewPrefilter(PrefilterRecall.LOW)
+    steam_product = generate_mock_steam_product()
+    reviews = generate_mock_reviews(
+        2, datetime(2025, 1, 1, 23, tzinfo=timezone.utc), timedelta(minutes=1)
+    )
+    reviews[0].review = "so many cheaters"
+
+    labelled = await extract_cheating_sentiment(
+        pipeline.llm_client,
+        reviews,
+        steam_product,
+        pipeline.llm_limiter,
+        prefilter=pipeline.prefilter,
+    )
+    review_batch = main.park_failed_reviews(pipeline, steam_product, labelled)
+    await main.store_review_batch(pipeline, review_batch)
+    await main.archive_reviews(pipeline, steam_product, labelled)
+    labels = await pipeline.store.get_review_labels(0, [1, 2])
+    assert [labels[i].model for i in (1, 2)] == ["mock", "prefilter-low"]
+    assert [a.model for a in pipeline.archive.read_day(0, DAY)] == [
+        "mock",
+        "prefilter-low",
+    ]
+
+    # Only the prefiltered review isn't current, and the LLM labels it now
+    pipeline.llm_client.reviews.clear()
+    assert await main.replay_archive(pipeline, steam_product, DAY, DAY, True) == 1
+    assert pipeline.llm_client.reviews == [reviews[1].review]
+    assert await stored_models(pipeline, 2) == {"mock"}
+    await pipeline.steam_http_client.aclose()
@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+from llm.client import AsyncLimiter
+from metrics import Metrics, metrics
+
+
+def test_metrics_export():
+    m = Metrics(buckets=(0.1, 1))
+    for value in [0.05] * 98 + [0.5, 5]:
+        m.observe("llm_request_seconds", value, backend="local")
+    m.inc("steam_reviews_fetched", 100)
+    m.set("run_seconds", 12.5)
+
+    h = m.histograms[("llm_request_seconds", (("backend", "local"),))]
+    assert h.bucket_counts == [98, 1, 1]
+    assert h.quantile(0.5) < 0.1
+    assert 0.1 < h.quantile(0.99) <= 1
+
+    prometheus = m.to_prometheus().splitlines()
+    assert 'llm_request_seconds_bucket{backend="local",le="1"} 99' in prometheus
+    assert 'llm_request_seconds_bucket{backend="local",le="+Inf"} 100' in prometheus
+    assert 'llm_request_seconds_count{backend="local"} 100' in prometheus
+    assert "steam_reviews_fetched 100" in prometheus
+    assert "# TYPE run_seconds gauge" in prometheus
+
+    lines = [json.loads(line) for line in m.to_json_lines().splitlines()]
+    assert [(line["type"], line["name"]) for line in lines] == [
+        ("histogram", "llm_request_seconds"),
+        ("counter", "steam_reviews_fetched"),
+        ("gauge", "run_seconds"),
+    ]
+    assert lines[0]["labels"] == {"backend": "local"}
+
+
+@pytest.mark.asyncio
+async def test_named_limiter_reports_its_wait():
+    limiter = AsyncLimiter(
+        max_concurrency=None, max_requests_per_second=20, name="test"
+    )
+
+    async def noop():
+        pass
+
+    for _ in range(3):
+        await limiter.run(noop)
+
+    h = metrics.histograms[("limiter_wait_seconds", (("limiter", "test"),))]
+    assert h.count == 3
+    # The second and third call waited for the rate limit
+    assert h.total >= 0.09
+
+
+def test_metrics_write_replaces_the_file(tmp_path):
+    path = tmp_path / "extraction.prom"
+    path.write_text("stale\n")
+    m = Metrics()
+    m.set("run_seconds", 1)
+
+    m.write(str(path))
+
+    assert "run_seconds 1" in path.read_text().splitlines()
+    # The textfile collector never sees a temporary file
+    assert [p.name for p in tmp_path.iterdir()] == ["extraction.prom"]
@@ -0,0 +1,80 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from benchmarks.stub_server import StubServer, steam_reviews_route
+from llm.client import AsyncLimiter
+from mocks import generate_mock_reviews, generate_mock_steam_product
+from steam_product import (
+    create_steam_http_client,
+    fetch_steam_reviews,
+    fetch_steam_reviews_sliced,
+    iter_steam_review_cursor_pages,
+)
+
+APP_REVIEWS_PATH = "/appreviews/0"
+
+
+@pytest.mark.asyncio
+async def test_fetch_steam_reviews_resumes_from_cursor():
+    newest = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    reviews = generate_mock_reviews(250, newest)
+    from_dt = reviews[-1].timestamp_created
+    routes = {APP_REVIEWS_PATH: steam_reviews_route(reviews)}
+    limiter = AsyncLimiter(max_concurrency=None, max_requests_per_second=None)
+
+    with StubServer(routes=routes) as stub:
+        base_url = stub.url + "/appreviews/{app_id}"
+        http_client = create_steam_http_client()
+
+        pages = iter_steam_review_cursor_pages(
+            generate_mock_steam_product(), base_url, from_dt, limiter, http_client
+        )
+        first_page, next_cursor = await anext(pages)
+        await pages.aclose()
+
+        resumed = await fetch_steam_reviews(
+            generate_mock_steam_product(),
+            base_url,
+            from_dt,
+            limiter,
+            http_client,
+            cursor=next_cursor,
+        )
+        await http_client.aclose()
+
+    assert len(first_page) == 100
+    assert [r.recommendation_id for r in first_page + resumed] == [
+        r.recommendation_id for r in reviews
+    ]
+    cursors = [r.query["cursor"][0] for r in stub.requests]
+    assert cursors.count("*") == 1
+
+
+@pytest.mark.asyncio
+async def test_fetch_steam_reviews_sliced_merges_slices():
+    newest = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    reviews = generate_mock_reviews(500, newest)
+    n_slices = 4
+    routes = {APP_REVIEWS_PATH: steam_reviews_route(reviews)}
+    limiter = AsyncLimiter(max_concurrency=None, max_requests_per_second=None)
+
+    with StubServer(routes=routes) as stub:
+        http_client = create_steam_http_client()
+        sliced = await fetch_steam_reviews_sliced(
+            generate_mock_steam_product(),
+            stub.url + "/appreviews/{app_id}",
+            from_dt=reviews[-1].timestamp_created,
+            to_dt=newest,
+            n_slices=n_slices,
+            limiter=limiter,
+            http_client=http_client,
+        )
+        await http_client.aclose()
+
+    # Reviews on a slice bound come back from both slices but only once here
+    assert [r.recommendation_id for r in sliced] == [
+        r.recommendation_id for r in reviews
+    ]
+    start_dates = {r.query["start_date"][0] for r in stub.requests}
+    assert len(start_dates) == n_slices